@@ -1,10 +1,17 @@
 #!/usr/bin/env python
 
+import hashlib
+import os
 import os.path as op
 import re
+import socket
+import threading
+import time
 
 from adb import adb_commands
+from adb import adb_protocol
 from adb import sign_m2crypto
+from adb import usb_exceptions
 
 __author__ = "Alex Hoffman"
 __copyright__ = "Copyright 2019, Alex Hoffman"
@@ -14,6 +21,53 @@ __maintainer__ = "Alex Hoffman"
 __email__ = "alex.hoffman@tum.de"
 __status__ = "Beta"
 
+# Errors raised by the ADB transport when the device connection has been lost
+connection_errors = (usb_exceptions.CommonUsbError,
+                     adb_protocol.InvalidResponseError, socket.error)
+
+
+class CommandBatch:
+    """ Collects reads, writes and commands such that they can be executed on the target device in a single
+    shell invocation instead of one ADB round-trip each. Each queued call returns the index of its output in
+    the list returned by run().
+    """
+    def __init__(self, adb):
+        self.adb = adb
+        self.commands = []
+        self.statuses = []
+        # Only batches of reads and overwrites are retried after a lost connection, see ADBInterface.command
+        self.idempotent = True
+
+    def _add(self, command):
+        self.commands.append(command)
+        return len(self.commands) - 1
+
+    def command(self, command, idempotent=False):
+        self.idempotent = self.idempotent and idempotent
+        return self._add(command)
+
+    def read_file(self, filename):
+        return self._add("cat " + filename)
+
+    def write_file(self, filename, contents):
+        return self._add("echo " + contents + " > " + filename)
+
+    def clear_file(self, filename):
+        return self.write_file(filename, "")
+
+    def append_to_file(self, filename, contents):
+        self.idempotent = False
+        return self._add("echo " + contents + " >> " + filename)
+
+    def run(self):
+        """ Executes all queued commands.
+
+        :return: List of the commands' outputs, in the order that they were queued
+        """
+        outputs, self.statuses = self.adb.run_batch(self.commands,
+                                                    self.idempotent)
+        return outputs
+
 
 class ADBInterface:
     """ Object to interface with an attached Android device over an ADB connection. The ADB connection
@@ -24,24 +78,106 @@ class ADBInterface:
     """
 
     current_interface = None
+    hash_chunk_size = 1024 * 1024
+
+    # Each batched command is followed by the marker and its exit status, used to split the combined output
+    batch_marker = "--adb-batch-status--"
+    batch_marker_re = re.compile(re.escape(batch_marker) + r"(\d+)\r?\n")
+    # Older adbd versions limit the length of a shell command to a single 4K message
+    max_batch_length = 4000
+
+    def __init__(self, serial=None):
+        """
+        :param serial: Serial of the target device, either a USB serial or "host:port" for a TCP connection. The
+        first USB device found is used if not given.
+        """
+        self.serial = serial
+        self.device = None
+        self.lock = threading.RLock()
+        self.last_used = 0
+        self._connect()
 
-    def __init__(self):
+    def __del__(self):
+        self.current_interface = None
+        if self.device:
+            self.device.Close()
+
+    def _connect(self):
         signer = sign_m2crypto.M2CryptoSigner(
             op.expanduser("~/.android/adbkey"))
         self.device = adb_commands.AdbCommands()
-        self.device.ConnectDevice(rsa_keys=[signer])
+        self.device.ConnectDevice(serial=self.serial, rsa_keys=[signer])
         # ADBInterface.current_interface = self
+        self.last_used = time.time()
         self.kill_media()
 
-    def __del__(self):
-        self.current_interface = None
-        self.device.Close()
+    def close(self):
+        """ Closes the connection, which is reestablished once the interface is next used.
+        """
+        with self.lock:
+            if self.device is not None:
+                try:
+                    self.device.Close()
+                except Exception:
+                    pass
+                self.device = None
+
+    def _get_device(self):
+        """ Returns the connected device, reconnecting if the interface has been closed, see close.
+        """
+        if self.device is None:
+            print("ADB connection closed, reconnecting")
+            self._connect()
+        return self.device
+
+    def reconnect(self):
+        """ Closes the current, presumably broken, connection and establishes a new one.
+        """
+        with self.lock:
+            try:
+                self.device.Close()
+            except Exception:
+                pass
+            self._connect()
+
+    def is_alive(self):
+        """ Checks that the connection still responds to a shell command.
+        """
+        try:
+            with self.lock:
+                if self.device is None:
+                    return False
+                return self.device.Shell("echo 1").strip() == "1"
+        except Exception:
+            return False
+
+    def _call(self, function, *args, **kwargs):
+        """ Calls a function of the underlying ADB connection. If the connection has been lost it is reestablished
+        and, if the call can safely be made twice, the call is retried once.
+
+        :param function: Name of the AdbCommands function that is to be called
+        :param retry: Keyword argument, retries the call after a lost connection, defaults to False
+        :return: The return value of the called function
+        """
+        retry = kwargs.pop("retry", False)
+        with self.lock:
+            try:
+                result = getattr(self._get_device(), function)(*args,
+                                                               **kwargs)
+            except connection_errors, e:
+                print("ADB connection lost ({}), reconnecting".format(e))
+                self.reconnect()
+                if not retry:
+                    raise e
+                result = getattr(self.device, function)(*args, **kwargs)
+            self.last_used = time.time()
+            return result
 
     def kill_media(self):
         self.kill_proc("process.media")
 
     # Used for a bug in Lineage OS 7.1 where the media service consumes all network memory, causing ADB errors and
-    # killing the tool
+    # killing the tool. Its commands are not retried as it is run while connecting, see _connect.
     def kill_proc(self, proc):
         re_line = self.command("busybox top -n 1 | grep {}".format(proc))
 
@@ -54,13 +190,83 @@ class ADBInterface:
                 self.command("kill {}".format(line))
                 print("killed {} proc: {}".format(proc, line))
 
-    def command(self, command):
+    def command(self, command, timeout_ms=None, idempotent=False):
         """ Executes a command on the target device.
 
         :param command: String literal of the command that is to be run
+        :param timeout_ms: Timeout for long running commands, the connection's default timeout is used if not given
+        :param idempotent: The command can safely be run twice, ie. it only reads or overwrites files, and is
+        retried if the connection is lost. Other commands, such as appends, are not retried as they may have
+        been executed before the connection was lost.
         :return: The text output that would otherwise be displayed on stdout
         """
-        return self.device.Shell(command)
+        return self._call("Shell",
+                          command,
+                          timeout_ms=timeout_ms,
+                          retry=idempotent)
+
+    def stream_command(self, command, timeout_ms=None):
+        """ Executes a long running command on the target device, yielding its output as it is produced. The
+        connection is held until the command completes. A lost connection is not retried as the output that has
+        already been read cannot be replayed.
+
+        :param command: String literal of the command that is to be run
+        :param timeout_ms: Timeout for the command, the connection's default timeout is used if not given
+        :return: Generator of the command's output, in the chunks in which it is received
+        """
+        with self.lock:
+            for output in self._get_device().StreamingShell(
+                    command, timeout_ms=timeout_ms):
+                self.last_used = time.time()
+                yield output
+
+    def batch(self):
+        """ Creates a command batch, see CommandBatch.
+
+        :return: An empty CommandBatch that runs its commands through this interface
+        """
+        return CommandBatch(self)
+
+    def run_batch(self, commands, idempotent=False):
+        """ Executes a list of commands using as few shell invocations as possible. The output of each command
+        is delimited by a marker that also records the command's exit status.
+
+        :param commands: List of command strings
+        :param idempotent: All commands can safely be run twice, see command
+        :return: Tuple of the list of command outputs and the list of exit statuses
+        """
+        outputs = []
+        statuses = []
+
+        script = []
+        script_length = 0
+        for command in commands:
+            line = "{}; echo \"\n{}$?\"".format(command, self.batch_marker)
+            if script and script_length + len(line) > self.max_batch_length:
+                self._run_script(script, outputs, statuses, idempotent)
+                script = []
+                script_length = 0
+            script.append(line)
+            script_length += len(line) + 2
+
+        if script:
+            self._run_script(script, outputs, statuses, idempotent)
+
+        return outputs, statuses
+
+    def _run_script(self, script, outputs, statuses, idempotent):
+        result = self.batch_marker_re.split(
+            self.command("; ".join(script), idempotent=idempotent))
+        # [output, status, output, status, ..., trailing output]
+        for i in range(0, len(result) - 1, 2):
+            output = result[i]
+            # Strip the newline that was printed before the marker
+            if output.endswith("\r\n"):
+                output = output[:-2]
+            elif output.endswith("\n"):
+                output = output[:-1]
+            outputs.append(output)
+            statuses.append(int(result[i + 1]))
 
     def write_file(self, filename, contents):
         """ Writes the provided string into the target file, this is done using 'echo >'.
@@ -69,7 +275,7 @@ class ADBInterface:
         :param contents: String contents that is to be written into file
         """
         command = "echo " + contents + " > " + filename
-        self.device.Shell(command)
+        self.command(command, idempotent=True)
 
     def clear_file(self, filename):
         """ Clears the target file using 'echo >'
@@ -85,25 +291,177 @@ class ADBInterface:
         :param contents: String contents that is to be appended to the target file
         """
         command = "echo " + contents + " >> " + filename
-        self.device.Shell(command)
+        self.command(command)
 
-    def read_file(self, filename):
+    def read_file(self, filename, dest_file=None):
         """ Reads the contents of a target file on the target Android system.
 
         :param filename: File that is to be read
-        :return: A string representation of the target file's contents
+        :param dest_file: Optional file handle into which the contents are streamed instead of being returned
+        :return: A string representation of the target file's contents, if no destination file is given
         """
-        return self.device.Pull(filename)
+        if dest_file is not None:
+            # Not retried as the destination may already hold part of the file
+            self._call("Pull", filename, dest_file=dest_file)
+            return None
 
-    def pull_file(self, target_file, dest_filename):
+        return self._call("Pull", filename, retry=True)
+
+    def pull_file(self,
+                  target_file,
+                  dest_filename,
+                  progress_callback=None,
+                  verify=True):
         """ Pulls the target file from the target Android system into the provided file, relative to the
-        working directory.
+        working directory. The file is streamed to disk as it is received such that it is never held in memory.
 
         :param target_file: File path and name of the file that is to be pulled
         :param dest_filename: File path and name, relative to working directory, where the pulled file
         should be stored
+        :param progress_callback: Called as progress_callback(filename, bytes_written, total_bytes) as chunks
+        are written
+        :param verify: Checks the size and MD5 sum of the pulled file against the target's file
         """
         self.kill_media()
-        f = open(dest_filename, "wb+")
-        f.write(self.device.Pull(target_file))
-        f.close()
+        # Not retried through _call as a broken transfer must restart with an empty file
+        with self.lock:
+            try:
+                with open(dest_filename, "wb+") as f:
+                    self._get_device().Pull(
+                        target_file,
+                        dest_file=f,
+                        progress_callback=progress_callback)
+            except connection_errors, e:
+                print("ADB connection lost ({}), reconnecting".format(e))
+                self.reconnect()
+                with open(dest_filename, "wb+") as f:
+                    self.device.Pull(target_file,
+                                     dest_file=f,
+                                     progress_callback=progress_callback)
+            self.last_used = time.time()
+
+        if verify:
+            self._verify_pull(target_file, dest_filename)
+
+    def pull_files(self, files, progress_callback=None, verify=True):
+        """ Pulls a number of files, concurrently if the transport allows it. A USB device can only be claimed
+        by a single connection, as such the files are only pulled in parallel over TCP connections.
+
+        :param files: List of (target file, destination filename) tuples
+        :param progress_callback: See pull_file
+        :param verify: See pull_file
+        """
+        if not self.supports_concurrent_transfers():
+            for target_file, dest_filename in files:
+                self.pull_file(target_file, dest_filename, progress_callback,
+                               verify)
+            return
+
+        errors = []
+
+        def pull(target_file, dest_filename):
+            try:
+                ADBInterface(self.serial).pull_file(target_file,
+                                                    dest_filename,
+                                                    progress_callback, verify)
+            except Exception, e:
+                errors.append(e)
+
+        threads = [
+            threading.Thread(target=pull, args=(target_file, dest_filename))
+            for target_file, dest_filename in files
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            raise errors[0]
+
+    def supports_concurrent_transfers(self):
+        """ Only TCP connections, given as "host:port", can be opened multiple times to the same device.
+        """
+        return self.serial is not None and ":" in self.serial
+
+    def _verify_pull(self, target_file, dest_filename):
+        """ Compares the size and MD5 sum of a pulled file with the file on the target system. Pseudo files,
+        such as those in debugfs, report a size of zero and cannot be checked.
+
+        :param target_file: The file on the target system
+        :param dest_filename: The local copy of the target file
+        """
+        size = self._call("Stat", target_file, retry=True)[1]
+        if not size:
+            return
+
+        local_size = os.path.getsize(dest_filename)
+        if local_size != size:
+            raise IOError("Pulled {} is {} bytes, expected {}".format(
+                target_file, local_size, size))
+
+        md5 = hashlib.md5()
+        with open(dest_filename, "rb") as f:
+            for chunk in iter(lambda: f.read(self.hash_chunk_size), b""):
+                md5.update(chunk)
+
+        target_md5 = self.command("busybox md5sum " + target_file,
+                                  idempotent=True).split()
+        if target_md5 and target_md5[0] != md5.hexdigest():
+            raise IOError("Pulled {} does not match its MD5 sum".format(
+                target_file))
+
+
+class ADBConnectionPool:
+    """ Process wide pool of ADB connections, one per device serial. Establishing a connection requires the RSA
+    handshake as well as killing the media process, as such all device facing objects share the pooled
+    connection instead of creating their own. Connections that have been idle are health checked before being
+    handed out and are reconnected if they no longer respond.
+    """
+
+    connections = dict()
+    lock = threading.Lock()
+    # Connections inherited by a forked process belong to the parent and must not be used
+    pid = None
+    # Seconds a connection may be idle before it is health checked when next requested
+    health_check_interval = 5.0
+    # Serial of the device that connections are requested for when no serial is given, see EnergyDebugger --serial
+    default_serial = None
+
+    @classmethod
+    def get(cls, serial=None):
+        """ Returns the pooled connection to a device, connecting to it if required.
+
+        :param serial: Serial of the target device, see ADBInterface. The default serial is used if not given.
+        :return: A connected ADBInterface
+        """
+        if serial is None:
+            serial = cls.default_serial
+
+        with cls.lock:
+            if cls.pid != os.getpid():
+                cls.connections = dict()
+                cls.pid = os.getpid()
+
+            adb = cls.connections.get(serial)
+
+            if adb is None:
+                adb = ADBInterface(serial)
+                cls.connections[serial] = adb
+            elif (time.time() - adb.last_used > cls.health_check_interval
+                  and not adb.is_alive()):
+                print("ADB connection not responding, reconnecting")
+                adb.reconnect()
+
+            return adb
+
+    @classmethod
+    def close_all(cls):
+        """ Closes all pooled connections, such that the device can be used by the command line ADB server. The
+        interfaces may still be held by other objects, as such they are only closed and reconnect once they are
+        next used, see ADBInterface.close.
+        """
+        with cls.lock:
+            for adb in cls.connections.values():
+                adb.close()
+            cls.connections.clear()
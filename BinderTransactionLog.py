@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+"""
+Parses the binder transaction log, pulled from /d/binder/transaction_log alongside the trace, and joins it
+against the binder transaction events of the trace.
+
+Each line of the log records a transaction by its debug ID, the same ID that is given by the binder_transaction
+trace events, as well as the sending and receiving process and thread:
+
+12345: call  from 1234:1240 to 567:0 context binder node 1001 handle 3 size 64:0
+
+The log is indexed into numpy arrays sorted by debug ID, and into the process of each thread that it names. Both
+indices are cached next to the log. The join resolves the process of the threads of the trace's binder
+transactions, such that threads that are missing from the 'ps' snapshot, ie. those that were started and exited
+during tracing, are attributed to their process by PIDTool. The kernel only keeps the most recent transactions in
+the log, transactions that are no longer held are joined by thread instead.
+
+The destination thread is not resolved from the log, the kernel logs the same target thread that the trace
+reports.
+"""
+
+import os
+import re
+
+import numpy as np
+
+from SystemEvents import EventBinderTransaction
+
+__author__ = "Alex Hoffman"
+__copyright__ = "Copyright 2019, Alex Hoffman"
+__license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = "Alex Hoffman"
+__email__ = "alex.hoffman@tum.de"
+__status__ = "Beta"
+
+
+class BinderTransactionLog:
+    """ Index of the binder transaction log by transaction ID, and of the process that each thread in the log
+    belongs to.
+    """
+
+    line_re = re.compile(
+        r"^(\d+): (call|async|reply)\s+from (\d+):(\d+) to (\d+):(\d+)")
+    types = ["call", "async", "reply"]
+    fields = [
+        "debug_id", "type", "from_proc", "from_thread", "to_proc", "to_thread"
+    ]
+    thread_fields = ["threads", "thread_procs"]
+
+    def __init__(self, filename):
+        """
+        :param filename: The pulled transaction log, the index is cached as <filename>.npz
+        """
+        self.filename = filename
+        self.index_filename = filename + ".npz"
+
+        if (os.path.isfile(self.index_filename)
+                and os.path.getmtime(self.index_filename) >=
+                os.path.getmtime(self.filename)):
+            self._load_index()
+        else:
+            self._parse_log()
+            self._save_index()
+
+    def __len__(self):
+        return len(self.debug_id)
+
+    def _parse_log(self):
+        rows = []
+        with open(self.filename, "r") as f:
+            for line in f:
+                match = self.line_re.match(line)
+                if match:
+                    rows.append((int(match.group(1)),
+                                 self.types.index(match.group(2)),
+                                 int(match.group(3)), int(match.group(4)),
+                                 int(match.group(5)), int(match.group(6))))
+
+        table = np.array(rows, dtype=np.int64).reshape(-1, len(self.fields))
+        table = table[np.argsort(table[:, 0], kind="mergesort")]
+
+        for i, field in enumerate(self.fields):
+            setattr(self, field, table[:, i])
+
+        # Process of each thread, the most recent transaction that names a thread wins should its PID be reused
+        threads = np.concatenate((self.from_thread, self.to_thread))
+        procs = np.concatenate((self.from_proc, self.to_proc))
+        known = threads != 0
+        threads, procs = threads[known], procs[known]
+        order = np.lexsort((np.tile(np.arange(len(self)), 2)[known], threads))
+        threads, procs = threads[order], procs[order]
+        last = np.ones(len(threads), dtype=bool)
+        last[:-1] = threads[1:] != threads[:-1]
+        self.threads = threads[last]
+        self.thread_procs = procs[last]
+
+    def _load_index(self):
+        index = np.load(self.index_filename)
+        try:
+            for field in self.fields + self.thread_fields:
+                setattr(self, field, index[field])
+        finally:
+            index.close()
+
+    def _save_index(self):
+        try:
+            with open(self.index_filename, "wb") as f:
+                np.savez(f, **dict((field, getattr(self, field))
+                                   for field in self.fields +
+                                   self.thread_fields))
+        except IOError, e:
+            print("Binder log index could not be cached: %s" % e)
+
+    def join(self, events):
+        """ Resolves the process of the sending and receiving threads of the trace's binder transactions. The
+        transactions are joined by debug ID, those that are no longer held by the log by thread.
+
+        :param events: List of processed events
+        :return: Tuple of the dictionary of thread PID to process PID and the number of transactions joined by
+        debug ID
+        """
+        binder_events = [
+            event for event in events
+            if isinstance(event, EventBinderTransaction)
+        ]
+        if not len(self) or not binder_events:
+            return dict(), 0
+
+        ids = np.array([event.transaction for event in binder_events],
+                       dtype=np.int64)
+        senders = np.array([event.pid for event in binder_events],
+                           dtype=np.int64)
+        targets = np.array([event.target_pid for event in binder_events],
+                           dtype=np.int64)
+
+        rows = np.searchsorted(self.debug_id, ids)
+        rows[rows == len(self)] = 0
+        joined = ((self.debug_id[rows] == ids) &
+                  (self.from_thread[rows] == senders))
+        receivers = joined & (self.to_thread[rows] != 0)
+
+        threads = [senders[joined], self.to_thread[rows[receivers]]]
+        procs = [self.from_proc[rows[joined]], self.to_proc[rows[receivers]]]
+
+        # Threads of the remaining transactions
+        rest = np.unique(np.concatenate((senders[~joined], targets[~joined])))
+        thread_rows = np.searchsorted(self.threads, rest)
+        thread_rows[thread_rows == len(self.threads)] = 0
+        if len(self.threads):
+            found = self.threads[thread_rows] == rest
+            threads.append(rest[found])
+            procs.append(self.thread_procs[thread_rows[found]])
+
+        thread_processes = dict(
+            zip(np.concatenate(threads).tolist(),
+                np.concatenate(procs).tolist()))
+        return thread_processes, int(np.count_nonzero(joined))
@@ -16,14 +16,24 @@ from PyQt5.QtWidgets import *
 import AboutDialog
 import MainInterface
 import SettingsDialog
-from ADBInterface import ADBInterface
+from ADBInterface import ADBConnectionPool
+from BinderTransactionLog import BinderTransactionLog
 from GovernorControler import GovernorController
+from LiveProcessor import LiveProcessor
+from MemoryBudget import MemoryBudget
+from ParameterSweep import ParameterSweep, parse_grid
 from PIDTool import PIDTool
+from ProcessBranch import ProcessBranch
+from Profiler import Profiler
+from SessionProcessor import SessionProcessor
 from SysLoggerInterface import SysLogger
-from SystemMetrics import SystemMetrics
+from SystemMetrics import CPUUtilizationTable, SystemMetrics
+import TraceCMDParser
 from TraceCMDParser import TracecmdProcessor
-from TraceProcessor import TraceProcessor
+from TraceProcessor import TraceProcessor, parse_window
+from TraceReportParser import TraceReportProcessor, generate_report
 from Tracer import Tracer
+from TreeCheckpoint import TreeCheckpoint
 
 __author__ = "Alex Hoffman"
 __copyright__ = "Copyright 2019, Alex Hoffman"
@@ -65,10 +75,102 @@ parser.add_argument(
     help="Enables the drawing of the generated graph",
 )
 parser.add_argument(
-    "-te",
-    "--test",
+    "-w",
+    "--window",
+    required=False,
+    type=parse_window,
+    help="Only processes the window start:end, given in seconds from the start of the trace, to speed up "
+    "testing",
+)
+parser.add_argument(
+    "-r",
+    "--report",
+    action="store_true",
+    help="Parses the ASCII trace report instead of the binary .dat, used automatically if the tracecmd module "
+    "cannot be loaded",
+)
+parser.add_argument(
+    "-k",
+    "--checkpoint",
+    action="store_true",
+    help="Checkpoints the processed process tree to results/<app>.ckpt.npz",
+)
+parser.add_argument(
+    "-K",
+    "--from-checkpoint",
+    action="store_true",
+    help="Regenerates the results from the checkpoint of a previous run instead of tracing and processing",
+)
+parser.add_argument(
+    "-q",
+    "--quick",
+    action="store_true",
+    help="Only computes the per-thread energy totals and energy timeline, skipping the task graph and "
+    "optimizations",
+)
+parser.add_argument(
+    "--segmented",
+    action="store_true",
+    help="Records the trace in segments that are pulled as they complete, for traces longer than the trace "
+    "buffer can hold. The segments are processed as one session, see SessionProcessor",
+)
+parser.add_argument(
+    "--live",
+    required=False,
+    type=float,
+    help="Analyses the trace while it is being recorded, reporting the energy and optimizations of the given "
+    "number of most recent seconds, see LiveProcessor",
+)
+parser.add_argument(
+    "--live-file",
+    required=False,
+    help="Reads the live trace from a growing local file of trace_pipe output instead of the device",
+)
+parser.add_argument(
+    "--ps-file",
+    required=False,
+    help="Process table ('busybox ps -T' output) of the target system for --live-file, such that the target "
+    "system is not connected to. Defaults to results/<app>.ps, saved by each run that connects to the target",
+)
+parser.add_argument(
+    "--memory-budget",
+    required=False,
+    type=float,
+    help="Moves the per microsecond timelines to memory mapped scratch files under results/ once the process "
+    "uses more than the given number of MB, see MemoryBudget",
+)
+parser.add_argument(
+    "--profile",
     action="store_true",
-    help="Tests only a few hundred events to speed up testing",
+    help="Writes the time and memory of each processing phase and the per event type handling times to "
+    "results/<app>_profile.json, see Profiler",
+)
+parser.add_argument(
+    "--retention",
+    required=False,
+    type=float,
+    help="Retires the tasks of each thread that finished more than the given number of seconds before its "
+    "latest task, keeping only their aggregates in memory, see ProcessBranch.retention_horizon_us",
+)
+parser.add_argument(
+    "--spill",
+    action="store_true",
+    help="Spills retired tasks to results/spill/ such that they are still evaluated by the optimizer",
+)
+parser.add_argument(
+    "-j",
+    "--shards",
+    required=False,
+    type=int,
+    help="Handles the trace's events in time shards across the given number of processes, see ShardProcessor",
+)
+parser.add_argument(
+    "--sweep",
+    required=False,
+    type=parse_grid,
+    help="Evaluates a grid of optimizer, utilization window and timeline parameters over the checkpoint of a "
+    "previous run, given "
+    "as name=value,value;... see ParameterSweep",
 )
 parser.add_argument(
     "-sub",
@@ -76,6 +178,12 @@ parser.add_argument(
     action="store_true",
     help="Enable the drawing of node subgraphs",
 )
+parser.add_argument(
+    "--serial",
+    required=False,
+    help="Serial of the target device, either a USB serial or host:port for a TCP connection, over which the "
+    "trace results are pulled concurrently. The first USB device found is used if not given.",
+)
 parser.add_argument(
     "-p",
     "--preamble",
@@ -172,7 +280,7 @@ class SettingsMenu(QDialog, SettingsDialog.Ui_DialogSettings):
         else:
             pull_location = self.lineEditSyslogPullFolder.text() + "/trace.dat"
         try:
-            adb = ADBInterface()
+            adb = ADBConnectionPool.get()
             adb.pull_file("/data/local/tmp/trace.dat", pull_location)
         except Exception, e:
             QMessageBox.critical(
@@ -757,6 +865,8 @@ class MainInterface(QMainWindow, MainInterface.Ui_MainWindow):
                     # main program's process
                     sys.stdout = sys.__stdout__
                     sys.stderr = sys.__stderr__
+                    # A USB device can only be claimed by one process at a time
+                    ADBConnectionPool.close_all()
                     proc = multiprocessing.Process(
                         target=buttonrunprocess,
                         args=(
@@ -831,7 +941,8 @@ def buttonrunprocess(
                                           skip_tracing=skip_tracing,
                                           progress_signal=progress_signal,
                                           results_subdir=subdir,
-                                          pid=pid)
+                                          pid=pid,
+                                          window=args.window)
         current_debugger.run()
         if open_func is not None:
             open_func(subdir)
@@ -912,8 +1023,8 @@ class EnergyDebugger:
                  skip_tracing,
                  progress_signal,
                  results_subdir,
-                 pid=None):
-        self.adb = ADBInterface()
+                 pid=None,
+                 window=None):
         self.application = application
         self.governor = governor
         self.duration = duration
@@ -927,13 +1038,31 @@ class EnergyDebugger:
         self.progress_signal = progress_signal
         self.results_subdir = results_subdir
         self.pid = pid
+        self.window = window
         """ Required objects for tracking system metrics and interfacing with a target system, connected
-        via an ADB connection.
+        via an ADB connection. Runs that do not trace are offline where possible, see _get_offline_context.
         """
 
+        offline_context = self._get_offline_context()
+        self.adb = None if offline_context else ADBConnectionPool.get(
+            args.serial)
+
         start_time = time.time()
         try:
-            self.pid_tool = PIDTool(self.adb, self.application, self.pid)
+            if offline_context:
+                ps_output, pid, thread_names, initial_metrics = offline_context
+                self.pid_tool = PIDTool(None,
+                                        self.application,
+                                        pid,
+                                        ps_output=ps_output)
+                self.pid_tool.thread_names.update(thread_names)
+            else:
+                self.pid_tool = PIDTool(self.adb, self.application, self.pid)
+                initial_metrics = None
+                try:
+                    self.pid_tool.save_table(self._get_results_path(".ps"))
+                except IOError, e:
+                    print("Saving process table failed, %s" % e)
         except Exception, e:
             raise Exception("Trace failed: {}".format(e))
         print("PIDs gathered --- %s Sec" % (time.time() - start_time))
@@ -942,7 +1071,7 @@ class EnergyDebugger:
         print("Trace processor created --- %s Sec" %
               (time.time() - start_time))
         start_time = time.time()
-        self.sys_metrics = SystemMetrics(self.adb)
+        self.sys_metrics = SystemMetrics(self.adb, initial_metrics)
         print("System metrics initialized --- %s Sec" %
               (time.time() - start_time))
         """ The tracer object stores the configuration for the ftrace trace that is to be performed on the
@@ -959,7 +1088,7 @@ class EnergyDebugger:
         )
         print("Tracer created --- %s Sec" % (time.time() - start_time))
 
-        if self.duration > 6:
+        if self.duration > 6 and not (args.segmented or args.live):
             print "WARNING: Running traces over 6 seconds can cause issue due to data loss from trace buffer size " "limitations"
             QMessageBox.warning(
                 self,
@@ -984,23 +1113,161 @@ class EnergyDebugger:
         # TODO
         pass
 
+    def _get_results_path(self, suffix):
+        return os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                            "results/" + self.application + suffix)
+
+    def _read_binder_log(self):
+        """ Reads the binder transaction log pulled after tracing, if there is one.
+        """
+        tlog_path = self._get_results_path(".tlog")
+        if os.path.isfile(tlog_path):
+            try:
+                return BinderTransactionLog(tlog_path)
+            except Exception, e:
+                print("Reading binder log failed, %s" % e)
+        return None
+
+    def _get_offline_context(self):
+        """ Runs that regenerate results from a checkpoint, and live analyses of a local file for which a
+        process table is available, do not require the target system. The process table and initial metrics are
+        then read from the checkpoint or the process table file instead of the target.
+
+        :return: Tuple of the 'busybox ps -T' output, application PID, dictionary of thread names and initial
+        metrics, see TreeCheckpoint.load_context, or None if the target system is required
+        """
+        if args.from_checkpoint or args.sweep:
+            return TreeCheckpoint.load_context(
+                self._get_results_path(".ckpt.npz"))
+
+        if args.live and args.live_file:
+            ps_path = args.ps_file or self._get_results_path(".ps")
+            if os.path.isfile(ps_path):
+                with open(ps_path, "r") as f:
+                    return f.read(), self.pid, dict(), None
+            print("No process table found at %s, capturing it from the target"
+                  % ps_path)
+
+        return None
+
     def run(self):
         """ Entry point into the debugging tool.
         """
+        budget = None
+        if args.memory_budget is not None:
+            budget = MemoryBudget(
+                args.memory_budget,
+                os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             "results/"))
+        profiler = Profiler(self.application) if args.profile else None
+        try:
+            self._run()
+        finally:
+            if profiler is not None:
+                self._write_profile(profiler)
+            if budget is not None:
+                budget.cleanup()
+
+    def _write_profile(self, profiler):
+        file_folder = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                   "results/")
+        if self.results_subdir:
+            file_folder += self.results_subdir
+        if not os.path.exists(file_folder):
+            os.makedirs(file_folder)
+        filename = file_folder + self.application + "_profile.json"
+        profiler.write(filename)
+        print("Profile written to %s" % filename)
+
+    def _run(self):
         """ As the energy debugger depends on the custom trace points implemented in the syslogger module,
         it must be loaded before tracing begins. It must then be unloaded and finished before the results
         are pulled from the target system.
         """
         start_time = time.time()
 
+        if args.retention is not None:
+            ProcessBranch.retention_horizon_us = int(args.retention * 1000000)
+            if args.spill:
+                ProcessBranch.spill_dir = os.path.join(
+                    os.path.dirname(os.path.realpath(__file__)),
+                    "results/spill/")
+
+        # Checkpoints keep the idle states such that the utilization window can be swept
+        CPUUtilizationTable.record_states = args.checkpoint
+
+        checkpoint_path = self._get_results_path(".ckpt.npz")
+        if args.sweep:
+            ParameterSweep(self.trace_processor, self.sys_metrics,
+                           checkpoint_path, self.governor,
+                           self.results_subdir).run(args.sweep)
+            print "Run took a total of %s seconds to run" % (time.time() -
+                                                             start_time)
+            return
+
+        if args.from_checkpoint:
+            self.trace_processor.process_checkpoint(
+                governor=self.governor,
+                metrics=self.sys_metrics,
+                checkpoint=checkpoint_path,
+                draw=self.graph,
+                subdir=self.results_subdir,
+            )
+            print "Run took a total of %s seconds to run" % (time.time() -
+                                                             start_time)
+            return
+
+        if args.live:
+            live_processor = LiveProcessor(self.trace_processor,
+                                           self.sys_metrics, args.live)
+            if args.live_file:
+                live_processor.process(
+                    LiveProcessor.follow_file(args.live_file),
+                    subdir=self.results_subdir)
+            else:
+                self.sys_logger.start()
+                try:
+                    live_processor.process(
+                        self.tracer.stream_trace(args.skip_clear),
+                        subdir=self.results_subdir)
+                finally:
+                    self.sys_logger.stop()
+            print "Run took a total of %s seconds to run" % (time.time() -
+                                                             start_time)
+            return
+
         if not self.skip_tracing:
+            Profiler.begin("trace")
             self.sys_logger.start()
-            self.tracer.run_tracer(self.preamble, args.skip_clear)
+            self.tracer.run_tracer(self.preamble, args.skip_clear,
+                                   segmented=args.segmented)
             self.sys_logger.stop()
             try:
-                self.tracer.get_trace_results()
+                self.tracer.get_trace_results(segmented=args.segmented)
             except Exception, e:
                 print("Getting trace results failed, %s" % e)
+            Profiler.end("trace")
+
+        if args.segmented:
+            try:
+                segments = Tracer.read_segment_manifest(
+                    self.tracer.segment_manifest)
+            except IOError, e:
+                print("Reading segment manifest failed, %s" % e)
+                return
+            SessionProcessor(self.trace_processor, self.sys_metrics,
+                             report=args.report).process(
+                                 segments,
+                                 governor=self.governor,
+                                 preamble=self.preamble,
+                                 progress_signal=self.progress_signal,
+                                 draw=self.graph,
+                                 subgraph=self.subgraph,
+                                 subdir=self.results_subdir,
+                                 binder_log=self._read_binder_log())
+            print "Run took a total of %s seconds to run" % (time.time() -
+                                                             start_time)
+            return
         """ The tracecmd data pulled (.dat suffix) is then iterated through and the trace events are systematically
         processed. Results are generated into a CSV file, saved to the working directory under the same name as the 
         target
@@ -1008,15 +1275,27 @@ class EnergyDebugger:
         """
 
         print "Creating trace processor"
+        Profiler.begin("parse_trace")
         try:
             dat_path = os.path.join(
                 os.path.dirname(os.path.realpath(__file__)),
                 "results/" + self.application + ".dat",
             )
-            self.tc_processor = TracecmdProcessor(dat_path, self.preamble)
+            if args.report or TraceCMDParser.Trace is None:
+                report_path = os.path.join(
+                    os.path.dirname(os.path.realpath(__file__)),
+                    "results/" + self.application + ".report",
+                )
+                if not os.path.isfile(report_path):
+                    generate_report(dat_path, report_path)
+                self.tc_processor = TraceReportProcessor(
+                    report_path, self.preamble)
+            else:
+                self.tc_processor = TracecmdProcessor(dat_path, self.preamble)
             self.tc_processor.print_event_count()
         except Exception, e:
             print("Creating trace processor failed, %s" % e)
+        Profiler.end("parse_trace")
 
         try:
             self.trace_processor.process_trace(
@@ -1029,6 +1308,11 @@ class EnergyDebugger:
                 test=self.event_count,
                 subgraph=self.subgraph,
                 subdir=self.results_subdir,
+                window=self.window,
+                binder_log=self._read_binder_log(),
+                checkpoint=checkpoint_path if args.checkpoint else None,
+                quick=args.quick,
+                shards=args.shards,
             )
         except Exception, e:
             raise Exception(e)
@@ -1038,6 +1322,9 @@ class EnergyDebugger:
 
 
 if __name__ == "__main__":
+    # Device facing objects request their connections from the pool without a serial
+    ADBConnectionPool.default_serial = args.serial
+
     if not args.commandline:
         app = QApplication(sys.argv)
         interface = MainInterface()
@@ -11,7 +11,7 @@ __maintainer__ = "Alex Hoffman"
 __email__ = "alex.hoffman@tum.de"
 __status__ = "Beta"
 
-from ADBInterface import ADBInterface
+from ADBInterface import ADBConnectionPool
 
 
 class GovernorController:
@@ -20,89 +20,82 @@ class GovernorController:
     big_name = "cpu"
 
     def get_governors(self):
-        adb = ADBInterface()
+        adb = ADBConnectionPool.get()
         return adb.command(
-            "cat /sys/devices/system/cpu/cpu0/cpufreq/scaling_available_governors"
-        ).split()
+            "cat /sys/devices/system/cpu/cpu0/cpufreq/scaling_available_governors",
+            idempotent=True).split()
 
     def get_current_governor(self):
-        governors = ["",""]
-        adb = ADBInterface()
+        batch = ADBConnectionPool.get().batch()
+        batch.read_file("/sys/devices/system/cpu/cpu0/cpufreq/scaling_governor")
+        batch.read_file("/sys/devices/system/cpu/cpu4/cpufreq/scaling_governor")
 
-        governors[0] = adb.command(
-            "cat /sys/devices/system/cpu/cpu0/cpufreq/scaling_governor").split(
-            )[0]
-        governors[1] = adb.command(
-                "cat /sys/devices/system/cpu/cpu4/cpufreq/scaling_governor").split(
-                )[0]
-        return governors
+        return [output.split()[0] for output in batch.run()]
 
     def set_big_online(self, state):
-        adb = ADBInterface()
+        batch = ADBConnectionPool.get().batch()
 
-        if state:
-            for i in range(4):
-                adb.command("echo 1 > /sys/devices/system/cpu/cpu{}/online 2> /dev/null".format(i))
-        else:
-            for i in range(4):
-                adb.command("echo 0 > /sys/devices/system/cpu/cpu{}/online 2> /dev/null".format(i))
+        for i in range(4):
+            batch.command("echo {} > /sys/devices/system/cpu/cpu{}/online 2> /dev/null".format(
+                1 if state else 0, i), idempotent=True)
+
+        batch.run()
 
     def set_hotplug_online(self, state):
 
-        adb = ADBInterface()
+        adb = ADBConnectionPool.get()
 
         if state:
-            adb.command("echo 1 > /sys/power/enable_dm_hotplug")
+            adb.write_file("/sys/power/enable_dm_hotplug", "1")
         else:
-            adb.command("echo 0 > /sys/power/enable_dm_hotplug")
+            adb.write_file("/sys/power/enable_dm_hotplug", "0")
 
     def set_governor(self, governor):
         self.set_big_online(True)
         self.set_hotplug_online(False)
 
-        adb = ADBInterface()
-
-        adb.command(
-            "echo {} > /sys/devices/system/cpu/cpu0/cpufreq/scaling_governor".
-            format(governor))
-        adb.command(
-                "echo {} > /sys/devices/system/cpu/cpu4/cpufreq/scaling_governor".
-                    format(governor))
+        batch = ADBConnectionPool.get().batch()
+        batch.write_file("/sys/devices/system/cpu/cpu0/cpufreq/scaling_governor",
+                         governor)
+        batch.write_file("/sys/devices/system/cpu/cpu4/cpufreq/scaling_governor",
+                         governor)
+        batch.run()
 
     def get_min_freq(self, cpu):
-        adb = ADBInterface()
+        adb = ADBConnectionPool.get()
 
         return adb.command(
             "cat /sys/devices/system/cpu/cpu{}/cpufreq/scaling_min_freq".
-            format(cpu)).split()[0]
+            format(cpu), idempotent=True).split()[0]
 
     def get_max_freq(self, cpu):
-        adb = ADBInterface()
+        adb = ADBConnectionPool.get()
 
         return adb.command(
             "cat /sys/devices/system/cpu/cpu{}/cpufreq/scaling_max_freq".
-            format(cpu)).split()[0]
+            format(cpu), idempotent=True).split()[0]
 
     def set_min_freq(self, cpu, freq):
-        adb = ADBInterface()
+        adb = ADBConnectionPool.get()
 
         adb.command(
             "echo {} > /sys/devices/system/cpu/cpu{}/cpufreq/scaling_min_freq".
-            format(freq, cpu))
+            format(freq, cpu), idempotent=True)
 
     def set_max_freq(self, cpu, freq):
-        adb = ADBInterface()
+        adb = ADBConnectionPool.get()
 
         adb.command(
             "echo {} > /sys/devices/system/cpu/cpu{}/cpufreq/scaling_max_freq".
-            format(freq, cpu))
+            format(freq, cpu), idempotent=True)
 
     def reset_cpu_frequencies(self, cpu):
-        adb = ADBInterface()
+        adb = ADBConnectionPool.get()
 
         table_path = "/sys/devices/system/cpu/cpufreq/mp-cpufreq/{}_freq_table".format(
             self.little_name if cpu <= 3 else self.big_name)
-        freqs = adb.command("cat {}".format(table_path)).split()
+        freqs = adb.command("cat {}".format(table_path),
+                            idempotent=True).split()
         min_freq = freqs[-1]
         max_freq = freqs[0]
 
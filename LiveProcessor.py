@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+"""
+Live analysis of a trace as it is being recorded. The events are read incrementally, either streamed from the
+device's trace_pipe (see Tracer.stream_trace) or from a growing local file as a stand-in, and are handled by a
+single process tree as in a session of segments (see SessionProcessor). Each update handles the events read
+since the previous update as the next segment of the session, roughly every update_interval seconds.
+
+After each update the energy and the optimizations of the tasks that finished within the last window seconds
+are summed per process. Tasks are evaluated by the optimizer once the next task of their branch has started,
+such that their dependent task is known. The tasks, buckets and metric histories before the window are then
+dropped, see ProcessTree.discard_before and SystemMetrics.discard_history, such that the memory held remains
+bounded by the window however long the analysis runs. As such no complete results are written, instead the
+summary of each update is appended to results/<subdir><app>_live.csv.
+"""
+
+import csv
+import os
+import time
+
+from ProcessBranch import ProcessBranch
+from SessionProcessor import SessionProcessor
+from TraceReportParser import parse_lines
+
+__author__ = "Alex Hoffman"
+__copyright__ = "Copyright 2019, Alex Hoffman"
+__license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = "Alex Hoffman"
+__email__ = "alex.hoffman@tum.de"
+__status__ = "Beta"
+
+
+class LiveWindow:
+    """ Summary of the last window of a live analysis.
+
+    Attributes:
+        start           Absolute time of the start of the window
+        finish          Absolute time of the last event handled
+        processes       Dictionary of process name to [energy, DVFS count, reallocation count]
+        gpu_energy      Energy (in joules) of the GPU within the window
+        total_energy    Energy (in joules) of the processes and the GPU within the window
+    """
+    def __init__(self, start, finish):
+        self.start = start
+        self.finish = finish
+        self.processes = dict()
+        self.gpu_energy = 0.0
+        self.total_energy = 0.0
+
+
+class LiveProcessor:
+    """ Rolling per-process energy and optimization counts of a trace that is being recorded, see module
+    docstring.
+    """
+
+    # Seconds, of either wall time or trace time, between updates
+    update_interval = 1.0
+    # Seconds between reads of a growing local file
+    poll_interval = 0.2
+    # Number of processes printed with each update
+    top_processes = 5
+
+    def __init__(self, trace_processor, metrics, window, update_signal=None):
+        """
+        :param trace_processor: TraceProcessor of the traced application
+        :param metrics: SystemMetrics of the target system
+        :param window: Seconds over which the energy and optimizations are summed
+        :param update_signal: Optional signal that is emitted with the LiveWindow of each update
+        """
+        self.trace_processor = trace_processor
+        self.metrics = metrics
+        self.window_us = int(window * 1000000)
+        self.update_signal = update_signal
+        self.session = SessionProcessor(trace_processor, metrics)
+        # ID of the last task of each branch that has been evaluated by the optimizer
+        self.evaluated = dict()
+
+    @staticmethod
+    def follow_file(filename, idle_timeout=5.0):
+        """ Yields the text appended to a growing file, eg. a trace_pipe that is redirected into a local file.
+        Empty strings are yielded while the file is not growing, such that updates are not held back.
+
+        :param filename: File that is being written to
+        :param idle_timeout: Seconds that the file may not grow for before it is considered complete
+        """
+        with open(filename, "r") as f:
+            last_read = time.time()
+            while True:
+                text = f.read()
+                if text:
+                    last_read = time.time()
+                    yield text
+                elif time.time() - last_read > idle_timeout:
+                    return
+                else:
+                    yield ""
+                    time.sleep(LiveProcessor.poll_interval)
+
+    def process(self, stream, subdir=None):
+        """ Handles the stream until it ends or the analysis is interrupted.
+
+        :param stream: Iterable of the streamed text, in arbitrary chunks of report formatted lines
+        :param subdir: Sub directory to store results in
+        """
+        file_folder = "results/"
+        if subdir:
+            file_folder += subdir
+        if not os.path.exists(file_folder):
+            os.makedirs(file_folder)
+
+        self.session.start()
+        self.evaluated = dict()
+
+        with open(file_folder + self.trace_processor.filename + "_live.csv",
+                  "w+") as f:
+            writer = csv.writer(f, delimiter=",")
+            writer.writerow([
+                "Start", "Finish", "Process Energy", "GPU Energy",
+                "Total Energy", "DVFS", "Reallocations", "Top Process"
+            ])
+
+            partial = ""
+            pending = ([], [], [], [])
+            last_update = time.time()
+            try:
+                for text in stream:
+                    lines = (partial + text).split("\n")
+                    partial = lines.pop()  # Incomplete until its newline is read
+                    if lines:
+                        (processed, temps, idles, counts, markers,
+                         threads) = parse_lines(lines)
+                        for events, parsed in zip(
+                                pending, (processed, temps, idles, threads)):
+                            events.extend(parsed)
+
+                    if (time.time() - last_update >= self.update_interval
+                            or self._get_span(pending[0]) >=
+                            self.update_interval):
+                        last_update = time.time()
+                        if self._update(pending, writer):
+                            f.flush()
+                            pending = ([], [], [], [])
+            except KeyboardInterrupt:
+                print("Live analysis interrupted")
+
+            self._update(pending, writer)
+
+    @staticmethod
+    def _get_span(events):
+        if not events:
+            return 0
+        return (events[-1].time - events[0].time) * 0.000001
+
+    def _update(self, pending, writer):
+        """ Handles the pending events as the next segment of the session and summarizes the window.
+
+        :return: False if the events are held back until the next update, as the session can only start once
+        a temperature event has been read
+        """
+        events, temps, idles, threads = pending
+        if not events or (self.session.last_temp_event is None
+                          and not temps):
+            return False
+
+        self.session.add_segment(events, temps, idles, threads)
+        process_tree = self.session.process_tree
+        self._evaluate_tasks(process_tree)
+
+        finish = self.session.session_finish
+        start = max(finish - self.window_us, self.session.session_start)
+        window = self._get_window(process_tree, start, finish)
+
+        process_tree.discard_before(start)
+        self.metrics.discard_history(start)
+
+        self._report(window, writer)
+        return True
+
+    def _evaluate_tasks(self, process_tree):
+        """ Runs the optimizer over the tasks that have finished and whose branch has started its next task
+        since the last update.
+        """
+        optimizations_found = [0, 0, 0, 0]
+        for branch in process_tree.process_branches.itervalues():
+            last_evaluated = self.evaluated.get(branch.pid, -1)
+            for task in branch.tasks[:-1]:
+                if task.id <= last_evaluated:
+                    continue
+                process_tree.find_task_optimizations(task,
+                                                     optimizations_found)
+                self.evaluated[branch.pid] = task.id
+
+    def _get_window(self, process_tree, start, finish):
+        window = LiveWindow(start, finish)
+
+        interval_us = ProcessBranch.timeline_interval_us
+        first_bucket = start // interval_us
+        for branch in process_tree.process_branches.itervalues():
+            stats = window.processes.setdefault(branch.pname, [0.0, 0, 0])
+            for bucket, energy in branch.interval_energy.iteritems():
+                if bucket >= first_bucket:
+                    stats[0] += energy[0] + energy[1]
+
+            for task in branch.tasks:
+                if start <= task.finish_time <= finish:
+                    if task.optimization_info.dvfs_possible():
+                        stats[1] += 1
+                    if task.optimization_info.realloc_possible():
+                        stats[2] += 1
+
+        for name in [
+                name for name, stats in window.processes.iteritems()
+                if stats == [0.0, 0, 0]
+        ]:
+            del window.processes[name]
+
+        window.gpu_energy = self.metrics.sys_util_history.gpu.get_energy(
+            start, finish)
+        window.total_energy = window.gpu_energy + sum(
+            stats[0] for stats in window.processes.itervalues())
+
+        return window
+
+    def _report(self, window, writer):
+        processes = sorted(window.processes.iteritems(),
+                           key=lambda item: item[1][0],
+                           reverse=True)
+        process_energy = window.total_energy - window.gpu_energy
+        dvfs = sum(stats[1] for stats in window.processes.itervalues())
+        reallocations = sum(stats[2]
+                            for stats in window.processes.itervalues())
+
+        writer.writerow([
+            window.start / 1000000.0, window.finish / 1000000.0,
+            process_energy, window.gpu_energy, window.total_energy, dvfs,
+            reallocations, processes[0][0] if processes else ""
+        ])
+
+        print("** Last %.1f seconds: %.4f J (GPU %.4f J), DVFS %d, "
+              "reallocations %d **" %
+              ((window.finish - window.start) * 0.000001, window.total_energy,
+               window.gpu_energy, dvfs, reallocations))
+        for name, stats in processes[:self.top_processes]:
+            print("   %s: %.4f J, DVFS %d, reallocations %d" %
+                  (name, stats[0], stats[1], stats[2]))
+
+        if self.update_signal:
+            self.update_signal.emit(window)
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+"""
+Memory budget of the processing, for traces whose per microsecond timelines would otherwise not fit into RAM.
+
+Once the resident memory of the process exceeds the budget, the timelines that are created or grown from then
+on are backed by memory mapped files in a scratch directory instead of RAM:
+- the utilization arrays of the cores, see CPUUtilizationTable.add_idle_event
+- the temperature timeline, which is held as the indices of the measurements, see IndexedTimeline
+- the energy prefix sums of the clusters, see ClusterEnergyTimeline
+
+The page cache holds the parts of the files that are in use, such that processing continues more slowly rather
+than the host running out of memory. All lookups into the timelines are binary searches or reads of nearby
+indices. The event lists themselves remain in memory, as they are lists of event objects.
+"""
+
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+__author__ = "Alex Hoffman"
+__copyright__ = "Copyright 2019, Alex Hoffman"
+__license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = "Alex Hoffman"
+__email__ = "alex.hoffman@tum.de"
+__status__ = "Beta"
+
+
+class ScratchArray:
+    """ A growable one dimensional array backed by a memory mapped file. The capacity of the file doubles as it
+    fills, such that values are appended in place and the file is only remapped when it grows.
+    """
+
+    initial_capacity = 1 << 20
+
+    def __init__(self, filename, values):
+        """
+        :param filename: Scratch file, which is overwritten
+        :param values: Initial values of the array, which also set its type
+        """
+        self.filename = filename
+        self.dtype = values.dtype
+        self.length = 0
+        self.data = None
+        self._resize(max(len(values), self.initial_capacity))
+        self.append(values)
+
+    def _resize(self, capacity):
+        if self.data is not None:
+            self.data.flush()
+        with open(self.filename, "a+b") as f:
+            f.truncate(capacity * self.dtype.itemsize)
+        self.data = np.memmap(self.filename,
+                              dtype=self.dtype,
+                              mode="r+",
+                              shape=(capacity, ))
+
+    def append(self, values):
+        """ Appends values to the array.
+
+        :return: The array's values, as a view of the mapped file
+        """
+        length = self.length + len(values)
+        if length > len(self.data):
+            self._resize(max(len(self.data) * 2, length))
+        self.data[self.length:length] = values
+        self.length = length
+        return self.view()
+
+    def view(self):
+        return self.data[:self.length]
+
+
+class IndexedTimeline:
+    """ Stand-in for a per microsecond object array whose values repeat, such as the temperature timeline. The
+    distinct values are held in memory and the index of the value of each microsecond in a ScratchArray. It is
+    indexed, by integers or index arrays, as the object array would be.
+    """
+    def __init__(self, values, indices):
+        self.values = np.empty(len(values), dtype=object)
+        self.values[:] = values
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, key):
+        return self.values[self.indices[key]]
+
+
+class MemoryBudget:
+    """ Decides when timelines are moved to scratch files and owns those files, see module docstring.
+    """
+
+    # The budget in use, if any
+    current = None
+    # Seconds between reads of the resident memory of the process
+    check_interval = 0.5
+
+    def __init__(self, budget_mb, directory):
+        """
+        :param budget_mb: Resident memory (in MB) above which timelines are moved to scratch files
+        :param directory: Directory in which the scratch directory of the budget is created
+        """
+        self.budget = int(budget_mb * 1024 * 1024)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.scratch_dir = tempfile.mkdtemp(prefix="scratch_", dir=directory)
+        self.last_check = 0
+        self.over_budget = False
+        self.reported = False
+
+        MemoryBudget.current = self
+
+    @staticmethod
+    def get_resident_memory():
+        """ Returns the resident memory (in bytes) of the process.
+        """
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+    def exceeded(self):
+        """ Checks whether the process exceeds the budget, the resident memory being read at most every
+        check_interval seconds.
+        """
+        if time.time() - self.last_check >= self.check_interval:
+            self.last_check = time.time()
+            self.over_budget = self.get_resident_memory() > self.budget
+            if self.over_budget and not self.reported:
+                print("Memory budget exceeded, moving timelines to %s" %
+                      self.scratch_dir)
+                self.reported = True
+        return self.over_budget
+
+    def _create_file(self, name):
+        fd, filename = tempfile.mkstemp(prefix=name + "_",
+                                        dir=self.scratch_dir)
+        os.close(fd)
+        return filename
+
+    def scratch_array(self, name, values):
+        """ Moves a growable array to a scratch file, see ScratchArray.
+        """
+        return ScratchArray(self._create_file(name), values)
+
+    def to_memmap(self, name, values):
+        """ Moves an array to a read only scratch file.
+
+        :return: The memory mapped array
+        """
+        if not values.size:  # Empty files cannot be mapped
+            return values
+        filename = self._create_file(name)
+        values.tofile(filename)
+        return np.memmap(filename,
+                         dtype=values.dtype,
+                         mode="r",
+                         shape=values.shape)
+
+    def indexed_timeline(self, name, values, durations):
+        """ Builds an IndexedTimeline in which each value is repeated for its duration.
+
+        :param values: List of the distinct values, in order
+        :param durations: Number of microseconds of each value
+        """
+        indices = None
+        for i, duration in enumerate(durations):
+            repeated = np.full(duration, i, dtype=np.int32)
+            if indices is None:
+                indices = self.scratch_array(name, repeated)
+            else:
+                indices.append(repeated)
+        return IndexedTimeline(values, indices.view())
+
+    def cleanup(self):
+        """ Removes the scratch files. The arrays backed by them must not be used afterwards.
+        """
+        shutil.rmtree(self.scratch_dir, ignore_errors=True)
+        if MemoryBudget.current is self:
+            MemoryBudget.current = None
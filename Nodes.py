@@ -11,8 +11,7 @@ __status__ = "Beta"
 from SystemMetrics import SystemMetrics
 from Dependencies import Dependency
 from Optimizations import OptimizationInfo
-from SystemEvents import EventSchedSwitch, FreqPowerEvent
-from XU3EnergyProfile import XU3RegressionModel
+from SystemEvents import EventSchedSwitch
 
 task_ID = 0
 
@@ -28,11 +27,10 @@ class TaskNode:
     event is then known to be the sleep event and can then be processed accordingly.
     As such task processing must have a lead of one job.
 
-    Calculating task cycles works on incremental summing. If the CPU on which the process is
-    running or the GPU changes or the frequency changes then the variable is updated and
-    the calc time shifted to the point of the event. As such the calc time stores the time since
-    the exec time was last changed, and given that the CPU and frequency have been fixed during
-    that time, the cycles is easily updated using a += and the current values (before updating them)
+    Calculating task cycles and energy works on incremental summing. The calc time stores the time
+    until which the task's cycles and energy have been summed, when the task is switched out the
+    cycles and energy since the calc time are looked up from the energy timeline of the cluster on
+    which it ran, see ClusterEnergyTimeline, and the calc time is shifted to the switch out.
     """
     def __init__(self, graph, pid, name):
         global task_ID
@@ -40,7 +38,6 @@ class TaskNode:
         self.id = task_ID
         task_ID += 1
         self.events = []
-        self.sys_metric_change_events = []
         self.cpu_cycles = 0
         self.gpu_cycles = 0
         self.start_time = 0
@@ -78,122 +75,8 @@ class TaskNode:
                 if self.calc_time is 0:
                     self.calc_time = event.time
 
-                if (self.sys_metric_change_events
-                    ):  # Handle event that will change energy consumption
-
-                    for x, pe in enumerate(self.sys_metric_change_events):
-
-                        if pe.time < self.events[-1].time:
-                            continue
-                        # calc time is the point until which the energy has been calculated
-                        new_cycles = int((pe.time - self.calc_time) *
-                                         0.000001 * pe.cpu_frequency)
-
-                        self.util = [
-                            SystemMetrics.current_metrics.sys_util_history.cpu[
-                                (pe.cpu / 4) * 4 + 0].get_util(pe.time)
-                        ]
-                        self.util.append(
-                            SystemMetrics.current_metrics.sys_util_history.cpu[
-                                (pe.cpu / 4) * 4 + 1].get_util(pe.time))
-                        self.util.append(
-                            SystemMetrics.current_metrics.sys_util_history.cpu[
-                                (pe.cpu / 4) * 4 + 2].get_util(pe.time))
-                        self.util.append(
-                            SystemMetrics.current_metrics.sys_util_history.cpu[
-                                (pe.cpu / 4) * 4 + 3].get_util(pe.time))
-
-                        self.temp = [
-                            SystemMetrics.current_metrics.get_temp(
-                                pe.time, (pe.cpu / 4) * 4 + 0)
-                        ]
-                        self.temp.append(
-                            SystemMetrics.current_metrics.get_temp(
-                                pe.time, (pe.cpu / 4) * 4 + 1))
-                        self.temp.append(
-                            SystemMetrics.current_metrics.get_temp(
-                                pe.time, (pe.cpu / 4) * 4 + 2))
-                        self.temp.append(
-                            SystemMetrics.current_metrics.get_temp(
-                                pe.time, (pe.cpu / 4) * 4 + 3))
-
-                        cycle_energy = XU3RegressionModel.get_cpu_per_second_energy(
-                            pe.cpu, pe.cpu_frequency, self.util, self.temp)
-                        cycle_energy = [
-                            component / pe.cpu_frequency
-                            for component in cycle_energy
-                        ]
-
-                        self.cpu_cycles += new_cycles
-                        new_energy = [
-                            component * new_cycles
-                            for component in cycle_energy
-                        ]
-                        new_summed_energy = [
-                            self.energy[i] + new_energy[i]
-                            for i in range(len(new_energy))
-                        ]
-                        self.energy = new_summed_energy
-                        self.duration += pe.time - self.calc_time
-                        self.calc_time = pe.time
-
-                    del self.sys_metric_change_events[:]  # Remove after processing
-
-                if (event.time != self.calc_time
-                    ):  # Calculate remainder of energy consumption
-
-                    cpu_speed = SystemMetrics.current_metrics.get_cpu_core_freq(
-                        event.cpu)
-
-                    if cpu_speed:  ## TODO error here with GameGovernorx
-                        new_cycles = int(
-                            (event.time - self.calc_time) * 0.000001 * cpu_speed)
-
-                        self.util = [
-                            SystemMetrics.current_metrics.sys_util_history.cpu[
-                                (event.cpu / 4) * 4 + 0].get_util(event.time)
-                        ]
-                        self.util.append(
-                            SystemMetrics.current_metrics.sys_util_history.cpu[
-                                (event.cpu / 4) * 4 + 1].get_util(event.time))
-                        self.util.append(
-                            SystemMetrics.current_metrics.sys_util_history.cpu[
-                                (event.cpu / 4) * 4 + 2].get_util(event.time))
-                        self.util.append(
-                            SystemMetrics.current_metrics.sys_util_history.cpu[
-                                (event.cpu / 4) * 4 + 3].get_util(event.time))
-                        ##
-                        self.temp = [
-                            SystemMetrics.current_metrics.get_temp(
-                                event.time, (event.cpu / 4) * 4 + 0)
-                        ]
-                        self.temp.append(
-                            SystemMetrics.current_metrics.get_temp(
-                                event.time, (event.cpu / 4) * 4 + 1))
-                        self.temp.append(
-                            SystemMetrics.current_metrics.get_temp(
-                                event.time, (event.cpu / 4) * 4 + 2))
-                        self.temp.append(
-                            SystemMetrics.current_metrics.get_temp(
-                                event.time, (event.cpu / 4) * 4 + 3))
-
-                        cycle_energy = XU3RegressionModel.get_cpu_per_second_energy(
-                            event.cpu, cpu_speed, self.util, self.temp)
-                        cycle_energy = [
-                            component / cpu_speed for component in cycle_energy
-                        ]
-
-                        self.cpu_cycles += new_cycles
-                        new_energy = [
-                            component * new_cycles for component in cycle_energy
-                        ]
-                        new_summed_energy = [
-                            self.energy[i] + new_energy[i]
-                            for i in range(len(new_energy))
-                        ]
-                        self.energy = new_summed_energy
-                    self.duration += event.time - self.calc_time
-                    self.calc_time = event.time
+                if event.time != self.calc_time:
+                    self.advance(event.time, event.cpu)
 
             if event.next_pid == self.pid:  # Switching in
 
@@ -223,29 +106,35 @@ class TaskNode:
                                     color="violet",
                                     dir="forward")
 
+    def advance(self, ts, cpu):
+        """ Sums the task's cycles and energy from the calc time up to the given time, during which the task was
+        running on the given CPU, and shifts the calc time to it.
+        """
+        energy_timeline = SystemMetrics.current_metrics.get_energy_timeline(cpu)
+
+        self.cpu_cycles += int(energy_timeline.get_cycles(self.calc_time, ts))
+        self.energy[energy_timeline.cluster] += energy_timeline.get_energy(
+            self.calc_time, ts)
+        self.duration += ts - self.calc_time
+        self.calc_time = ts
+
     def finish(self):
         """ Set the time at which the task finished. The last event in a task will be the switch out event
         and as such this event's timestamp will be the end time of the current task.
         """
         self.finish_time = self.events[-1].time
 
-    def add_cpu_gpu_event(self, ts, cpu, cpu_freq, cpu_util, gpu_freq,
-                          gpu_util):
-        """ When a frequency or utilization value (needed for energy calculations) changes during a task's
-        execution a power event is added to a list that is then processed when the task ends. This allows
-        for accurate calculation of energy values over the duration of the task as there is a recorded history
-        of the system's metrics and changes over the duration of the task.
-
-        :param ts: Time at which the event happened
-        :param cpu:
-        :param cpu_freq:
-        :param cpu_util:
-        :param gpu_freq:
-        :param gpu_util:
-        :return:
-        """
-        self.sys_metric_change_events.append(
-            FreqPowerEvent(ts, cpu, cpu_freq, cpu_util, gpu_freq, gpu_util))
+        # Utilizations and temperatures of the task's cluster as it finished
+        metrics = SystemMetrics.current_metrics
+        first_core = (self.events[-1].cpu / 4) * 4
+        self.util = [
+            metrics.sys_util_history.cpu[first_core + i].get_util(
+                self.finish_time) for i in range(4)
+        ]
+        self.temp = [
+            metrics.get_temp(self.finish_time, first_core + i)
+            for i in range(4)
+        ]
 
 
 class BinderNode(TaskNode):
@@ -8,34 +8,218 @@ __maintainer__ = "Alex Hoffman"
 __email__ = "alex.hoffman@tum.de"
 __status__ = "Beta"
 
+import bisect
 import re
 import time
 import sys
 import os
+from collections import OrderedDict
 
 
 class PID:
     """ A process identified on a Linux system. Identified by a process and thread name as well as a unique
     identifying numeric ID.
     """
-    def __init__(self, pid, pname, tname):
+    def __init__(self, pid, pname, tname, tgid=None):
         self.pid = pid
         self.pname = pname
         self.tname = tname
+        self.tgid = tgid
+
+
+class LRUCache:
+    """ Dictionary that is bounded to a maximum number of entries, evicting the least recently used entry
+    once full.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, key):
+        value = self.entries.pop(key)
+        self.entries[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self.entries.pop(key, default)
+
+
+class PIDRoles:
+    """ Bitmap of the roles of each PID, indexed by PID, such that the relevance of a PID is found with a single
+    array read instead of a lookup in each of the PID dictionaries.
+    """
+
+    APP = 1
+    SYSTEM = 2
+    BINDER = 4
+    TRACKED = APP | SYSTEM
+
+    # Default pid_max of Linux, the bitmap grows if larger PIDs are seen
+    initial_size = 32768
+
+    def __init__(self):
+        self.bits = bytearray(self.initial_size)
+
+    def get(self, pid):
+        if pid < len(self.bits):
+            return self.bits[pid]
+        return 0
+
+    def set(self, pid, role):
+        if pid >= len(self.bits):
+            self.bits.extend(bytearray(max(pid + 1, 2 * len(self.bits)) -
+                                       len(self.bits)))
+        self.bits[pid] |= role
+
+    def clear(self, pid, role):
+        if pid < len(self.bits):
+            self.bits[pid] &= ~role & 0xff
+
+
+class RolePIDs(dict):
+    """ Dictionary of PID to PID object that keeps the role bitmap in sync as PIDs are added and removed.
+    """
+    def __init__(self, roles, role):
+        dict.__init__(self)
+        self.roles = roles
+        self.role = role
+
+    def __setitem__(self, pid, entry):
+        dict.__setitem__(self, pid, entry)
+        self.roles.set(pid, self.role)
+
+    def __delitem__(self, pid):
+        dict.__delitem__(self, pid)
+        self.roles.clear(pid, self.role)
+
+    def pop(self, pid, *default):
+        self.roles.clear(pid, self.role)
+        return dict.pop(self, pid, *default)
+
+
+class ProcessTable:
+    """ A single snapshot of the threads running on the target system, as listed by 'busybox ps -T'. The
+    output is parsed once and indexed by thread ID, thread group ID, process name and binder parent such that
+    all PID classification is done on the host without further ADB calls.
+
+    busybox does not print the thread group of a thread. Threads are however listed directly after their main
+    thread, as such a thread group is taken to start whenever the process name changes. Binder threads carry
+    their parent's PID in their name, "Binder:<pid>_<n>", which is used in place of the inferred group.
+    """
+
+    # <tid> <uid> <time> [{<thread name>}] <command>
+    line_re = re.compile(r"^\s*(\d+)\s+\S+\s+\d+:\d+\s?(?:\{(.*)\}\s?)?(.*)$")
+    binder_re = re.compile(r"^Binder:(\d+)_")
+
+    def __init__(self, ps_output):
+        self.output = ps_output
+        self.by_tid = dict()
+        self.by_tgid = dict()
+        self.by_pname = dict()
+        self.binder_children = dict()
+        self.pnames = []
+
+        self._parse(ps_output)
+        self.pnames = sorted(self.by_pname.keys())
+
+    def _parse(self, ps_output):
+        tgid = None
+        last_pname = None
+
+        for line in ps_output.splitlines():
+            match = self.line_re.match(line)
+            if not match:
+                continue  # Header or empty line
+
+            tid = int(match.group(1))
+            pname = match.group(3).strip()
+            tname = match.group(2) if match.group(2) is not None else pname
+
+            if pname != last_pname:
+                tgid = tid
+                last_pname = pname
+
+            binder = self.binder_re.match(tname)
+            if binder:
+                entry = PID(tid, pname, tname, int(binder.group(1)))
+                self.binder_children.setdefault(entry.tgid, []).append(tid)
+            else:
+                entry = PID(tid, pname, tname, tgid)
+
+            self.by_tid[tid] = entry
+            self.by_tgid.setdefault(entry.tgid, []).append(entry)
+            self.by_pname.setdefault(pname, []).append(entry)
+
+    def with_prefix(self, prefix):
+        """ Finds all threads whose process name starts with the given prefix.
+
+        :param prefix: Beginning of the process name, eg. an application's package or "/system/bin"
+        :return: List of PID entries
+        """
+        entries = []
+        i = bisect.bisect_left(self.pnames, prefix)
+        while i < len(self.pnames) and self.pnames[i].startswith(prefix):
+            entries.extend(self.by_pname[self.pnames[i]])
+            i += 1
+        return entries
+
+    def group(self, tgid):
+        """ Returns all threads of the thread group, ie. process, with the given ID.
+        """
+        return self.by_tgid.get(tgid, [])
+
+    @staticmethod
+    def is_binder(entry):
+        return "Binder" in entry.tname
 
 
 class PIDTool:
-    """ Probes the target system using ps and grep to extract all relevant threads to bother the target
-    application, system services and binder threads.
+    """ Probes the target system using a single snapshot of ps to extract all relevant threads to bother the
+    target application, system services and binder threads.
     """
-    def __init__(self, adb_device, name, pid=None):
+
+    # Number of device lookups, including failed ones, that are remembered
+    pid_cache_size = 1024
+
+    def __init__(self, adb_device, name, pid=None, ps_output=None):
+        """
+        :param adb_device: ADBInterface of the target system, None when working offline from a stored process table
+        :param name: Name of the target application
+        :param pid: Optional PID of the target application, otherwise found by its name
+        :param ps_output: Output of 'busybox ps -T' captured earlier, ie. stored in a checkpoint, that is used
+        instead of capturing the process table from the target system
+        """
 
         try:
             self.adb_device = adb_device
             self.name = name
+            # Thread names as seen in the trace, see observe_thread
+            self.thread_names = dict()
+            # Process of threads as found in the binder transaction log, see BinderTransactionLog
+            self.thread_processes = dict()
+            self.pid_cache = LRUCache(self.pid_cache_size)
+
+            start_time = time.time()
+            if ps_output is None:
+                self.ps_table = self._capture_table()
+                print("---- Captured process table --- %s Sec" %
+                      (time.time() - start_time))
+            else:
+                self.ps_table = ProcessTable(ps_output)
 
             main_pid = self._find_main_pid(pid)
-
             if main_pid is None:
                 print(
                     "Failed to find main PID for given application: {}".format(
@@ -43,11 +227,13 @@ class PIDTool:
                 raise Exception("Valid application not given")
             else:
                 print("---- Main PID found --- %d" % main_pid.pid)
-                self.app_pids = dict()
+                self.main_pid = main_pid.pid
+                self.roles = PIDRoles()
+                self.app_pids = RolePIDs(self.roles, PIDRoles.APP)
                 self.app_pids[main_pid.pid] = main_pid
                 self.app_pids[0] = PID(0, "idle_proc", "idle_thread")
-                self.system_pids = dict()
-                self.binder_pids = dict()
+                self.system_pids = RolePIDs(self.roles, PIDRoles.SYSTEM)
+                self.binder_pids = RolePIDs(self.roles, PIDRoles.BINDER)
 
                 self._find_all_pid()
         except Exception, e:
@@ -56,19 +242,33 @@ class PIDTool:
             print(exc_type, fname, exc_tb.tb_lineno)
             raise Exception("PIDTool __init__: " + str(e))
 
+    def _capture_table(self, grep=None):
+        """ Captures the threads running on the target system.
+
+        :param grep: Optional pattern to which the listing is limited on the target
+        :return: ProcessTable of the captured threads
+        """
+        command = "busybox ps -T"
+        if grep is not None:
+            command += " | grep " + str(grep)
+        return ProcessTable(self.adb_device.command(command, idempotent=True))
+
+    def save_table(self, filename):
+        """ Writes the captured process table, such that the tool can be recreated offline, see __init__.
+        """
+        directory = os.path.dirname(filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(filename, "w+") as f:
+            f.write(self.ps_table.output)
+
     def _find_all_pid(self):
 
         start_time = time.time()
         self._find_all_app_pids()
-        print("---- Found application PIDs --- %s Sec" %
-              (time.time() - start_time))
-        start_time = time.time()
         self._find_system_server_pids()
-        print("---- Found system server PIDs --- %s Sec" %
-              (time.time() - start_time))
-        start_time = time.time()
         self._find_binder_pids()
-        print("---- Found Binder PIDs --- %s Sec" % (time.time() - start_time))
+        print("---- Classified PIDs --- %s Sec" % (time.time() - start_time))
 
     def _find_main_pid(self, pid=None):
         """ Will find the parent PID of the target application.
@@ -76,18 +276,15 @@ class PIDTool:
         :return: PID object of the main process for the target application
         """
         if pid is None:
-
-            res = self.adb_device.command("ps | grep " + self.name)
+            entries = self.ps_table.with_prefix(self.name)
         else:
-            res = self.adb_device.command("ps | grep " + pid)
-        if res == "":
-            return None
+            entry = self.ps_table.by_tid.get(int(pid))
+            entries = [entry] if entry else []
 
-        regex_line = re.findall(r" +(\d+) +\d+ +\d+ .+ ([^ ]+)$", res)
-        pid = int(regex_line[0][0])
-        pname = regex_line[0][1]
+        if not entries:
+            return None
 
-        return PID(pid, pname, "main")
+        return PID(entries[0].tgid, entries[0].pname, "main", entries[0].tgid)
 
     def _find_system_server_pids(self):
         """ As Android applications rely heavily on the existing system services to perform portions of the
@@ -95,141 +292,131 @@ class PIDTool:
         processes/threads that are responsible for a target application's execution.
 
         System services are found by looking for binaries that originate from the /system/bin directory.
-
-        :return:
         """
-        res = self.adb_device.command("busybox ps -T | grep /system/bin")
-        res = res.splitlines()
-
-        for line in res:
-            if re.search("(Binder)", line):
-                continue
-            if line.isspace():
-                continue
-            if re.search("(grep)", line):
-                continue
-
-            regex_line = re.findall(r"(\d+) \d+ +\d+:\d+ ?({(.*)})? (.+)",
-                                    line)
-            pid = int(regex_line[0][0])
-            if regex_line[0][1] == "":
-                tname = pname = regex_line[0][3]
-            else:
-                tname = regex_line[0][2]
-                pname = regex_line[0][3]
-
-            self.system_pids[pid] = PID(pid, pname, tname)
+        for entry in self.ps_table.with_prefix("/system/bin"):
+            if not ProcessTable.is_binder(entry):
+                self.system_pids[entry.pid] = entry
 
     def _find_binder_pids(self):
         """ Finds the PIDs of all binder threads on the system. All binder threads are tracked as it is hard
         to know which binder threads and which parent services will be used during the execution of the target
         application.
+        """
+        for parent_pid, children in self.ps_table.binder_children.iteritems():
+            for tid in children:
+                self.binder_pids[tid] = self.ps_table.by_tid[tid]
+
+            # Check that parent threads are in system server threads. This catches threads
+            # such as the media codec which is commonly used but is not a system service
+            if parent_pid not in self.system_pids:
+                for entry in self.ps_table.group(parent_pid):
+                    if not ProcessTable.is_binder(entry):
+                        self.system_pids[entry.pid] = entry
+
+    def observe_thread(self, pid, name):
+        """ Records the name of a thread as it appears in the trace, eg. the prev_comm and next_comm of
+        sched_switch events.
+
+        :param pid: PID of the thread
+        :param name: The thread's name at the time of the event
+        """
+        self.thread_names[pid] = name
+
+    def thread_forked(self, parent_pid, pid, name):
+        """ Adds a thread created during the trace to the classified PIDs. Threads inherit the classification
+        of the thread that created them such that new application threads are tracked like those that existed
+        when the process table was captured.
 
-        :return: A list of all binder PIDs
+        :param parent_pid: PID of the thread that created the new thread
+        :param pid: PID of the new thread
+        :param name: Name of the new thread
+        :return: PID object of the new thread if its parent is an application or system thread, otherwise None
         """
-        # Get all processes except the system_server itself
-        res = self.adb_device.command("busybox ps -T | grep {Binder:")
-        res = res.splitlines()
+        self.thread_names[pid] = name
 
-        for line in res:
-            if line.isspace():
-                continue
-            if re.search("(grep)", line):
-                continue
+        parent = self.app_pids.get(parent_pid) if parent_pid != 0 else None
+        if parent is not None:
+            entry = PID(pid, parent.pname, name, parent.tgid)
+            self.app_pids[pid] = entry
+            return entry
 
-            regex_line = re.findall(
-                r"(\d+) \d+ +\d+:\d+ {(Binder:(\d+)_.+)} (.+)", line)
-            pid = int(regex_line[0][0])
-            tname = regex_line[0][1]
-            pname = regex_line[0][3]
+        parent = self.system_pids.get(parent_pid)
+        if parent is not None:
+            entry = PID(pid, parent.pname, name, parent.tgid)
+            self.system_pids[pid] = entry
+            return entry
 
-            self.binder_pids[pid] = PID(pid, pname, tname)
+        return None
 
-            # Check that parent threads are in system server threads. This catches threads
-            # such as the media codec which is commonly used but is not a system service
-            parent_pid = int(regex_line[0][2])
-
-            if not any(proc == parent_pid for proc in self.system_pids.keys()):
-                parent_thread = self.adb_device.command(
-                    "busybox ps -T | grep " + str(parent_pid))
-                parent_thread = parent_thread.splitlines()
-                for l in parent_thread:
-                    if re.search("(Binder)", l):
-                        continue
-                    if line.isspace():
-                        continue
-                    if re.search("(grep)", l):
-                        continue
-
-                    regex_line = re.findall(
-                        r"(\d+) \d+ +\d+:\d+ ({(.*)}.* )?(.+)$", l)
-                    pid = int(regex_line[0][0])
-                    pname = regex_line[0][3]
-                    if not regex_line[0][2]:
-                        tname = pname
-                    else:
-                        tname = regex_line[0][2]
-
-                    self.system_pids[pid] = PID(pid, pname, tname)
+    def thread_exited(self, pid):
+        """ Removes an exited thread from the classified PIDs as its PID may be reused by an unrelated thread.
+        The thread's name is kept for later lookups of events that occurred before it exited.
 
-    def find_pid_info(self, pid):
-        res = self.adb_device.command("busybox ps -T | grep " + str(pid))
-        res = res.splitlines()
+        :param pid: PID of the exited thread
+        """
+        if pid == 0:
+            return
+        self.app_pids.pop(pid, None)
+        self.system_pids.pop(pid, None)
+        self.binder_pids.pop(pid, None)
+        self.pid_cache.pop(pid)
 
-        if len(res) > 2:
-            return None
+    def find_pid_info(self, pid):
+        """ Resolves a thread that is not part of the classified PIDs. The names seen in the trace are checked
+        first, as the process table is a snapshot from before the trace and the PID may since have been reused.
+        The snapshot's entry is only used if its name matches the trace's, or if the thread has not been seen
+        in the trace. As threads may since have exited, the target system is only queried as a last resort. The
+        results of these queries, including failed ones, are cached such that each PID is queried at most once.
+
+        :param pid: PID of the thread
+        :return: PID object of the thread or None if the thread cannot be resolved
+        """
+        entry = self.ps_table.by_tid.get(pid)
+        name = self.thread_names.get(pid)
+        if name is not None:
+            # Thread names are truncated to 15 characters in the trace
+            if entry is not None and entry.tname[:15] == name[:15]:
+                return entry
+            return self._trace_entry(pid, name)
 
-        for line in res:
-            if re.search("(Binder)", line):
-                continue
-            if line.isspace():
-                continue
-            # remove grep process
-            if re.search("(grep)", line):
-                continue
-
-            regex_line = re.findall(r"(\d+) \d+ +\d+:\d+ ({(.*)}.* )?(.+)$",
-                                    line)
-
-            pid = int(regex_line[0][0])
-            pname = regex_line[0][3]
-            if not regex_line[0][2]:
-                tname = pname
-            else:
-                tname = regex_line[0][2]
+        if entry is not None:
+            return entry
 
-            return PID(pid, pname, tname)
+        if pid in self.pid_cache:
+            return self.pid_cache[pid]
 
-    def _find_all_app_pids(self):
-        """ Finds all child processes that are involved in the execution of the target application
-        returning their PIDs. Does not include binder threads.
+        if self.adb_device is None:  # Offline, see __init__
+            return None
 
-        :return: List of all PIDs that are using by the target applications in its execution
+        try:
+            entry = self._capture_table(grep=pid).by_tid.get(pid)
+        except Exception:
+            entry = None  # Device no longer available
+        self.pid_cache[pid] = entry
+        return entry
+
+    def _trace_entry(self, pid, name):
+        """ Creates a PID object from a thread name seen in the trace. The process is known for binder
+        threads, whose names contain their parent's PID, and for threads found in the binder transaction log,
+        otherwise the thread name is used.
         """
+        binder = ProcessTable.binder_re.match(name)
+        tgid = int(binder.group(1)) if binder else self.thread_processes.get(
+            pid)
+        if tgid is not None:
+            group = self.ps_table.group(tgid)
+            pname = group[0].pname if group else name
+            return PID(pid, pname, name, tgid)
 
-        res = self.adb_device.command("busybox ps -T | grep " + self.name)
-        res = res.splitlines()
-
-        for line in res:
-            if re.search("(Binder)", line):
-                continue
-            if line.isspace():
-                continue
-            # remove grep process
-            if re.search("(grep)", line):
-                continue
-
-            regex_line = re.findall(r"(\d+) \d+ +\d+:\d+ ({(.*)}.* )?(.+)$",
-                                    line)
-
-            pid = int(regex_line[0][0])
-            pname = regex_line[0][3]
-            if not regex_line[0][2]:
-                tname = pname
-            else:
-                tname = regex_line[0][2]
+        return PID(pid, name, name)
 
-            self.app_pids[pid] = PID(pid, pname, tname)
+    def _find_all_app_pids(self):
+        """ Finds all child processes that are involved in the execution of the target application.
+        Does not include binder threads.
+        """
+        for entry in self.ps_table.with_prefix(self.name):
+            if not ProcessTable.is_binder(entry):
+                self.app_pids[entry.pid] = entry
 
     def find_child_binder_threads(self, pid):
         """ Binder threads are currently addressed using that parent binder process as the target. This can
@@ -246,22 +433,7 @@ class PIDTool:
         :param pid: PID whose child threads should be found
         :return: A list of all child binder PIDs
         """
-        res = ""
-        try:
-            res = self.adb_device.command(
-                "busybox ps -T | grep Binder | grep " + str(pid))
-            res = res.splitlines()
-        except Exception:
-            pass
-
-        child_pids = []
-        for line in res:
-            if line.isspace():
-                continue
-            if re.search("(grep)", line):
-                continue
-            child_pids.append(int(re.findall(r" *(\d+)", line)[0]))
-        return child_pids
+        return list(self.ps_table.binder_children.get(pid, []))
 
     def is_relevant_pid(self, pid):
         """ Only PIDs that appear in either the main application PIDs, binder thread PIDs and the system
@@ -270,13 +442,7 @@ class PIDTool:
         :param pid: PID that is to be checked or relevance
         :return: Boolean that signifies if the given PID is relevant
         """
-        if pid in self.app_pids:
-            return True
-        if pid in self.system_pids:
-            return True
-        if pid in self.binder_pids:
-            return True
-        return False
+        return self.roles.get(pid) != 0
 
     def get_pid_info(self, pid_no):
         if pid_no in self.app_pids:
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+"""
+Evaluates the results of one processed trace over a grid of the optimizer and timeline parameters, loading the
+trace's checkpoint (see TreeCheckpoint) rather than re-tracing and re-processing it for each value.
+
+The grid is given as "name=value,value;name=value", ie.
+
+    migration_factor=1.5,2.0237,2.5;utilization_window=0.1,0.25;max_big_freq=1.6e9,2e9
+
+Every combination of the given values is evaluated, parameters that are not given keep their defaults. The
+results of each combination are written as usual, suffixed by the combination's index, and the totals of all
+combinations are collected into a single comparison table.
+
+The utilization window (in seconds) is swept from the idle states stored in the checkpoint, the checkpoint must
+therefore have been written by a run that recorded them (--checkpoint). For each window the utilizations, the
+energy of all task runs and the optimizer's frequency and utilization lookups of all tasks are computed at once,
+see TreeCheckpoint.load and ProcessTree.cache_optimizer_inputs, and shared by the combinations of the other
+parameters. The optimizer's decisions are still evaluated per task for each combination.
+"""
+
+import csv
+import itertools
+import os
+import sys
+import time
+from collections import OrderedDict
+
+from Optimizations import OptimizationInfo
+from ProcessBranch import ProcessBranch
+from SystemMetrics import CPUUtilizationTable
+from TreeCheckpoint import TreeCheckpoint
+from XU3EnergyProfile import XU3RegressionModel
+
+__author__ = "Alex Hoffman"
+__copyright__ = "Copyright 2019, Alex Hoffman"
+__license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = "Alex Hoffman"
+__email__ = "alex.hoffman@tum.de"
+__status__ = "Beta"
+
+
+def parse_grid(grid):
+    """ Parses a parameter grid, see module docstring.
+
+    :param grid: String representation of the grid
+    :return: Ordered dictionary of parameter name to the list of its values
+    """
+    parameters = OrderedDict()
+    try:
+        for entry in grid.split(";"):
+            if not entry.strip():
+                continue
+            name, values = entry.split("=")
+            name = name.strip()
+            if name not in ParameterSweep.defaults:
+                raise ValueError("Unknown sweep parameter '%s'" % name)
+            parameters[name] = [float(value) for value in values.split(",")]
+    except ValueError, e:
+        raise ValueError("Grid must be given as name=value,value;... (%s)" % e)
+
+    return parameters
+
+
+class ParameterSweep:
+    """ Reruns finish_tree on a checkpointed process tree for every combination of a parameter grid.
+    """
+
+    # Sweepable parameters and their defaults. The frequency parameters cap the candidate frequencies of the
+    # optimizer's DVFS and reallocation search. The utilization window and timeline interval come first such that
+    # the checkpoint is only reloaded when either changes.
+    defaults = OrderedDict([
+        ("utilization_window", CPUUtilizationTable.window_duration * 0.000001),
+        ("timeline_interval", ProcessBranch.timeline_interval_us * 0.000001),
+        ("migration_factor", XU3RegressionModel.migration_factor),
+        ("max_little_freq", max(XU3RegressionModel.little_freqs)),
+        ("max_big_freq", max(XU3RegressionModel.big_freqs)),
+    ])
+
+    def __init__(self, trace_processor, metrics, checkpoint, governor,
+                 subdir=None):
+        """
+        :param trace_processor: TraceProcessor of the traced application
+        :param metrics: SystemMetrics into which the checkpoint is loaded
+        :param checkpoint: Filename of the checkpoint
+        :param governor: Governor that the trace was run under
+        :param subdir: Sub directory to store results in
+        """
+        self.trace_processor = trace_processor
+        self.metrics = metrics
+        self.checkpoint = checkpoint
+        self.governor = governor
+        self.subdir = subdir
+
+    def run(self, grid):
+        """ Evaluates all combinations of the grid and writes the comparison table to
+        results/<subdir><app>_sweep.csv.
+
+        :param grid: Ordered dictionary of parameter name to values, see parse_grid
+        :return: List of the result rows, one per combination
+        """
+        names = list(self.defaults.keys())
+        values = [grid.get(name, [default])
+                  for name, default in self.defaults.iteritems()]
+        combinations = [dict(zip(names, combination))
+                        for combination in itertools.product(*values)]
+        print("Sweeping %d parameter combinations" % len(combinations))
+
+        rows = []
+        failed = []
+        data = TreeCheckpoint.read(self.checkpoint)
+        process_tree = None
+        window = None
+        loaded = None
+        default_interval = ProcessBranch.timeline_interval_us
+        try:
+            for index, parameters in enumerate(combinations):
+                start_time = time.time()
+                sys.stdout.write("Combination %d" % index)
+
+                try:
+                    # The timeline buckets of the branches are built as the checkpoint is loaded
+                    window_us = int(round(parameters["utilization_window"] *
+                                          1000000))
+                    interval_us = int(
+                        round(parameters["timeline_interval"] * 1000000))
+                    if (window_us, interval_us) != loaded:
+                        loaded = None
+                        ProcessBranch.timeline_interval_us = interval_us
+                        process_tree, window = TreeCheckpoint.load(
+                            data,
+                            self.trace_processor.pidt,
+                            self.metrics,
+                            utilization_window=window_us)
+                        process_tree.cache_optimizer_inputs()
+                        loaded = (window_us, interval_us)
+
+                    self._apply_parameters(parameters)
+                    self._reset_optimizations(process_tree)
+
+                    optimizations_found = process_tree.finish_tree(
+                        "%s_sweep%d" %
+                        (self.trace_processor.filename, index),
+                        self.governor,
+                        self.subdir,
+                        window=window)
+                except Exception, e:
+                    # A failing combination is left out of the table rather than aborting the sweep
+                    print(" --- FAILED: %s" % e)
+                    failed.append(index)
+                    continue
+                print(" --- COMPLETED in %s seconds" %
+                      (time.time() - start_time))
+
+                rows.append([index] + [parameters[name] for name in names] +
+                            [process_tree.total_energy] + optimizations_found)
+        finally:
+            ProcessBranch.timeline_interval_us = default_interval
+            self._apply_parameters(self.defaults)
+
+        if failed:
+            print("%d of %d combinations failed: %s" %
+                  (len(failed), len(combinations), failed))
+        self._write_table(names, rows)
+        return rows
+
+    def _apply_parameters(self, parameters):
+        profile = self.metrics.energy_profile
+        profile.migration_factor = parameters["migration_factor"]
+        profile.little_freqs = [
+            freq for freq in XU3RegressionModel.little_freqs
+            if freq <= parameters["max_little_freq"]
+        ] or XU3RegressionModel.little_freqs[:1]
+        profile.big_freqs = [
+            freq for freq in XU3RegressionModel.big_freqs
+            if freq <= parameters["max_big_freq"]
+        ] or XU3RegressionModel.big_freqs[:1]
+
+    @staticmethod
+    def _reset_optimizations(process_tree):
+        """ The optimizer marks the tasks that it finds optimizations for, these are cleared between
+        combinations.
+        """
+        for branch in process_tree.process_branches.itervalues():
+            for task in branch.tasks:
+                task.optimization_info = OptimizationInfo(task.graph)
+
+    def _write_table(self, names, rows):
+        file_folder = "results/"
+        if self.subdir:
+            file_folder += self.subdir
+        if not os.path.exists(file_folder):
+            os.makedirs(file_folder)
+
+        with open(file_folder + self.trace_processor.filename + "_sweep.csv",
+                  "w+") as f:
+            writer = csv.writer(f, delimiter=",")
+            writer.writerow(["Combination"] + names + [
+                "Total Energy", "B2L Reallocations", "DVFS",
+                "Realloc in cluster", "DVFS after realloc"
+            ])
+            for row in rows:
+                writer.writerow(row)
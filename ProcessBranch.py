@@ -8,13 +8,12 @@ __maintainer__ = "Alex Hoffman"
 __email__ = "alex.hoffman@tum.de"
 __status__ = "Beta"
 
-import sys
-
-from pydispatch import dispatcher
 import numpy as np
 from Dependencies import DependencyType
 from Nodes import *
 from SystemEvents import JobType, ThreadState
+from SystemMetrics import SystemMetrics
+from TaskSpill import TaskSpill
 
 
 class EnergyDuration:
@@ -32,6 +31,17 @@ class ProcessBranch:
     each task being comprised of jobs/slices (time spend executing thread between a wake and
     sleep event).
     """
+
+    # Size of the buckets in which the energy of finished tasks is accumulated, see _finish_task
+    timeline_interval_us = 50000
+    # Tasks that finished more than the horizon before the latest finished task of their branch are retired,
+    # see _retire_tasks. All tasks are kept if not set.
+    retention_horizon_us = None
+    # Directory into which retired tasks are spilled, see TaskSpill. Retired tasks are only aggregated if not set.
+    spill_dir = None
+    # The most recent tasks are never retired, they may still gain dependencies
+    retained_tasks = 2
+
     def __init__(self, pid, pname, tname, start, graph, pidtracer, cpus, gpu):
 
         self.pid = pid
@@ -51,88 +61,22 @@ class ProcessBranch:
             0.0,
         ]  # calculated upon request at the end between given intervals
         self.duration = 0
-
-    def _connect_to_cpu_event(self, cpu):
-        """ Threads can change the CPU on which they are scheduled, to handle changes in PID->CPU allocation
-        each active PID task subscribes to a certain CPU branch from which it receives changes in the CPU's
-        metrics, needed for accurate energy calculation.
-
-        :param cpu: CPU index to which the PID branch wishes to subscribe
-        """
-        try:
-            dispatcher.connect(
-                self._handle_cpu_freq_change,
-                signal=self.cpus[cpu].signal_freq,
-                sender=dispatcher.Any,
-            )
-        except IndexError:
-            print "CPUs not init'd"
-            sys.exit(1)
-
-    def _disconnect_from_cpu_event(self, cpu):
-        """ Disconnects a PID branch from a certain CPU's metric update signal
-
-        :param cpu: CPU index from which the PID branch should be unsubscribed
-        """
-        try:
-            dispatcher.disconnect(
-                self._handle_cpu_freq_change,
-                signal=self.cpus[cpu].signal_freq,
-                sender=dispatcher.Any,
-            )
-        except IndexError:
-            print "IndexError in disconnecting from cpu"
-            sys.exit(1)
-
-    def _handle_cpu_freq_change(self):
-        """ Adds a CPU/GPU metric change event to the current branch. This event snapshots the CPU's metrics
-        before they were changed. The GPU's metrics have not changed and as such the current ones can be used.
-
-        """
-        if self.tasks:
-
-            try:
-                self.tasks[-1].add_cpu_gpu_event(
-                    self.cpus[self.cpu].events[-1].time,
-                    self.cpu,
-                    self.cpus[self.cpu].prev_freq,
-                    self.cpus[self.cpu].prev_util,
-                    self.gpu.freq,
-                    self.gpu.util,
-                )
-            except IndexError:
-                print "IndexError in handling CPU freq change"
-                sys.exit(1)
-
-    def _handle_cpu_num_change(self, event):
-        """ Adds a CPU/GPU metric change event to the current branch. This event snapshots the CPU's metrics
-        before the CPU was changed. If the new CPU has a different frequency to the previous one then a change
-        event is created. The GPU's metrics have not changed and as such the current ones can be used.
-
-        """
-        if self.tasks:
-
-            try:
-                if self.cpus[event.cpu].freq != self.cpus[self.cpu].freq:
-                    self.tasks[-1].add_cpu_gpu_event(
-                        event.time,
-                        self.cpu,
-                        self.cpus[self.cpu].freq,
-                        self.cpus[self.cpu].util,
-                        self.gpu.freq,
-                        self.gpu.util,
-                    )
-            except IndexError:
-                print "IndexError in handing CPU num change"
-                sys.exit(1)
-
-        self._disconnect_from_cpu_event(self.cpu)
-        self.cpu = event.cpu
-        self._connect_to_cpu_event(self.cpu)
+        # Running totals of the finished tasks, and their energy in buckets of timeline_interval_us
+        self.task_energy = [0.0, 0.0]
+        self.task_duration = 0
+        self.interval_energy = dict()
+        # Aggregates of the retired tasks, whose energy and duration remain in the running totals
+        self.retired_count = 0
+        self.retired_binder_count = 0
+        self.retired_cycles = 0
+        self.retired_start = None
+        self.duration_histogram = dict()  # Count of retired tasks by power of two duration
+        self.spill = None
 
     def get_interval_energy(self, second, interval, start_time, finish_time):
         """ Returns the energy consumed by a process during a given second offset from an initial start time,
-        constrained by a finish time.
+        constrained by a finish time. Intervals that line up with the branch's timeline buckets are read from
+        the buckets, other intervals are summed from the tasks.
 
         :param second: The number of intervals that the time window of interest is offset from the start time
         :param interval: The size of the time intervals that are being calculated
@@ -140,8 +84,15 @@ class ProcessBranch:
         :param finish_time: An upper bound which cannot be exceeded.
         :return: The calculated energy (in joules) for the specified second
         """
-        nanosecond_start = start_time + (second * interval * 1000000)
-        nanosecond_finish = nanosecond_start + interval * 1000000
+        interval_us = int(round(interval * 1000000))
+        nanosecond_start = start_time + second * interval_us
+        nanosecond_finish = nanosecond_start + interval_us
+
+        if (interval_us == self.timeline_interval_us
+                and nanosecond_start % interval_us == 0):
+            return list(
+                self.interval_energy.get(nanosecond_start // interval_us,
+                                         [0.0, 0.0]))
 
         if finish_time < nanosecond_finish:
             nanosecond_finish = finish_time
@@ -149,77 +100,211 @@ class ProcessBranch:
         return self.get_task_energy(nanosecond_start, nanosecond_finish).energy
 
     def get_task_energy(self, start_time, finish_time):
-        """ Sums the energy of the task between two time bounds
+        """ Sums the energy of the task between two time bounds. The running totals of the branch's finished
+        tasks are used, such that only the tasks at either end that do not lie entirely within the bounds
+        need to be looked at.
 
         :param start_time: The time at which energy consumption should start being summed
         :param finish_time: The time at which energy consumption should stop being summed
         :return: The energy sum and precise time over which the energy value was summed
         """
         tasks_stats = EnergyDuration()
+        tasks_stats.energy = list(self.task_energy)
+        tasks_stats.duration = self.task_duration
+
+        if self.tasks and not self.tasks[-1].finish_time:  # Still running at the end of the trace
+            self._add_task_share(tasks_stats, self.tasks[-1], 1.0)
+
+        # Tasks that started before the start bound
+        for task in self.iter_tasks():
+            if task.start_time >= start_time:
+                break
+            self._correct_task_share(tasks_stats, task, start_time,
+                                     finish_time)
+
+        # Tasks that are still running or finished after the finish bound
+        for task in self.iter_tasks(reverse=True):
+            if task.start_time < start_time or (
+                    task.finish_time and task.finish_time <= finish_time):
+                break
+            self._correct_task_share(tasks_stats, task, start_time,
+                                     finish_time)
 
-        for task in self.tasks:
-            # Task that falls at starting point
-            if (task.start_time < start_time) and (task.finish_time >
-                                                   start_time):
+        return tasks_stats
 
-                try:
-                    energy_delta = [((task.finish_time - start_time) /
-                                     task.duration * component)
-                                    for component in task.energy]
-                    for i in range(len(tasks_stats.energy)):
-                        tasks_stats.energy[i] += energy_delta[i]
+    @staticmethod
+    def _get_task_fraction(task, start_time, finish_time):
+        """ Returns the fraction of a task that falls within the given bounds, tasks that overlap a bound are
+        split by the fraction of their start to finish time within the bounds. Tasks that are still running
+        count in full if they started within the bounds.
+        """
+        if not task.finish_time:
+            return 1.0 if start_time <= task.start_time <= finish_time else 0.0
+
+        overlap = (min(task.finish_time, finish_time) -
+                   max(task.start_time, start_time))
+        if overlap <= 0:
+            return 0.0
+        return float(overlap) / (task.finish_time - task.start_time)
+
+    @staticmethod
+    def _add_task_share(tasks_stats, task, fraction):
+        for i in range(len(tasks_stats.energy)):
+            tasks_stats.energy[i] += task.energy[i] * fraction
+        tasks_stats.duration += task.duration * fraction
+
+    def _correct_task_share(self, tasks_stats, task, start_time, finish_time):
+        """ Replaces the full share of a task in the summed stats with the share that falls within the bounds.
+        """
+        fraction = self._get_task_fraction(task, start_time, finish_time)
+        self._add_task_share(tasks_stats, task, fraction - 1.0)
 
-                    tasks_stats.duration += task.finish_time - start_time
+    def _finish_task(self, task):
+        """ Finishes a task, see accumulate_task.
 
-                except ZeroDivisionError:
-                    continue
-            # Task that falls at the ending of the second
-            elif (task.start_time <= finish_time) and (task.finish_time >
-                                                       finish_time):
+        :param task: The task that has been switched out into sleep
+        """
+        task.finish()
+        self.accumulate_task(task)
 
-                try:
-                    energy_delta = [((finish_time - task.start_time) /
-                                     task.duration * component)
-                                    for component in task.energy]
-                    for i in range(len(tasks_stats.energy)):
-                        tasks_stats.energy[i] += energy_delta[i]
+        if self.retention_horizon_us is not None:
+            self._retire_tasks(task.finish_time - self.retention_horizon_us)
 
-                    tasks_stats.duration += finish_time - task.start_time
+    def accumulate_task(self, task):
+        """ Adds the energy of a finished task to the running totals of the branch and to the timeline buckets
+        that it overlaps, split by the fraction of the task that falls into each bucket.
 
-                except ZeroDivisionError:
-                    continue
-            # Middle events
-            elif (task.start_time >= start_time) and (task.finish_time <=
-                                                      finish_time):
+        :param task: Finished task of the branch
+        """
+        for i in range(len(self.task_energy)):
+            self.task_energy[i] += task.energy[i]
+        self.task_duration += task.duration
+
+        bucket = task.start_time // self.timeline_interval_us
+        last_bucket = max(task.finish_time - 1,
+                          task.start_time) // self.timeline_interval_us
+        while bucket <= last_bucket:
+            if task.finish_time > task.start_time:
+                fraction = self._get_task_fraction(
+                    task, bucket * self.timeline_interval_us,
+                    (bucket + 1) * self.timeline_interval_us)
+            else:
+                fraction = 1.0
 
-                for i in range(len(tasks_stats.energy)):
-                    tasks_stats.energy[i] += task.energy[i]
+            energy = self.interval_energy.setdefault(bucket, [0.0, 0.0])
+            for i in range(len(energy)):
+                energy[i] += task.energy[i] * fraction
+            bucket += 1
 
-                tasks_stats.duration += task.duration
-            # Finished second
-            elif task.start_time >= finish_time:
+    def get_start_time(self):
+        """ Returns the start time of the branch's first task, including retired tasks.
+        """
+        if self.retired_start is not None:
+            return self.retired_start
+        return self.tasks[0].start_time
 
-                return tasks_stats
+    def get_task_count(self):
+        return self.retired_count + len(self.tasks)
 
-        return tasks_stats
+    def iter_tasks(self, reverse=False):
+        """ Iterates over the branch's tasks, the spilled tasks being read back from disk, see TaskSpill.
+        Retired tasks that were not spilled are not included.
+
+        :param reverse: Iterates from the most recent task backwards
+        """
+        if reverse:
+            for task in reversed(self.tasks):
+                yield task
+        if self.spill is not None:
+            for task in self.spill.iter_tasks(reverse):
+                yield task
+        if not reverse:
+            for task in self.tasks:
+                yield task
+
+    def _retire_tasks(self, before):
+        """ Removes the tasks that finished before a time from the branch and the graph, such that the memory
+        held by a branch remains bounded however long the trace is. Their energy and duration remain in the
+        running totals of the branch, their counts, cycles and durations are added to the branch's aggregates.
+        If a spill directory is set they are also spilled, such that finish_tree can still evaluate them.
+
+        :param before: Time before which finished tasks are retired
+        """
+        for tasks in (self.tasks, self.binder_tasks):
+            count = 0
+            for task in tasks[:-self.retained_tasks]:
+                if not task.finish_time or task.finish_time >= before:
+                    break
+                count += 1
+            if not count:
+                continue
+
+            for task in tasks[:count]:
+                if self.graph.has_node(task):
+                    self.graph.remove_node(task)
+                # The retained tasks may still refer to the retired tasks, which must not keep their
+                # predecessors alive in turn
+                task.dependency.prev_task = None
+
+            if tasks is self.tasks:
+                self._aggregate_tasks(tasks[:count])
+            else:
+                self.retired_binder_count += count
+            del tasks[:count]
+
+    def _aggregate_tasks(self, tasks):
+        if self.retired_start is None:
+            self.retired_start = tasks[0].start_time
+        if self.spill is None and self.spill_dir is not None:
+            self.spill = TaskSpill(self.spill_dir, self.pid, self.tname,
+                                   self.graph)
+
+        for task in tasks:
+            self.retired_count += 1
+            self.retired_cycles += task.cpu_cycles
+            bucket = int(task.duration).bit_length()
+            self.duration_histogram[bucket] = self.duration_histogram.get(
+                bucket, 0) + 1
+            if self.spill is not None:
+                self.spill.append(task)
+
+    def discard_tasks(self, before):
+        """ Retires the tasks that finished before a time and drops the timeline buckets before it, such that
+        a branch handling an unbounded stream of events only holds a window of it, see LiveProcessor.
+
+        :param before: Time before which finished tasks are removed
+        """
+        self._retire_tasks(before)
+
+        first_bucket = before // self.timeline_interval_us
+        for bucket in [b for b in self.interval_energy if b < first_bucket]:
+            del self.interval_energy[bucket]
 
     def get_optimization_timeline(self, start_us, interval_count, interval_us):
-        finish_time = start_us + (interval_count * interval_us)
         # [DVFS,Task realloc]
         optimizations_timeline = np.full(interval_count * 2,
                                          [0]).reshape(interval_count, 2)
 
-        for task in self.tasks:
-            if (start_us < task.start_time
-                    and task.start_time + task.duration <= finish_time):
-                index = int(round((task.start_time - start_us) / interval_us))
-                if task.optimization_info.dvfs_possible():
-                    optimizations_timeline[index][1] += 1
-                if task.optimization_info.realloc_possible():
-                    optimizations_timeline[index][0] += 1
+        for task in self.iter_tasks():
+            self.add_task_optimizations(optimizations_timeline, task,
+                                        start_us, interval_us)
 
         return optimizations_timeline
 
+    @staticmethod
+    def add_task_optimizations(optimizations_timeline, task, start_us,
+                               interval_us):
+        """ Counts the optimizations found for a task into the interval of the timeline in which it started.
+        """
+        finish_time = start_us + (len(optimizations_timeline) * interval_us)
+        if (start_us < task.start_time
+                and task.start_time + task.duration <= finish_time):
+            index = int(round((task.start_time - start_us) / interval_us))
+            if task.optimization_info.dvfs_possible():
+                optimizations_timeline[index][1] += 1
+            if task.optimization_info.realloc_possible():
+                optimizations_timeline[index][0] += 1
+
     def add_event(self, event, event_type=JobType.UNKNOWN, subgraph=False):
         """ Handles the adding of events to the branch, specifically making sure that there is an active task
         to which the event can be added and that the event is connected to the correct CPU.
@@ -233,7 +318,6 @@ class ProcessBranch:
         if self.cpu is None:  # CPU association
 
             self.cpu = event.cpu
-            self._connect_to_cpu_event(self.cpu)
 
         if event_type == JobType.SCHED_SWITCH_OUT:
 
@@ -244,7 +328,7 @@ class ProcessBranch:
 
                 if event.prev_state == str(ThreadState.INTERRUPTIBLE_SLEEP_S):
                     self.active = False
-                    self.tasks[-1].finish()
+                    self._finish_task(self.tasks[-1])
                 else:
                     self.active = True
 
@@ -260,12 +344,13 @@ class ProcessBranch:
 
                     toi = self.tasks[-1]
                     toi.add_event(event, subgraph=subgraph)  ##HERE
-                    toi.finish()
+                    self._finish_task(toi)
                     utils_g = ("{}% ".format(round(k[1], 2))
                                for k in enumerate(toi.util))
                     utils = ""
                     for entry in utils_g:
                         utils += str(entry)
+                    metrics = SystemMetrics.current_metrics
                     label = (
                         "{}.{} ==> {}.{}\nPID: {}\nCPU: {} @ {} Hz\nUtil: {}\nTemp: {}\nGPU: {}Hz Util {}% "
                         "\n Duration: {} CPU Cycles: {}\nEnergy: {};{}\n Dependency: {} Dependent: #{} "
@@ -277,11 +362,11 @@ class ProcessBranch:
                             str(toi.finish_time)[-6:],
                             event.pid,
                             event.cpu,
-                            event.cpu_freq[0 if event.cpu < 4 else 1],
+                            metrics.get_cpu_freq_at(event.cpu, event.time),
                             utils,
                             toi.temp,
-                            event.gpu_freq,
-                            event.gpu_util,
+                            metrics.gpu_freq_history.get(event.time),
+                            metrics.gpu_util_history.get(event.time),
                             toi.duration,
                             toi.cpu_cycles,
                             toi.energy[1],
@@ -326,7 +411,7 @@ class ProcessBranch:
 
             if event.cpu != self.cpu:  # If the CPU has changed
 
-                self._handle_cpu_num_change(event)
+                self.cpu = event.cpu
 
             if self.active is False:  # New task starting
 
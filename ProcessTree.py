@@ -8,15 +8,19 @@ __maintainer__ = "Alex Hoffman"
 __email__ = "alex.hoffman@tum.de"
 __status__ = "Beta"
 
+import bisect
 import csv
 import time
 import os
+from collections import OrderedDict
 
 import networkx as nx
 
 from Dependencies import DependencyType
 from HardwareBranches import *
 from Optimizations import OptimizationInfoType
+from PIDTool import PIDRoles
+from Profiler import EventStats
 from ProcessBranch import ProcessBranch
 from SystemEvents import *
 from SystemMetrics import *
@@ -33,21 +37,34 @@ class ProcessTree:
 
         self.process_branches = dict()
         self.binder_branches = dict()
-        self.pending_binder_calls = []
+        # First halves by debug ID, in the order that they were sent
+        self.pending_binder_calls = OrderedDict()
+        # Stack of the first halves that each binder thread is currently handling, by thread
+        self.received_binder_calls = dict()
+        # Replies are only matched by debug ID once binder_transaction_received events are seen
+        self.exact_binder_matching = False
+        # Events are dispatched on their exact type
+        self.event_handlers = {
+            EventSchedSwitch: self._handle_sched_switch,
+            EventBinderTransaction: self._handle_binder_transaction,
+            EventBinderReceived: self._handle_binder_received,
+            EventFreqChange: self._handle_freq_change,
+            EventProcessFork: self._handle_process_fork,
+            EventProcessExit: self._handle_process_exit,
+            EventMaliUtil: self._handle_mali_util,
+        }
         self.completed_binder_calls = []
         self.cpus = []
+        self.total_energy = 0.0  # Set by finish_tree
+        # Cluster frequencies and core utilizations of each task by task ID, see cache_optimizer_inputs
+        self.optimizer_inputs = None
 
         self._create_cpu_branches()
         self.gpu = GPUBranch(self.metrics.current_gpu_freq,
                              self.metrics.current_gpu_util, self.graph)
         self._create_pid_branches()
 
-        self.idle_time = 0
-        self.temp_time = 0
-        self.binder_time = 0
-        self.mali_time = 0
-        self.sched_switch_time = 0
-        self.freq_time = 0
+        self.event_stats = EventStats()
 
     def _create_cpu_branches(self):
         """ Creates a CPU branch for each CPU found in a system
@@ -102,13 +119,15 @@ class ProcessTree:
                 self.gpu,
             )
 
-    def finish_tree(self, filename, governor, subdir):
+    def finish_tree(self, filename, governor, subdir, window=None):
         """ After all events have been added to a tree the tree compiles its energy results and
         writes them to a CSV file. Summaries of each PID's energy consumption as well as total
         tree energy metrics are provided.
 
         :param filename: Filename prefix which is used to differentiate the current trace
         :param subdir: Sub directory to store results in (usefull if running multiple tests)
+        :param window: Tuple of absolute (start, finish) timestamps that the results are clamped to, used when
+        only a window of the trace was processed
         """
         file_folder = "results/"
 
@@ -131,15 +150,20 @@ class ProcessTree:
 
                 if branch.tasks:
 
-                    if branch.tasks[
-                            0].start_time < start_time or start_time == 0:
-                        start_time = branch.tasks[0].start_time
+                    branch_start = branch.get_start_time()
+                    if branch_start < start_time or start_time == 0:
+                        start_time = branch_start
 
                     if (branch.tasks[-1].start_time + branch.tasks[-1].duration
                         ) > finish_time or finish_time == 0:
                         finish_time = (branch.tasks[-1].start_time +
                                        branch.tasks[-1].duration)
 
+            # Tasks from the warm-up margin before a window are not reported
+            if window:
+                start_time = max(start_time, window[0])
+                finish_time = min(finish_time, window[1])
+
             results_writer.writerow(["Application", filename])
             results_writer.writerow(["Governor", governor])
             results_writer.writerow(["Start", start_time / 1000000.0])
@@ -151,8 +175,13 @@ class ProcessTree:
             total_energy = 0.0
             # b2l_realloc, dvfs, same cluster realloc, dvfs after realloc
             optimizations_found = [0, 0, 0, 0]
-            timeline_interval = 0.05
-            timeline_intervals = int(round(duration / timeline_interval)) + 1
+            # The timeline is aligned to the buckets in which the branches accumulate their task energy
+            timeline_interval = ProcessBranch.timeline_interval_us * 0.000001
+            timeline_start = (start_time -
+                              start_time % ProcessBranch.timeline_interval_us)
+            timeline_intervals = int(
+                round((finish_time - timeline_start) * 0.000001 /
+                      timeline_interval)) + 1
             optimization_timeline_total = np.full(timeline_intervals * 2,
                                                   [0]).reshape(
                                                       timeline_intervals, 2)
@@ -203,268 +232,26 @@ class ProcessTree:
                             branch.pid,
                             branch.pname,
                             branch.tname,
-                            str(len(branch.tasks)),
+                            str(branch.get_task_count()),
                             branch.energy,
                             branch.duration,
                         ])
 
-                        mf = self.metrics.energy_profile.migration_factor
-
                         ### OPTIMAL EVALUATION
                         error_task = 0
                         try:
-                            for task in branch.tasks:
+                            # Spilled tasks are read back one at a time, see TaskSpill
+                            for task in branch.iter_tasks():
                                 error_task = task.id
-
-                                if (
-                                        task.cpu_cycles == 0
-                                ):  # Tasks that started at the end of the trace time
-                                    continue
-
-                                cores = self.metrics.sys_util_history
-                                core_utils = [0.0] * 8
-                                core_utils[0] = cores.cpu[0].get_util(
-                                    task.finish_time)
-                                core_utils[1] = cores.cpu[1].get_util(
-                                    task.finish_time)
-                                core_utils[2] = cores.cpu[2].get_util(
-                                    task.finish_time)
-                                core_utils[3] = cores.cpu[3].get_util(
-                                    task.finish_time)
-                                core_utils[4] = cores.cpu[4].get_util(
-                                    task.finish_time)
-                                core_utils[5] = cores.cpu[5].get_util(
-                                    task.finish_time)
-                                core_utils[6] = cores.cpu[6].get_util(
-                                    task.finish_time)
-                                core_utils[7] = cores.cpu[7].get_util(
-                                    task.finish_time)
-
-                                lf = self.metrics.energy_profile.little_freqs
-                                bf = self.metrics.energy_profile.big_freqs
-
-                                task_cycles = task.cpu_cycles
-
-                                # Reallocate to small core
-                                if (
-                                        task.events[0].cpu > 3
-                                ):  # big TODO fix the use of the first event's CPU
-
-                                    little_core_index = np.argmin(
-                                        core_utils[:4]
-                                    )  # Core with most capacity
-                                    little_cores = core_utils[:4]
-
-                                    cur_core_util = core_utils[
-                                        task.events[0].cpu]
-                                    # target_core_util = core_utils[little_core_index]
-
-                                    cur_little_cpu_freq = float(
-                                        task.events[0].cpu_freq[0])
-
-                                    cycles_on_little = round(task_cycles * mf)
-
-                                    for little_freq in lf:
-
-                                        # Scaled little utils
-                                        if cur_little_cpu_freq != little_freq:
-                                            scaling_factor = (
-                                                cur_little_cpu_freq /
-                                                little_freq)
-                                            core_utils_new_freq = [
-                                                core * scaling_factor
-                                                for core in little_cores
-                                            ]
-                                        else:
-                                            core_utils_new_freq = little_cores
-
-                                        # Check existing workload can be fit onto CPU at new frequency
-                                        if all(core_util <= 100.0 for core_util
-                                               in core_utils_new_freq):
-
-                                            # Realloc to little
-                                            available_cycles_on_little_at_new_freq = round(
-                                                (1.0 - (core_utils_new_freq[
-                                                    little_core_index] / 100))
-                                                * little_freq)
-
-                                            required_duration = (
-                                                cycles_on_little /
-                                                available_cycles_on_little_at_new_freq
-                                                * 1000000)
-
-                                            finish_time_on_little = int(
-                                                round(task.start_time +
-                                                      required_duration))
-
-                                            new_util_on_target_core = core_utils_new_freq[
-                                                little_core_index] + (
-                                                    cycles_on_little /
-                                                    little_freq * 100)
-
-                                            try:
-                                                depender_start_time = (
-                                                    task.dependency.next_task.
-                                                    start_time)
-                                            except Exception as e:
-                                                continue
-
-                                            if (finish_time_on_little <
-                                                    depender_start_time):
-                                                task.optimization_info.add_optim_type(
-                                                    OptimizationInfoType.
-                                                    B2L_REALLOC)
-                                                optimizations_found[0] += 1
-
-                                                if (little_freq != task.
-                                                        events[0].cpu_freq[0]):
-                                                    task.optimization_info.add_optim_type(
-                                                        OptimizationInfoType.
-                                                        DVFS_AFTER_REALLOC)
-                                                    optimizations_found[3] += 1
-
-                                                task.optimization_info.set_message(
-                                                    "Task can be reallocated")
-
-                                                op_writer.writerow([
-                                                    task.optimization_info.ID,
-                                                    task.id,
-                                                    task.pid,
-                                                    task.name,
-                                                    task.start_time,
-                                                    task.duration,
-                                                    task.events[0].cpu,
-                                                    task.events[0].cpu_freq[
-                                                        0 if task.events[0].
-                                                        cpu < 4 else 1],
-                                                    little_core_index,
-                                                    task.events[0].cpu_freq[0],
-                                                    little_freq,
-                                                    cur_core_util,
-                                                    cur_core_util,
-                                                    new_util_on_target_core,
-                                                    str(task.optimization_info
-                                                        ),
-                                                ])
-
-                                                break
-
-                                # Current core not running at minimum DVFS
-                                if (task.events[0].cpu <= 3
-                                        and task.events[0].cpu_freq[0] != lf[0]
-                                    ) or (task.events[0].cpu >= 4 and
-                                          task.events[0].cpu_freq[1] != bf[0]):
-
-                                    cur_cpu_freq = float(
-                                        task.events[0].
-                                        cpu_freq[0 if task.events[0].
-                                                 cpu <= 3 else 1])
-
-                                    if task.events[0].cpu <= 3:  # LITTLE
-                                        freq_index = lf.index(cur_cpu_freq)
-                                        freqs = lf[:
-                                                   freq_index]  # Freqs from minimum freq until the current one
-                                        lowest_util_core_index = np.argmin(
-                                            core_utils[:4])
-
-                                    else:  # big
-                                        freq_index = bf.index(cur_cpu_freq)
-                                        freqs = bf[:freq_index]
-                                        lowest_util_core_index = (
-                                            np.argmin(core_utils[4:]) + 4)
-
-                                    # Utilization of core that task is currently running on
-                                    cur_core_util = core_utils[
-                                        task.events[0].cpu]
-
-                                    target_core_util = core_utils[
-                                        task.events[0].cpu]
-
-                                    if (lowest_util_core_index !=
-                                            task.events[0].cpu
-                                        ):  # Might be a better core in cluster
-
-                                        # Utilization of core in cluster with smallest load
-                                        target_core_util = core_utils[
-                                            lowest_util_core_index]
-
-                                        # Load generated from the target task
-                                        task_load = (
-                                            float(task.duration) /
-                                            self.metrics.sys_util_history.
-                                            cpu[0].uw.window_duration * 100)
-
-                                        # Current core utilization less the task of interest's load
-                                        cur_core_util_wo_task = (
-                                            cur_core_util - task_load)
-
-                                        # If reallocation would result in a lower max utilization between current and target
-                                        # core
-                                        if cur_core_util_wo_task > target_core_util:
-                                            core_utils[task.events[0].
-                                                       cpu] -= task_load
-                                            core_utils[
-                                                lowest_util_core_index] += task_load
-                                            task.optimization_info.add_optim_type(
-                                                OptimizationInfoType.
-                                                SAME_CLUSTER_REALLOC)
-                                            optimizations_found[2] += 1
-
-                                    for freq in freqs:
-
-                                        # Scale
-                                        scaling_factor = cur_cpu_freq / freq
-                                        if task.events[0].cpu <= 3:  # LITTLE
-                                            core_utils_new_freq = [
-                                                core * scaling_factor
-                                                for core in core_utils[:4]
-                                            ]
-                                        else:  # big
-                                            core_utils_new_freq = [
-                                                core * scaling_factor
-                                                for core in core_utils[4:]
-                                            ]
-
-                                        if all(core_util <= 100.0 for core_util
-                                               in core_utils_new_freq):
-
-                                            task.optimization_info.set_message(
-                                                "DVFS optimization possible")
-                                            task.optimization_info.add_optim_type(
-                                                OptimizationInfoType.DVFS)
-                                            optimizations_found[1] += 1
-
-                                            op_writer.writerow([
-                                                task.optimization_info.ID,
-                                                task.id,
-                                                task.pid,
-                                                task.name,
-                                                task.start_time,
-                                                task.duration,
-                                                task.events[0].cpu,
-                                                task.events[0].
-                                                cpu_freq[0 if task.events[0].
-                                                         cpu < 4 else 1],
-                                                lowest_util_core_index,
-                                                cur_cpu_freq,
-                                                freq,
-                                                cur_core_util,
-                                                target_core_util,
-                                                core_utils_new_freq[
-                                                    lowest_util_core_index %
-                                                    4],
-                                                str(task.optimization_info),
-                                            ])
-                                            break
+                                self.find_task_optimizations(
+                                    task, optimizations_found, op_writer)
+                                branch.add_task_optimizations(
+                                    optimization_timeline_total, task,
+                                    timeline_start,
+                                    timeline_interval * 1000000)
                         except Exception, e:
                             e = str(e) + " task {}".format(error_task)
                             raise Exception(e)
-
-                        optimization_timeline = branch.get_optimization_timeline(
-                            start_time, timeline_intervals,
-                            timeline_interval * 1000000)
-                        optimization_timeline_total = np.add(
-                            optimization_timeline_total, optimization_timeline)
                 except Exception, e:
                     e = str(e) + " in branch {}".format(error_branch)
                     raise Exception(e)
@@ -494,7 +281,7 @@ class ProcessTree:
                 total_timeline_dvfs += optimization_timeline_total[i][1]
                 offset = timeline_interval * i
                 results_writer.writerow([
-                    start_time + offset * 1000000,
+                    timeline_start + offset * 1000000,
                     offset,
                     optimization_timeline_total[i][1],
                     optimization_timeline_total[i][0],
@@ -527,6 +314,8 @@ class ProcessTree:
 
             total_energy += gpu_energy
 
+            self.total_energy = total_energy
+
             results_writer.writerow([])
             results_writer.writerow(["Total Energy", total_energy])
             try:
@@ -545,7 +334,7 @@ class ProcessTree:
 
                 for x, branch in self.process_branches.iteritems():
                     energy = branch.get_interval_energy(
-                        i, timeline_interval, start_time, finish_time)
+                        i, timeline_interval, timeline_start, finish_time)
                     new_energy = [
                         second[0][0] + energy[0], second[0][1] + energy[1]
                     ]
@@ -555,7 +344,7 @@ class ProcessTree:
 
                 second[
                     1] += self.metrics.sys_util_history.gpu.get_interval_energy(
-                        i, timeline_interval, start_time, finish_time)
+                        i, timeline_interval, timeline_start, finish_time)
                 temp_l = SystemMetrics.current_metrics.get_temp(
                     i * timeline_interval * 1000000, 0)
                 temp_b = SystemMetrics.current_metrics.get_temp(
@@ -585,7 +374,7 @@ class ProcessTree:
 
             for x, second in enumerate(energy_timeline):
                 results_writer.writerow([
-                    str(x * timeline_interval + start_time / 1000000.0),
+                    str(x * timeline_interval + timeline_start / 1000000.0),
                     str(x * timeline_interval),
                     str(second[0][0] + second[0][1]),
                     str(second[0][1]),
@@ -599,6 +388,315 @@ class ProcessTree:
 
             return optimizations_found
 
+    def cache_optimizer_inputs(self):
+        """ Looks up the cluster frequencies at the start and the core utilizations at the finish of all tasks at
+        once, rather than per task in find_task_optimizations. Used when the optimizations of the same tree are
+        evaluated repeatedly, see ParameterSweep, the metrics must not change while the inputs are cached.
+        """
+        tasks = [
+            task for branch in self.process_branches.values()
+            for task in branch.iter_tasks() if task.cpu_cycles != 0
+        ]
+        if not tasks:
+            self.optimizer_inputs = {}
+            return
+
+        start_times = np.array([t.events[0].time for t in tasks],
+                               dtype=np.int64)
+        finish_times = np.array([t.finish_time for t in tasks],
+                                dtype=np.int64)
+        task_freqs = np.column_stack([
+            self.metrics.cluster_freq_history[c].get_many(start_times)
+            for c in range(2)
+        ]).tolist()
+        core_utils = np.column_stack([
+            table.get_utils(finish_times)
+            for table in self.metrics.sys_util_history.cpu
+        ]).tolist()
+
+        self.optimizer_inputs = dict(
+            (task.id, (task_freqs[i], core_utils[i]))
+            for i, task in enumerate(tasks))
+
+    def _get_optimizer_inputs(self, task):
+        """ Returns the cluster frequencies at the start of the task and the core utilizations at its finish.
+        """
+        task_freqs = self.metrics.get_cluster_freqs(
+            task.events[0].time)
+
+        cores = self.metrics.sys_util_history
+        core_utils = [0.0] * 8
+        core_utils[0] = cores.cpu[0].get_util(
+            task.finish_time)
+        core_utils[1] = cores.cpu[1].get_util(
+            task.finish_time)
+        core_utils[2] = cores.cpu[2].get_util(
+            task.finish_time)
+        core_utils[3] = cores.cpu[3].get_util(
+            task.finish_time)
+        core_utils[4] = cores.cpu[4].get_util(
+            task.finish_time)
+        core_utils[5] = cores.cpu[5].get_util(
+            task.finish_time)
+        core_utils[6] = cores.cpu[6].get_util(
+            task.finish_time)
+        core_utils[7] = cores.cpu[7].get_util(
+            task.finish_time)
+
+        return task_freqs, core_utils
+
+    def find_task_optimizations(self, task, optimizations_found,
+                                op_writer=None):
+        """ Evaluates whether a finished task could have been reallocated from the big to the LITTLE cluster
+        before its dependent task started, reallocated within its cluster or run at a lower frequency. The
+        optimizations found are marked on the task.
+
+        :param task: Finished task that is to be evaluated
+        :param optimizations_found: List of the counts of B2L reallocations, DVFS, reallocations within a
+        cluster and DVFS after reallocation which is incremented by the optimizations found
+        :param op_writer: Optional CSV writer into which the optimizations are written
+        """
+        mf = self.metrics.energy_profile.migration_factor
+
+        if (
+                task.cpu_cycles == 0
+        ):  # Tasks that started at the end of the trace time
+            return
+
+        if self.optimizer_inputs is not None:
+            task_freqs, core_utils = self.optimizer_inputs[task.id]
+            core_utils = list(core_utils)
+        else:
+            task_freqs, core_utils = self._get_optimizer_inputs(task)
+        lf = self.metrics.energy_profile.little_freqs
+        bf = self.metrics.energy_profile.big_freqs
+
+        task_cycles = task.cpu_cycles
+
+        # Reallocate to small core
+        if (
+                task.events[0].cpu > 3
+        ):  # big TODO fix the use of the first event's CPU
+
+            little_core_index = np.argmin(
+                core_utils[:4]
+            )  # Core with most capacity
+            little_cores = core_utils[:4]
+
+            cur_core_util = core_utils[
+                task.events[0].cpu]
+            # target_core_util = core_utils[little_core_index]
+
+            cur_little_cpu_freq = float(
+                task_freqs[0])
+
+            cycles_on_little = round(task_cycles * mf)
+
+            for little_freq in lf:
+
+                # Scaled little utils
+                if cur_little_cpu_freq != little_freq:
+                    scaling_factor = (
+                        cur_little_cpu_freq /
+                        little_freq)
+                    core_utils_new_freq = [
+                        core * scaling_factor
+                        for core in little_cores
+                    ]
+                else:
+                    core_utils_new_freq = little_cores
+
+                # Check existing workload can be fit onto CPU at new frequency
+                if all(core_util <= 100.0 for core_util
+                       in core_utils_new_freq):
+
+                    # Realloc to little
+                    available_cycles_on_little_at_new_freq = round(
+                        (1.0 - (core_utils_new_freq[
+                            little_core_index] / 100))
+                        * little_freq)
+
+                    required_duration = (
+                        cycles_on_little /
+                        available_cycles_on_little_at_new_freq
+                        * 1000000)
+
+                    finish_time_on_little = int(
+                        round(task.start_time +
+                              required_duration))
+
+                    new_util_on_target_core = core_utils_new_freq[
+                        little_core_index] + (
+                            cycles_on_little /
+                            little_freq * 100)
+
+                    try:
+                        depender_start_time = (
+                            task.dependency.next_task.
+                            start_time)
+                    except Exception as e:
+                        continue
+
+                    if (finish_time_on_little <
+                            depender_start_time):
+                        task.optimization_info.add_optim_type(
+                            OptimizationInfoType.
+                            B2L_REALLOC)
+                        optimizations_found[0] += 1
+
+                        if (little_freq != task_freqs[0]):
+                            task.optimization_info.add_optim_type(
+                                OptimizationInfoType.
+                                DVFS_AFTER_REALLOC)
+                            optimizations_found[3] += 1
+
+                        task.optimization_info.set_message(
+                            "Task can be reallocated")
+
+                        if op_writer:
+                            op_writer.writerow([
+                                task.optimization_info.ID,
+                                task.id,
+                                task.pid,
+                                task.name,
+                                task.start_time,
+                                task.duration,
+                                task.events[0].cpu,
+                                task_freqs[
+                                    0 if task.events[0].
+                                    cpu < 4 else 1],
+                                little_core_index,
+                                task_freqs[0],
+                                little_freq,
+                                cur_core_util,
+                                cur_core_util,
+                                new_util_on_target_core,
+                                str(task.optimization_info
+                                    ),
+                            ])
+
+                        break
+
+        # Current core not running at minimum DVFS
+        if (task.events[0].cpu <= 3
+                and task_freqs[0] != lf[0]
+            ) or (task.events[0].cpu >= 4 and
+                  task_freqs[1] != bf[0]):
+
+            cur_cpu_freq = float(
+                task_freqs[0 if task.events[0].
+                         cpu <= 3 else 1])
+
+            # Freqs from minimum freq until the current one. The current frequency need not be one of the profile's
+            # frequencies, ie. when those are capped by a ParameterSweep, all lower frequencies are candidates.
+            if task.events[0].cpu <= 3:  # LITTLE
+                freqs = lf[:bisect.bisect_left(lf, cur_cpu_freq)]
+                lowest_util_core_index = np.argmin(
+                    core_utils[:4])
+
+            else:  # big
+                freqs = bf[:bisect.bisect_left(bf, cur_cpu_freq)]
+                lowest_util_core_index = (
+                    np.argmin(core_utils[4:]) + 4)
+
+            # Utilization of core that task is currently running on
+            cur_core_util = core_utils[
+                task.events[0].cpu]
+
+            target_core_util = core_utils[
+                task.events[0].cpu]
+
+            if (lowest_util_core_index !=
+                    task.events[0].cpu
+                ):  # Might be a better core in cluster
+
+                # Utilization of core in cluster with smallest load
+                target_core_util = core_utils[
+                    lowest_util_core_index]
+
+                # Load generated from the target task
+                task_load = (
+                    float(task.duration) /
+                    self.metrics.sys_util_history.
+                    cpu[0].uw.window_duration * 100)
+
+                # Current core utilization less the task of interest's load
+                cur_core_util_wo_task = (
+                    cur_core_util - task_load)
+
+                # If reallocation would result in a lower max utilization between current and target
+                # core
+                if cur_core_util_wo_task > target_core_util:
+                    core_utils[task.events[0].
+                               cpu] -= task_load
+                    core_utils[
+                        lowest_util_core_index] += task_load
+                    task.optimization_info.add_optim_type(
+                        OptimizationInfoType.
+                        SAME_CLUSTER_REALLOC)
+                    optimizations_found[2] += 1
+
+            for freq in freqs:
+
+                # Scale
+                scaling_factor = cur_cpu_freq / freq
+                if task.events[0].cpu <= 3:  # LITTLE
+                    core_utils_new_freq = [
+                        core * scaling_factor
+                        for core in core_utils[:4]
+                    ]
+                else:  # big
+                    core_utils_new_freq = [
+                        core * scaling_factor
+                        for core in core_utils[4:]
+                    ]
+
+                if all(core_util <= 100.0 for core_util
+                       in core_utils_new_freq):
+
+                    task.optimization_info.set_message(
+                        "DVFS optimization possible")
+                    task.optimization_info.add_optim_type(
+                        OptimizationInfoType.DVFS)
+                    optimizations_found[1] += 1
+
+                    if op_writer:
+                        op_writer.writerow([
+                            task.optimization_info.ID,
+                            task.id,
+                            task.pid,
+                            task.name,
+                            task.start_time,
+                            task.duration,
+                            task.events[0].cpu,
+                            task_freqs[0 if task.events[0].
+                                     cpu < 4 else 1],
+                            lowest_util_core_index,
+                            cur_cpu_freq,
+                            freq,
+                            cur_core_util,
+                            target_core_util,
+                            core_utils_new_freq[
+                                lowest_util_core_index %
+                                4],
+                            str(task.optimization_info),
+                        ])
+                    break
+
+    def discard_before(self, before):
+        """ Drops the finished tasks and the CPU and GPU events before a time, see ProcessBranch.discard_tasks.
+        Results can only be compiled for the time after it.
+        """
+        for branch in self.process_branches.itervalues():
+            branch.discard_tasks(before)
+
+        for branch in self.cpus + [self.gpu]:
+            count = 0
+            while (count < len(branch.events) - 1
+                   and branch.events[count].time < before):
+                count += 1
+            del branch.events[:count]
+
     def handle_event(self, event, subgraph):
         """
         An event is handled by and added to the current trace tree, handled depending on event type.
@@ -607,113 +705,73 @@ class ProcessTree:
         :param subgraph: Boolean to enable to drawing of the task graph's node's sub-graphs
         :return 0 on success
         """
-        proc_start_time = time.time()
-
-        # Set event freq
-        event.cpu_freq[0] = self.metrics.get_cpu_core_freq(0)
-        event.cpu_freq[1] = self.metrics.get_cpu_core_freq(4)
-        event.gpu_freq = self.metrics.current_gpu_freq
-        event.gpu_util = self.metrics.current_gpu_util
+        event_type = event.__class__
+        handler = self.event_handlers.get(event_type)
+        if handler is None:
+            return
+
+        # Only one in sample_interval events of each type is timed, see EventStats
+        stats = self.event_stats
+        count = stats.counts.get(event_type, 0)
+        stats.counts[event_type] = count + 1
+        if count % stats.sample_interval:
+            return handler(event, subgraph)
+
+        start_time = time.time()
+        result = handler(event, subgraph)
+        stats.add_sample(event_type, time.time() - start_time)
+        return result
+
+    def _handle_sched_switch(self, event, subgraph):
+        """ A sched switch swaps the thread running on a CPU, creating and completing the tasks of the
+        threads' branches.
+        """
+        self.pidtracer.observe_thread(event.pid, event.name)
+        self.pidtracer.observe_thread(event.next_pid, event.next_name)
 
-        if isinstance(event, EventSchedSwitch):  # PID context swap
+        # Only switches to application and system threads are of interest, ignoring binder threads
+        if not self.pidtracer.roles.get(event.next_pid) & PIDRoles.TRACKED:
+            return 0
 
-            # Task being switched out, ignoring idle task and binder threads
-            if event.pid != 0 and (event.next_pid in self.pidtracer.system_pids
-                                   or
-                                   event.next_pid in self.pidtracer.app_pids):
+        # Task being switched out, ignoring idle task
+        if event.pid != 0:
 
-                try:
-                    process_branch = self.process_branches[event.pid]
-                    process_branch.add_event(
-                        event,
-                        event_type=JobType.SCHED_SWITCH_OUT,
-                        subgraph=subgraph)
-
-                except KeyError:
-                    pass  # PID not of interest to program
-
-            # Task being switched in, again ignoring idle task and binder threads
-            if event.next_pid != 0 and (
-                    event.next_pid in self.pidtracer.system_pids
-                    or event.next_pid in self.pidtracer.app_pids):
-
-                for x, pending_binder_node in reversed(
-                        list(enumerate(
-                            self.completed_binder_calls))):  # Most recent
-
-                    # If event to be switched in is the target of the Binder transaction
-                    if event.next_pid == pending_binder_node.target_pid:
-
-                        # If async binder call (no binder thread)
-                        if pending_binder_node.transaction_type == BinderType.ASYNC:
-                            # Calling PID acts as binder thread and should be added to binder threads if not already
-                            # added
-                            if (pending_binder_node.caller_pid not in
-                                    self.binder_branches):
-                                pid_info = self.pidtracer.get_pid_info(
-                                    pending_binder_node.caller_pid)
-
-                                if not pid_info:
-                                    del self.completed_binder_calls[x]
-                                    break
-
-                                self.binder_branches[
-                                    pending_binder_node.
-                                    caller_pid] = ProcessBranch(
-                                        pid_info.pid,
-                                        pid_info.pname,
-                                        pid_info.tname,
-                                        None,
-                                        self.graph,
-                                        self.pidtracer,
-                                        self.cpus,
-                                        self.gpu,
-                                    )
-
-                                self.pidtracer.binder_pids[
-                                    pending_binder_node.
-                                    binder_thread] = pid_info
-
-                        else:  # Sync
-                            # Binder thread that is not yet known
-                            if (pending_binder_node.binder_thread not in
-                                    self.binder_branches):
-                                pid_info = self.pidtracer.find_pid_info(
-                                    pending_binder_node.binder_thread)
-
-                                if not pid_info:
-                                    del self.completed_binder_calls[x]
-                                    break
-
-                                self.binder_branches[
-                                    pending_binder_node.
-                                    binder_thread] = ProcessBranch(
-                                        pid_info.pid,
-                                        pid_info.pname,
-                                        pid_info.tname,
-                                        None,
-                                        self.graph,
-                                        self.pidtracer,
-                                        self.cpus,
-                                        self.gpu,
-                                    )
-
-                                self.pidtracer.binder_pids[
-                                    pending_binder_node.
-                                    binder_thread] = pid_info
-
-                        # If target thread is not yet known
-                        if event.next_pid not in self.process_branches:
-                            # Calling to a PID that was not initially found as belonging to app
-                            pid_info = self.pidtracer.find_pid_info(
-                                event.next_pid)
+            try:
+                process_branch = self.process_branches[event.pid]
+                process_branch.add_event(
+                    event,
+                    event_type=JobType.SCHED_SWITCH_OUT,
+                    subgraph=subgraph)
+
+            except KeyError:
+                pass  # PID not of interest to program
+
+        # Task being switched in, again ignoring idle task
+        if event.next_pid != 0:
+
+            for x, pending_binder_node in reversed(
+                    list(enumerate(
+                        self.completed_binder_calls))):  # Most recent
+
+                # If event to be switched in is the target of the Binder transaction
+                if event.next_pid == pending_binder_node.target_pid:
+
+                    # If async binder call (no binder thread)
+                    if pending_binder_node.transaction_type == BinderType.ASYNC:
+                        # Calling PID acts as binder thread and should be added to binder threads if not already
+                        # added
+                        if (pending_binder_node.caller_pid not in
+                                self.binder_branches):
+                            pid_info = self.pidtracer.get_pid_info(
+                                pending_binder_node.caller_pid)
 
                             if not pid_info:
                                 del self.completed_binder_calls[x]
                                 break
 
-                            self.process_branches[
-                                event.next_pid] = ProcessBranch(
+                            self.binder_branches[
+                                pending_binder_node.
+                                caller_pid] = ProcessBranch(
                                     pid_info.pid,
                                     pid_info.pname,
                                     pid_info.tname,
@@ -724,192 +782,305 @@ class ProcessTree:
                                     self.gpu,
                                 )
 
-                            self.pidtracer.app_pids[event.next_pid] = pid_info
+                            self.pidtracer.binder_pids[
+                                pending_binder_node.
+                                binder_thread] = pid_info
+
+                    else:  # Sync
+                        # Binder thread that is not yet known
+                        if (pending_binder_node.binder_thread not in
+                                self.binder_branches):
+                            pid_info = self.pidtracer.find_pid_info(
+                                pending_binder_node.binder_thread)
+
+                            if not pid_info:
+                                del self.completed_binder_calls[x]
+                                break
 
-                        # Add first half binder event to binder branch
-                        if pending_binder_node.first_half:
-                            self.binder_branches[
-                                pending_binder_node.binder_thread].add_event(
-                                    pending_binder_node.first_half,
-                                    event_type=JobType.BINDER_SEND,
-                                )
-                        else:  # Async binder transaction
                             self.binder_branches[
-                                pending_binder_node.binder_thread].add_event(
-                                    pending_binder_node.second_half,
-                                    event_type=JobType.BINDER_SEND,
+                                pending_binder_node.
+                                binder_thread] = ProcessBranch(
+                                    pid_info.pid,
+                                    pid_info.pname,
+                                    pid_info.tname,
+                                    None,
+                                    self.graph,
+                                    self.pidtracer,
+                                    self.cpus,
+                                    self.gpu,
                                 )
 
-                        # Add second half binder event to binder branch
+                            self.pidtracer.binder_pids[
+                                pending_binder_node.
+                                binder_thread] = pid_info
+
+                    # If target thread is not yet known
+                    if event.next_pid not in self.process_branches:
+                        # Calling to a PID that was not initially found as belonging to app
+                        pid_info = self.pidtracer.find_pid_info(
+                            event.next_pid)
+
+                        if not pid_info:
+                            del self.completed_binder_calls[x]
+                            break
+
+                        self.process_branches[
+                            event.next_pid] = ProcessBranch(
+                                pid_info.pid,
+                                pid_info.pname,
+                                pid_info.tname,
+                                None,
+                                self.graph,
+                                self.pidtracer,
+                                self.cpus,
+                                self.gpu,
+                            )
+
+                        self.pidtracer.app_pids[event.next_pid] = pid_info
+
+                    # Add first half binder event to binder branch
+                    if pending_binder_node.first_half:
+                        self.binder_branches[
+                            pending_binder_node.binder_thread].add_event(
+                                pending_binder_node.first_half,
+                                event_type=JobType.BINDER_SEND,
+                            )
+                    else:  # Async binder transaction
                         self.binder_branches[
                             pending_binder_node.binder_thread].add_event(
                                 pending_binder_node.second_half,
-                                event_type=JobType.BINDER_RECV,
+                                event_type=JobType.BINDER_SEND,
                             )
 
-                        try:
-                            self.graph.add_edge(  # Edge from calling task to binder node
-                                self.process_branches[
-                                    pending_binder_node.caller_pid].tasks[-1],
-                                self.binder_branches[
-                                    pending_binder_node.binder_thread].
-                                binder_tasks[-1],
-                                color="palevioletred3",
-                                dir="forward",
-                                style="bold",
-                            )
+                    # Add second half binder event to binder branch
+                    self.binder_branches[
+                        pending_binder_node.binder_thread].add_event(
+                            pending_binder_node.second_half,
+                            event_type=JobType.BINDER_RECV,
+                        )
 
-                            # Switch in new pid which will find pending completed binder transaction and create a
-                            # new task node
+                    try:
+                        self.graph.add_edge(  # Edge from calling task to binder node
                             self.process_branches[
-                                pending_binder_node.target_pid].add_event(
-                                    event,
-                                    event_type=JobType.SCHED_SWITCH_IN,
-                                    subgraph=subgraph)
-
-                            self.graph.add_edge(  # Edge from binder node to next task
-                                self.binder_branches[
-                                    pending_binder_node.binder_thread].
-                                binder_tasks[-1],
-                                self.process_branches[
-                                    pending_binder_node.target_pid].tasks[-1],
-                                color="yellow3",
-                                dir="forward",
-                            )
+                                pending_binder_node.caller_pid].tasks[-1],
+                            self.binder_branches[
+                                pending_binder_node.binder_thread].
+                            binder_tasks[-1],
+                            color="palevioletred3",
+                            dir="forward",
+                            style="bold",
+                        )
+
+                        # Switch in new pid which will find pending completed binder transaction and create a
+                        # new task node
+                        self.process_branches[
+                            pending_binder_node.target_pid].add_event(
+                                event,
+                                event_type=JobType.SCHED_SWITCH_IN,
+                                subgraph=subgraph)
+
+                        self.graph.add_edge(  # Edge from binder node to next task
+                            self.binder_branches[
+                                pending_binder_node.binder_thread].
+                            binder_tasks[-1],
+                            self.process_branches[
+                                pending_binder_node.target_pid].tasks[-1],
+                            color="yellow3",
+                            dir="forward",
+                        )
+
+                        # Create dependency
+                        self.process_branches[
+                            pending_binder_node.target_pid].tasks[
+                                -1].dependency.type = DependencyType.BINDER
+
+                    except IndexError:
+                        pass  # Calling task has no nodes yet to link, tracing started during transaction
+
+                    if (pending_binder_node.target_pid ==
+                            pending_binder_node.caller_pid
+                        ):  # Task signaling itself
+                        # Create dependency from current task to calling task
+                        try:
+                            self.process_branches[
+                                pending_binder_node.target_pid].tasks[
+                                    -1].dependency.prev_task = self.process_branches[
+                                        pending_binder_node.
+                                        caller_pid].tasks[-2]
 
-                            # Create dependency
+                            # Create dependency from calling task to current task
+                            self.process_branches[
+                                pending_binder_node.caller_pid].tasks[
+                                    -2].dependency.next_task = self.process_branches[
+                                        pending_binder_node.
+                                        target_pid].tasks[-1]
+                        except IndexError:  # First task for PID
+                            pass
+
+                    else:
+                        if self.process_branches[
+                                pending_binder_node.caller_pid].tasks[-1]:
+                            # Create dependency from current task to calling task
                             self.process_branches[
                                 pending_binder_node.target_pid].tasks[
-                                    -1].dependency.type = DependencyType.BINDER
+                                    -1].dependency.prev_task = self.process_branches[
+                                        pending_binder_node.
+                                        caller_pid].tasks[-1]
+
+                            # Create dependency from calling task to current task
+                            self.process_branches[
+                                pending_binder_node.caller_pid].tasks[
+                                    -1].dependency.next_task = self.process_branches[
+                                        pending_binder_node.
+                                        target_pid].tasks[-1]
 
-                        except IndexError:
-                            pass  # Calling task has no nodes yet to link, tracing started during transaction
+                    # remove binder task that is now complete
+                    del self.completed_binder_calls[x]
 
-                        if (pending_binder_node.target_pid ==
-                                pending_binder_node.caller_pid
-                            ):  # Task signaling itself
-                            # Create dependency from current task to calling task
-                            try:
-                                self.process_branches[
-                                    pending_binder_node.target_pid].tasks[
-                                        -1].dependency.prev_task = self.process_branches[
-                                            pending_binder_node.
-                                            caller_pid].tasks[-2]
-
-                                # Create dependency from calling task to current task
-                                self.process_branches[
-                                    pending_binder_node.caller_pid].tasks[
-                                        -2].dependency.next_task = self.process_branches[
-                                            pending_binder_node.
-                                            target_pid].tasks[-1]
-                            except IndexError:  # First task for PID
-                                pass
-
-                        else:
-                            if self.process_branches[
-                                    pending_binder_node.caller_pid].tasks[-1]:
-                                # Create dependency from current task to calling task
-                                self.process_branches[
-                                    pending_binder_node.target_pid].tasks[
-                                        -1].dependency.prev_task = self.process_branches[
-                                            pending_binder_node.
-                                            caller_pid].tasks[-1]
-
-                                # Create dependency from calling task to current task
-                                self.process_branches[
-                                    pending_binder_node.caller_pid].tasks[
-                                        -1].dependency.next_task = self.process_branches[
-                                            pending_binder_node.
-                                            target_pid].tasks[-1]
-
-                        # remove binder task that is now complete
-                        del self.completed_binder_calls[x]
-
-                        self.sched_switch_time += time.time() - proc_start_time
-                        return 0
-
-                # Not called from a Binder transaction (cyclic task)
-                try:
-                    self.process_branches[event.next_pid].add_event(
-                        event,
-                        event_type=JobType.SCHED_SWITCH_IN,
-                        subgraph=subgraph)
-                except KeyError:
-                    pass  # Branch (PID) is not of interest and as such can be passed
-
-            self.sched_switch_time += time.time() - proc_start_time
-            return 0
+                    return 0
+
+            # Not called from a Binder transaction (cyclic task)
+            try:
+                self.process_branches[event.next_pid].add_event(
+                    event,
+                    event_type=JobType.SCHED_SWITCH_IN,
+                    subgraph=subgraph)
+            except KeyError:
+                pass  # Branch (PID) is not of interest and as such can be passed
+
+        return 0
 
-        elif isinstance(event, EventBinderTransaction):
+    def _handle_binder_transaction(self, event, subgraph):
+        """ First halves are kept pending until they are received and replied to, see _match_binder_reply.
+        """
+        # Normal calls and async calls (first halves)
+        if event.trans_type == BinderType.CALL:
+
+            # First half of a binder transaction
+            if self.pidtracer.roles.get(event.pid) & PIDRoles.TRACKED:
+
+                self.pending_binder_calls[
+                    event.transaction] = FirstHalfBinderTransaction(
+                        event, event.target_pid, self.pidtracer)
+
+            elif self.exact_binder_matching:
+                # Untracked calls are still received and replied to by binder threads, as such they
+                # are kept such that their replies are not matched to tracked calls
+                self.pending_binder_calls[event.transaction] = None
 
-            # Normal calls and async calls (first halves)
-            if event.trans_type == BinderType.CALL:
+        elif event.trans_type == BinderType.ASYNC:
 
-                # First half of a binder transaction
-                if (event.pid in self.pidtracer.app_pids
-                        or event.pid in self.pidtracer.system_pids):
+            if self.pidtracer.roles.get(event.pid) & PIDRoles.TRACKED:
 
-                    self.pending_binder_calls.append(
-                        FirstHalfBinderTransaction(event, event.target_pid,
-                                                   self.pidtracer))
+                self.completed_binder_calls.append(
+                    CompletedBinderTransaction(event))
 
-            elif event.trans_type == BinderType.ASYNC:
+        elif event.trans_type == BinderType.REPLY:
 
-                if (event.pid in self.pidtracer.app_pids
-                        or event.pid in self.pidtracer.system_pids):
+            if (self.exact_binder_matching or self.pidtracer.roles.get(
+                    event.pid) & (PIDRoles.SYSTEM | PIDRoles.BINDER)):
 
+                transaction = self._match_binder_reply(event)
+                if transaction:
                     self.completed_binder_calls.append(
-                        CompletedBinderTransaction(event))
+                        CompletedBinderTransaction(
+                            event, transaction.send_event))
 
-            elif event.trans_type == BinderType.REPLY:
+        return 0
 
-                if (event.pid in self.pidtracer.system_pids
-                        or event.pid in self.pidtracer.binder_pids):
+    def _handle_binder_received(self, event, subgraph):
+        """ The receiving thread handles the transaction until it replies.
+        """
+        self.exact_binder_matching = True
 
-                    if self.pending_binder_calls:  # Pending first halves
-                        # Find most recent first half
-                        for x, transaction in reversed(
-                                list(enumerate(self.pending_binder_calls))):
+        # The receiving thread handles the transaction until it replies, one way transactions are never
+        # pending and are as such not added
+        if event.transaction in self.pending_binder_calls:
+            self.received_binder_calls.setdefault(event.pid, []).append(
+                self.pending_binder_calls.pop(event.transaction))
 
-                            if (any(pid == event.pid
-                                    for pid in transaction.child_pids)
-                                    or event.pid == transaction.parent_pid
-                                ):  # Find corresponding first half
+        return 0
 
-                                self.completed_binder_calls.append(
-                                    CompletedBinderTransaction(
-                                        event, transaction.send_event))
+    def _handle_freq_change(self, event, subgraph):
+        """ Frequency changes apply to all four cores of the target cluster.
+        """
+        for i in range(event.target_cpu, event.target_cpu + 4):
+            self.metrics.current_core_freqs[i] = event.freq
+            self.metrics.current_core_utils[i] = event.util
+            self.cpus[i].add_event(event)
 
-                                del self.pending_binder_calls[
-                                    x]  # Remove completed first half
+        return 0
 
-            self.binder_time += time.time() - proc_start_time
-            return 0
+    def _handle_process_fork(self, event, subgraph):
+        """ New threads are classified by their parent, see PIDTool.thread_forked.
+        """
+        pid_info = self.pidtracer.thread_forked(event.pid, event.child_pid,
+                                                event.child_name)
+        if (pid_info is not None
+                and event.child_pid not in self.process_branches):
+            self.process_branches[event.child_pid] = ProcessBranch(
+                pid_info.pid,
+                pid_info.pname,
+                pid_info.tname,
+                None,
+                self.graph,
+                self.pidtracer,
+                self.cpus,
+                self.gpu,
+            )
+        return 0
 
-        elif isinstance(event, EventFreqChange):
+    def _handle_process_exit(self, event, subgraph):
+        """ Exited threads are no longer classified as their PID may be reused.
+        """
+        self.pidtracer.thread_exited(event.pid)
+        return 0
 
-            for i in range(event.target_cpu, event.target_cpu + 4):
-                self.metrics.current_core_freqs[i] = event.freq
-                self.metrics.current_core_utils[i] = event.util
-                self.cpus[i].add_event(event)
+    def _handle_mali_util(self, event, subgraph):
+        """ Mali events update the GPU's frequency and utilization.
+        """
+        self.metrics.current_gpu_freq = event.freq
+        self.metrics.current_gpu_util = event.util
+        self.metrics.sys_util_history.gpu.add_event(event)
+        self.gpu.add_event(event)
 
-            self.freq_time += time.time() - proc_start_time
-            return 0
+        return 0
 
-        elif isinstance(event, EventMaliUtil):
+    def _match_binder_reply(self, event):
+        """ Finds the first half of the transaction that a reply completes. When binder_transaction_received
+        events are traced the reply completes the most recent transaction received by the replying thread.
+        Otherwise the most recent pending first half that was sent to the replying thread, or to its parent
+        binder thread, is assumed.
 
-            self.metrics.current_gpu_freq = event.freq
-            self.metrics.current_gpu_util = event.util
-            self.metrics.sys_util_history.gpu.add_event(event)
-            self.gpu.add_event(event)
+        :param event: Binder reply event
+        :return: The completed first half or None if no first half is found
+        """
+        if self.exact_binder_matching:
+            handled = self.received_binder_calls.get(event.pid)
+            return handled.pop() if handled else None
 
-            self.mali_time += time.time() - proc_start_time
-            return 0
+        for transaction_id in reversed(self.pending_binder_calls):
+            transaction = self.pending_binder_calls[transaction_id]
+            if transaction and transaction.is_handled_by(event.pid):
+                del self.pending_binder_calls[transaction_id]
+                return transaction
+
+        return None
 
     @staticmethod
     def handle_temp_event(event, event_n_minus_1):
 
-        value = TempLogEntry(
+        value = ProcessTree.get_temp_entry(event)
+
+        if not event_n_minus_1:
+            return np.full(1, value)
+        else:
+            duration = event.time - event_n_minus_1.time
+            return np.full(duration, [value])
+
+    @staticmethod
+    def get_temp_entry(event):
+        return TempLogEntry(
             event.time,
             event.big0,
             event.big1,
@@ -919,12 +1090,6 @@ class ProcessTree:
             event.gpu,
         )
 
-        if not event_n_minus_1:
-            return np.full(1, value)
-        else:
-            duration = event.time - event_n_minus_1.time
-            return np.full(duration, [value])
-
     def handle_idle_event(self, event):
 
         self.metrics.sys_util_history.cpu[event.cpu].add_idle_event(event)
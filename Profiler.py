@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+"""
+Instrumentation of the processing pipeline, written as a machine readable JSON profile per run such that runs
+can be compared across traces and versions.
+
+The profile consists of:
+- a tree of phases, see Profiler.begin and Profiler.end, each with its wall and CPU time and the memory of the
+process at its start and end. The peak memory is the peak resident memory of the process during the phase,
+as tracemalloc is not available to Python 2. The kernel's resident memory high water mark (VmHWM) is reset as
+each phase starts, the peak reached so far being kept by the phases that are open, see PhaseSpan. The peak is
+not reported where the high water mark cannot be reset, ie. other than on Linux.
+- per event type counts and latencies of the process tree, see EventStats. Only one in sample_interval events
+of each type is timed, such that handling an event costs a dictionary update rather than two time calls.
+
+Phases are only recorded while a profiler is in use, the calls are no-ops otherwise.
+"""
+
+import json
+import os
+import platform
+import time
+
+from MemoryBudget import MemoryBudget
+
+__author__ = "Alex Hoffman"
+__copyright__ = "Copyright 2019, Alex Hoffman"
+__license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = "Alex Hoffman"
+__email__ = "alex.hoffman@tum.de"
+__status__ = "Beta"
+
+
+class EventStats:
+    """ Counts of the events handled by a process tree by type, and sampled latencies of their handling.
+    """
+
+    # One in this many events of each type is timed
+    sample_interval = 64
+
+    def __init__(self):
+        self.counts = dict()
+        self.samples = dict()
+        self.sample_time = dict()
+        # Count of samples by power of two latency (in microseconds), ie. bucket 3 is 4 to 7 microseconds
+        self.histograms = dict()
+
+    def add_sample(self, event_type, latency):
+        """ Records the latency (in seconds) of handling an event.
+        """
+        self.samples[event_type] = self.samples.get(event_type, 0) + 1
+        self.sample_time[event_type] = self.sample_time.get(event_type,
+                                                            0.0) + latency
+        histogram = self.histograms.setdefault(event_type, dict())
+        bucket = int(latency * 1000000).bit_length()
+        histogram[bucket] = histogram.get(bucket, 0) + 1
+
+    def get_estimated_time(self, event_type):
+        """ Estimates the total time (in seconds) spent handling the events of a type from their samples.
+        """
+        samples = self.samples.get(event_type, 0)
+        if not samples:
+            return 0.0
+        return (self.sample_time[event_type] / samples *
+                self.counts.get(event_type, 0))
+
+    def merge(self, other):
+        """ Adds the counts and samples of another tree's stats, see ShardProcessor.
+        """
+        for event_type, count in other.counts.iteritems():
+            self.counts[event_type] = self.counts.get(event_type, 0) + count
+        for event_type, samples in other.samples.iteritems():
+            self.samples[event_type] = self.samples.get(event_type,
+                                                        0) + samples
+            self.sample_time[event_type] = (
+                self.sample_time.get(event_type, 0.0) +
+                other.sample_time[event_type])
+            histogram = self.histograms.setdefault(event_type, dict())
+            for bucket, count in other.histograms[event_type].iteritems():
+                histogram[bucket] = histogram.get(bucket, 0) + count
+
+    def to_dict(self):
+        stats = dict()
+        for event_type, count in self.counts.iteritems():
+            samples = self.samples.get(event_type, 0)
+            stats[event_type.__name__] = {
+                "count": count,
+                "samples": samples,
+                "mean_us": (self.sample_time[event_type] / samples * 1000000
+                            if samples else None),
+                "estimated_total_s": self.get_estimated_time(event_type),
+                "histogram_us": dict(
+                    ("<%d" % (1 << bucket), bucket_count)
+                    for bucket, bucket_count in sorted(
+                        self.histograms.get(event_type, dict()).items())),
+            }
+        return stats
+
+
+class PhaseSpan:
+    """ A phase of the profile and the phases that it contains.
+    """
+    def __init__(self, name, open_spans=()):
+        """
+        :param name: Name of the phase
+        :param open_spans: Phases that contain the phase, these keep the peak reached so far as the high water
+        mark is reset for the phase
+        """
+        self.name = name
+        self.children = []
+        self.start = time.time()
+        self.cpu_start = sum(os.times()[:2])
+        self.memory_start = MemoryBudget.get_resident_memory()
+        self.duration = None
+        self.cpu_time = None
+        self.memory_end = None
+        self.peak_memory = None
+
+        for span in open_spans:
+            span.update_peak()
+        if self.reset_peak_memory():
+            self.peak_memory = self.memory_start
+
+    def finish(self):
+        self.duration = time.time() - self.start
+        self.cpu_time = sum(os.times()[:2]) - self.cpu_start
+        self.memory_end = MemoryBudget.get_resident_memory()
+        self.update_peak()
+
+    def update_peak(self):
+        """ Folds the high water mark since the last reset into the peak of the phase.
+        """
+        if self.peak_memory is not None:
+            self.peak_memory = max(self.peak_memory,
+                                   self.get_peak_memory())
+
+    @staticmethod
+    def reset_peak_memory():
+        """ Resets the resident memory high water mark of the process.
+
+        :return: Whether the high water mark could be reset
+        """
+        try:
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+            return True
+        except IOError:
+            return False
+
+    @staticmethod
+    def get_peak_memory():
+        """ Returns the resident memory high water mark (in bytes) of the process since it was last reset.
+        """
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    # Given in kB
+                    return int(line.split()[1]) * 1024
+        return 0
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "start": self.start,
+            "duration_s": self.duration,
+            "cpu_s": self.cpu_time,
+            "memory_start_bytes": self.memory_start,
+            "memory_end_bytes": self.memory_end,
+            "peak_memory_bytes": self.peak_memory,
+            "phases": [child.to_dict() for child in self.children],
+        }
+
+
+class Profiler:
+    """ Records the phases and event statistics of a run, see module docstring.
+    """
+
+    # The profiler in use, if any
+    current = None
+
+    def __init__(self, name):
+        """
+        :param name: Name of the profiled run, ie. the application
+        """
+        self.name = name
+        self.root = PhaseSpan("run")
+        self.stack = [self.root]
+        self.event_stats = EventStats()
+        self.attributes = dict()
+
+        Profiler.current = self
+
+    @staticmethod
+    def begin(name):
+        """ Starts a phase within the current phase.
+        """
+        profiler = Profiler.current
+        if profiler is None:
+            return
+        span = PhaseSpan(name, profiler.stack)
+        profiler.stack[-1].children.append(span)
+        profiler.stack.append(span)
+
+    @staticmethod
+    def end(name):
+        """ Finishes the named phase, and any phases within it that were left open, ie. by an early return.
+        """
+        profiler = Profiler.current
+        if profiler is None:
+            return
+        if not any(span.name == name for span in profiler.stack[1:]):
+            return
+        while True:
+            span = profiler.stack.pop()
+            span.finish()
+            if span.name == name:
+                return
+
+    @staticmethod
+    def add_event_stats(event_stats):
+        """ Adds the event statistics of a process tree to the profile.
+        """
+        if Profiler.current is not None:
+            Profiler.current.event_stats.merge(event_stats)
+
+    @staticmethod
+    def set_attribute(name, value):
+        """ Records a value that describes the run, ie. the number of events.
+        """
+        if Profiler.current is not None:
+            Profiler.current.attributes[name] = value
+
+    def write(self, filename):
+        """ Finishes all open phases and writes the profile.
+
+        :param filename: File into which the JSON profile is written
+        """
+        while self.stack:
+            self.stack.pop().finish()
+
+        profile = {
+            "application": self.name,
+            "python": platform.python_version(),
+            "host": platform.node(),
+            "attributes": self.attributes,
+            "phases": self.root.to_dict(),
+            "events": self.event_stats.to_dict(),
+        }
+
+        with open(filename, "w+") as f:
+            json.dump(profile, f, indent=2, sort_keys=True)
+
+        if Profiler.current is self:
+            Profiler.current = None
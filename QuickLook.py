@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+"""
+Quick-look mode, computes the per-thread energy totals and the energy timeline of a trace without building the
+process tree. No branches, tasks, dependencies or optimizations are created.
+
+The sched_switch events are sorted by CPU and time, such that the thread switched in by each event runs until
+the next switch on the same CPU. Each run interval is split at the timeline interval boundaries and every piece
+is integrated against the cluster energy timelines (see ClusterEnergyTimeline) in one vectorized pass. The
+pieces are then summed per thread and per timeline interval.
+"""
+
+import csv
+import os
+
+import numpy as np
+
+from PIDTool import PIDRoles
+from ProcessBranch import ProcessBranch
+from SystemEvents import EventMaliUtil, EventProcessFork, EventSchedSwitch
+
+__author__ = "Alex Hoffman"
+__copyright__ = "Copyright 2019, Alex Hoffman"
+__license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = "Alex Hoffman"
+__email__ = "alex.hoffman@tum.de"
+__status__ = "Beta"
+
+
+class QuickLook:
+    """ Energy totals of the application and system threads, see module docstring.
+    """
+    def __init__(self, pidtracer, metrics, filename):
+        """
+        :param pidtracer: PID tool object that has all the PIDs relevant to the target application stored
+        :param metrics: SystemMetrics whose temperature, utilization and energy timelines have been built
+        :param filename: Filename prefix of the results
+        """
+        self.pidtracer = pidtracer
+        self.metrics = metrics
+        self.filename = filename
+
+    def run(self, events, governor, subdir=None, bounds=None):
+        """ Computes and writes the totals to results/<subdir><filename>_quick_results.csv.
+
+        :param events: Time ordered processed events, including any thread and frequency events from before
+        a processing window
+        :param governor: Governor that the trace was run under
+        :param subdir: Sub directory to store results in
+        :param bounds: Tuple of absolute (start, finish) timestamps that the results are clamped to, if any
+        :return: Total energy (in joules)
+        """
+        self._replay_events(events)
+
+        pids, cpus, starts, finishes = self._get_run_intervals(events)
+        if bounds:
+            starts = np.maximum(starts, bounds[0])
+            finishes = np.minimum(finishes, bounds[1])
+            inside = finishes > starts
+            pids, cpus, starts, finishes = (pids[inside], cpus[inside],
+                                            starts[inside], finishes[inside])
+
+        if not len(starts):
+            print("No application or system threads ran during the trace")
+            return 0.0
+
+        start_time = int(starts.min())
+        finish_time = int(finishes.max())
+
+        interval_us = ProcessBranch.timeline_interval_us
+        timeline_start = start_time - start_time % interval_us
+        timeline_intervals = int(
+            round((finish_time - timeline_start) / float(interval_us))) + 1
+
+        # Split the run intervals at the timeline interval boundaries
+        first_bucket = starts // interval_us
+        counts = (finishes - 1) // interval_us - first_bucket + 1
+        pieces = np.repeat(np.arange(len(starts)), counts)
+        buckets = first_bucket[pieces] + (
+            np.arange(len(pieces)) - np.repeat(np.cumsum(counts) - counts, counts))
+        piece_starts = np.maximum(starts[pieces], buckets * interval_us)
+        piece_finishes = np.minimum(finishes[pieces],
+                                    (buckets + 1) * interval_us)
+
+        energy = np.zeros((2, len(pieces)))
+        for cluster in range(2):
+            in_cluster = (cpus[pieces] >= 4) == bool(cluster)
+            energy[cluster][in_cluster] = self.metrics.cluster_energy[
+                cluster].get_energy(piece_starts[in_cluster],
+                                    piece_finishes[in_cluster])
+
+        thread_pids, threads = np.unique(pids[pieces], return_inverse=True)
+        thread_energy = [
+            np.bincount(threads, weights=energy[cluster])
+            for cluster in range(2)
+        ]
+        thread_duration = np.bincount(threads,
+                                      weights=piece_finishes - piece_starts)
+
+        rows = buckets - timeline_start // interval_us
+        in_timeline = rows < timeline_intervals
+        timeline_energy = [
+            np.bincount(rows[in_timeline],
+                        weights=energy[cluster][in_timeline],
+                        minlength=timeline_intervals)
+            for cluster in range(2)
+        ]
+
+        return self._write_results(governor, subdir, start_time, finish_time,
+                                   timeline_start, timeline_intervals,
+                                   thread_pids, thread_energy, thread_duration,
+                                   timeline_energy)
+
+    def _replay_events(self, events):
+        """ Threads forked during the trace are classified by their parent, and the GPU utilization table is
+        built from the Mali events, as the process tree would when handling the events.
+        """
+        gpu = self.metrics.sys_util_history.gpu
+        for event in events:
+            if isinstance(event, EventProcessFork):
+                self.pidtracer.thread_forked(event.pid, event.child_pid,
+                                             event.child_name)
+            elif isinstance(event, EventMaliUtil):
+                gpu.add_event(event)
+
+    def _get_run_intervals(self, events):
+        """ Finds the intervals during which the application and system threads were running.
+
+        :return: Tuple of arrays of the PID, CPU, start and finish time of each run interval
+        """
+        switches = [
+            event for event in events if event.__class__ is EventSchedSwitch
+        ]
+        times = np.fromiter((e.time for e in switches), dtype=np.int64,
+                            count=len(switches))
+        cpus = np.fromiter((e.cpu for e in switches), dtype=np.int64,
+                           count=len(switches))
+        next_pids = np.fromiter((e.next_pid for e in switches),
+                                dtype=np.int64, count=len(switches))
+
+        order = np.lexsort((times, cpus))
+        times, cpus, next_pids = times[order], cpus[order], next_pids[order]
+
+        # Each switched in thread runs until the next switch on the same CPU
+        same_cpu = cpus[1:] == cpus[:-1]
+        pids = next_pids[:-1][same_cpu]
+        run_cpus = cpus[:-1][same_cpu]
+        starts = times[:-1][same_cpu]
+        finishes = times[1:][same_cpu]
+
+        roles = np.frombuffer(self.pidtracer.roles.bits, dtype=np.uint8)
+        tracked = ((pids != 0) & (pids < len(roles)) &
+                   (roles[np.minimum(pids, len(roles) - 1)]
+                    & PIDRoles.TRACKED != 0))
+
+        return pids[tracked], run_cpus[tracked], starts[tracked], finishes[
+            tracked]
+
+    def _get_names(self, pid):
+        info = (self.pidtracer.app_pids.get(pid)
+                or self.pidtracer.system_pids.get(pid))
+        if info is None:
+            return "", ""
+        return info.pname, info.tname
+
+    def _write_results(self, governor, subdir, start_time, finish_time,
+                       timeline_start, timeline_intervals, thread_pids,
+                       thread_energy, thread_duration, timeline_energy):
+        file_folder = "results/"
+        if subdir:
+            file_folder += subdir
+        if not os.path.exists(file_folder):
+            os.makedirs(file_folder)
+
+        gpu = self.metrics.sys_util_history.gpu
+        timeline_interval = ProcessBranch.timeline_interval_us * 0.000001
+        duration = (finish_time - start_time) * 0.000001
+
+        with open(file_folder + self.filename + "_quick_results.csv",
+                  "w+") as f:
+            results_writer = csv.writer(f, delimiter=",")
+
+            results_writer.writerow(["Application", self.filename])
+            results_writer.writerow(["Governor", governor])
+            results_writer.writerow(["Start", start_time / 1000000.0])
+            results_writer.writerow(["Finish", finish_time / 1000000.0])
+            results_writer.writerow(["Duration", duration])
+            results_writer.writerow([])
+
+            results_writer.writerow([
+                "PID",
+                "Process Name",
+                "Thread Name",
+                "Energy",
+                "Duration",
+            ])
+
+            total_energy = 0.0
+            for i, pid in enumerate(thread_pids.tolist()):
+                energy = [thread_energy[0][i], thread_energy[1][i]]
+                total_energy += energy[0] + energy[1]
+                pname, tname = self._get_names(pid)
+                results_writer.writerow(
+                    [pid, pname, tname, energy,
+                     int(thread_duration[i])])
+
+            gpu_energy = gpu.get_energy(start_time, finish_time)
+            results_writer.writerow(["GPU", gpu_energy])
+            total_energy += gpu_energy
+
+            results_writer.writerow([])
+            results_writer.writerow(["Total Energy", total_energy])
+            try:
+                results_writer.writerow(
+                    ["Average wattage", total_energy / duration])
+            except ZeroDivisionError:
+                print "No events were recorded!"
+
+            results_writer.writerow([])
+            results_writer.writerow(["Energy Timeline"])
+            results_writer.writerow([
+                "Absolute Time",
+                "Sec Offset",
+                "Thread Energy",
+                "Big Energy",
+                "Little Energy",
+                "GPU Energy",
+                "Total Energy",
+                "Temps",
+                "GPU Util",
+                "GPU Freq",
+            ])
+
+            for i in range(timeline_intervals):
+                ts = timeline_start + i * ProcessBranch.timeline_interval_us
+                little = timeline_energy[0][i]
+                big = timeline_energy[1][i]
+                gpu_interval_energy = gpu.get_interval_energy(
+                    i, timeline_interval, timeline_start, finish_time)
+                temps = (self.metrics.get_temp(ts, 4),
+                         self.metrics.get_temp(ts, 0),
+                         self.metrics.get_temp(ts, -1))
+                results_writer.writerow([
+                    str(ts / 1000000.0),
+                    str(i * timeline_interval),
+                    str(little + big),
+                    str(big),
+                    str(little),
+                    str(gpu_interval_energy),
+                    str(little + big + gpu_interval_energy),
+                    str(temps),
+                    str(gpu.get_util(ts - gpu.start_time)),  # Relative to the GPU table
+                    str(gpu.get_freq(ts - gpu.start_time)),
+                ])
+
+        return total_energy
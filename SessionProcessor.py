@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+"""
+Processes the segments of a segmented trace (see Tracer._trace_segments) in order, as one continuous trace.
+
+A single ProcessTree handles the events of all segments, such that open tasks and pending binder transactions
+carry over from one segment into the next. Only one segment's events and per microsecond metric timelines are
+held at a time. Before the next segment is loaded:
+- tasks that are running at the boundary are summed up to the first event of the next segment, using the
+energy timelines of the segment that they were running in
+- the temperature and utilization timelines are compacted into their change points, see
+SystemMetrics.compact_history, from which the timelines of the next segment continue. The utilization windows
+of the cores are kept and the last temperature measurement starts the next segment's temperature timeline.
+- the energy timelines are rebuilt from the boundary, see SystemMetrics.build_energy_timelines
+The frequency timelines and the GPU's utilization table span the whole session. The results of the session are
+written once all segments have been processed.
+"""
+
+import os
+import sys
+import time
+
+import TraceCMDParser
+from ProcessTree import ProcessTree
+from Profiler import Profiler
+from TraceCMDParser import TracecmdProcessor
+from TraceReportParser import TraceReportProcessor, generate_report
+
+__author__ = "Alex Hoffman"
+__copyright__ = "Copyright 2019, Alex Hoffman"
+__license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = "Alex Hoffman"
+__email__ = "alex.hoffman@tum.de"
+__status__ = "Beta"
+
+
+class SessionProcessor:
+    """ Processes a sequence of trace segments, see module docstring.
+    """
+    def __init__(self, trace_processor, metrics, report=False):
+        """
+        :param trace_processor: TraceProcessor of the traced application
+        :param metrics: SystemMetrics of the target system
+        :param report: Parses the ASCII report of each segment instead of its .dat, see TraceReportProcessor
+        """
+        self.trace_processor = trace_processor
+        self.metrics = metrics
+        self.report = report
+        self.binder_log = None
+        self.process_tree = None
+        self.last_temp_event = None
+        self.session_start = None
+        self.session_finish = None
+
+    def process(self,
+                segments,
+                governor,
+                preamble,
+                progress_signal=None,
+                draw=None,
+                subgraph=False,
+                subdir=None,
+                binder_log=None):
+        """ Processes the segments and writes the results of the session.
+
+        :param segments: List of (index, .dat filename, start uptime, finish uptime) tuples in recording order,
+        see Tracer.read_segment_manifest
+        :param preamble: Seconds discarded at the start of the first segment
+        :param draw: Boolean to signal if the visual .dot graph file should be drawn or not
+        :param subgraph: Boolean to signal if the subgraphs of the graph's task nodes should be drawn
+        :param subdir: Sub directory to store results in
+        :param binder_log: Optional BinderTransactionLog that is joined against the binder events of each segment
+        """
+        process_start_time = time.time()
+
+        self.start(binder_log)
+
+        for index, filename, start, finish in segments:
+            print("Segment %d, %s - %s" % (index, start, finish))
+            try:
+                segment = self._load_segment(
+                    filename, preamble if self.session_start is None else 0)
+            except SystemExit:  # The trace processors exit on unreadable files
+                print("Segment %d could not be read, skipping it" % index)
+                continue
+            if not segment.processed_events:
+                print("Segment %d has no events, skipping it" % index)
+                continue
+
+            self.add_segment(segment.processed_events, segment.temp_events,
+                             segment.idle_events,
+                             segment.preamble_thread_events, progress_signal,
+                             subgraph)
+
+        if self.session_start is None:
+            print("No segments could be processed")
+            return
+
+        self.metrics.sys_util_history.gpu.finish_time = self.session_finish
+        Profiler.add_event_stats(self.process_tree.event_stats)
+        self.trace_processor._finish_tree(self.process_tree, governor, subdir,
+                                          None, draw)
+
+        print("** Processing finished in %s seconds **" %
+              (time.time() - process_start_time))
+
+    def start(self, binder_log=None):
+        """ Starts a new session with an empty process tree.
+
+        :param binder_log: Optional BinderTransactionLog that is joined against the binder events of each segment
+        """
+        self.binder_log = binder_log
+        self.process_tree = ProcessTree(self.trace_processor.pidt,
+                                        self.metrics)
+        self.last_temp_event = None
+        self.session_start = None
+        self.session_finish = None
+
+    def add_segment(self,
+                    events,
+                    temp_events,
+                    idle_events,
+                    preamble_thread_events=(),
+                    progress_signal=None,
+                    subgraph=False):
+        """ Handles the events of the next segment of the session, see module docstring.
+
+        :param events: Time ordered processed events of the segment, must not be empty
+        :param temp_events: Temperature events of the segment, may only be empty once a previous segment had some
+        :param idle_events: Idle events of the segment
+        :param preamble_thread_events: Thread events from before the segment's events
+        """
+        Profiler.begin("segment")
+        if self.binder_log is not None:
+            thread_processes, _ = self.binder_log.join(events)
+            self.trace_processor.pidt.thread_processes.update(
+                thread_processes)
+
+        if self.session_start is None:
+            self.session_start = min(
+                [events[0].time] +
+                [e[0].time for e in (idle_events, temp_events) if e])
+            self.metrics.sys_util_history.gpu.init(
+                self.session_start, 0, self.metrics.current_gpu_util)
+            since = None
+        else:
+            since = events[0].time
+            self._advance_running_tasks(self.process_tree, since)
+            self.metrics.compact_history()
+
+        if self.last_temp_event is not None:
+            temp_events = [self.last_temp_event] + temp_events
+        self.trace_processor.build_temp_history(self.process_tree,
+                                                self.metrics, temp_events,
+                                                progress_signal)
+        self.trace_processor.build_util_history(self.process_tree,
+                                                idle_events, progress_signal)
+
+        start_time = time.time()
+        sys.stdout.write("Processing %d events" % len(events))
+        self.metrics.record_frequency_events(events)
+        self.metrics.build_energy_timelines(since)
+
+        for event in preamble_thread_events:
+            self.process_tree.handle_event(event, subgraph)
+        for event in events:
+            self.process_tree.handle_event(event, subgraph)
+        print(" --- COMPLETED in %s seconds" % (time.time() - start_time))
+
+        self.last_temp_event = temp_events[-1]
+        self.session_finish = events[-1].time
+        Profiler.end("segment")
+
+    def _load_segment(self, filename, preamble):
+        if self.report or TraceCMDParser.Trace is None:
+            report_filename = os.path.splitext(filename)[0] + ".report"
+            if not os.path.isfile(report_filename):
+                generate_report(filename, report_filename)
+            return TraceReportProcessor(report_filename, preamble)
+
+        return TracecmdProcessor(filename, preamble)
+
+    @staticmethod
+    def _advance_running_tasks(process_tree, boundary):
+        """ Sums the cycles and energy of the tasks that are running at a segment boundary, whose energy
+        timelines are replaced once the next segment is loaded.
+        """
+        for branch in process_tree.process_branches.itervalues():
+            if not branch.active or not branch.tasks:
+                continue
+            task = branch.tasks[-1]
+            last_event = task.events[-1]
+            if (getattr(last_event, "next_pid", None) == task.pid
+                    and task.calc_time < boundary):
+                task.advance(boundary, last_event.cpu)
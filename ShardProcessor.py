@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+"""
+Handles the events of a trace in time shards, each shard handled by its own ProcessTree within a worker process,
+and stitches the shard trees into the tree that handling all events serially would have built.
+
+The trace is split at the points closest to an even split at which no tracked thread has an open task, such
+that no task spans two shards. Each worker replays the thread events (forks, exits and thread names) from
+before its shard such that threads are classified as they would be at the start of the shard. The shard trees
+are returned as checkpoint arrays (see TreeCheckpoint) and merged in time order, the first task of a branch
+within a shard depending on the branch's last task of the previous shards.
+
+Whether a split was safe is only known once its shards have been handled. The shards on either side of a split
+are merged and handled again when
+- a thread had an open task, or binder transactions were in flight, at the split
+- a thread that was resolved during an earlier shard (see PIDTool.find_pid_info) has events after the split
+- the shard after the split could not be handled without the state of the previous shards
+In the worst case all shards are merged and the trace is handled serially, by a single worker.
+"""
+
+import bisect
+import multiprocessing
+
+import Nodes
+from PIDTool import PIDRoles
+from ProcessBranch import ProcessBranch
+from ProcessTree import ProcessTree
+from SystemEvents import (EventBinderReceived, EventBinderTransaction,
+                          EventFreqChange, EventMaliUtil, EventProcessExit,
+                          EventProcessFork, EventSchedSwitch, ThreadState)
+from TreeCheckpoint import TreeCheckpoint
+
+__author__ = "Alex Hoffman"
+__copyright__ = "Copyright 2019, Alex Hoffman"
+__license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = "Alex Hoffman"
+__email__ = "alex.hoffman@tum.de"
+__status__ = "Beta"
+
+# Set before the worker pool is created such that the workers inherit the events instead of receiving them pickled
+_shard_processor = None
+
+
+def _process_shard(shard):
+    """ Handles the events of a shard. Run within the worker processes.
+
+    :param shard: Tuple of the first and last (exclusive) event index of the shard
+    :return: ShardResult of the shard
+    """
+    # Shard trees are merged through their checkpoint, which must hold all of their tasks
+    ProcessBranch.retention_horizon_us = None
+    return _shard_processor.process_shard(*shard)
+
+
+class ShardResult:
+    """ Shard tree and the state at the shard's bounds that decides whether it can be stitched to its neighbours.
+    """
+    def __init__(self, shard):
+        self.shard = shard
+        self.data = None  # Checkpoint arrays of the shard tree
+        self.nodes = 0  # Number of task and binder nodes created
+        self.open_start = False  # A task was already running at the start of the shard
+        self.open_end = False  # A task or binder transaction was still open at the end of the shard
+        self.resolved_pids = []  # PIDs resolved while handling the shard
+        self.error = None
+        self.event_stats = None  # EventStats of the shard tree
+
+
+class ShardProcessor:
+    """ Handles the events of a trace in parallel shards, see module docstring.
+    """
+
+    # Smallest number of events per shard, the worker overhead outweighs the gain for fewer events
+    min_shard_events = 50000
+
+    def __init__(self, pidtracer, metrics, processes=None):
+        """
+        :param pidtracer: PID tool object that has all the PIDs relevant to the target application stored
+        :param metrics: SystemMetrics whose temperature, utilization and energy timelines have been built
+        :param processes: Number of worker processes, defaults to the number of CPUs
+        """
+        self.pidtracer = pidtracer
+        self.metrics = metrics
+        self.processes = processes or multiprocessing.cpu_count()
+
+        self.events = []
+        self.replayed_events = []
+        self.subgraph = False
+        self.first_id = 0
+
+        self.thread_events = []  # Indices of the fork and exit events
+        self.metric_events = []  # Indices of the fork, exit, frequency and Mali events, as replayed when stitching
+        self.thread_names = dict()  # Thread names as seen in the trace before each split
+        self.last_seen = dict()  # Index of the last event of each PID
+        self.first_received = None  # Index of the first binder received event
+
+    def process(self, events, replayed_events=None, subgraph=False):
+        """ Handles the events in shards and stitches the shard trees.
+
+        :param events: Time ordered events to be handled
+        :param replayed_events: Thread and frequency events from before the events, handled before the events of
+        each shard
+        :param subgraph: Boolean to enable to drawing of the task graph's node's sub-graphs
+        :return: ProcessTree that has handled all events
+        """
+        global _shard_processor
+
+        self.events = events
+        self.replayed_events = replayed_events or []
+        self.subgraph = subgraph
+        self.first_id = Nodes.task_ID
+
+        splits = self._find_splits()
+        shards = zip([0] + splits, splits + [len(events)])
+        results = dict()
+
+        # Each shard is handled by a freshly forked worker as handling a shard changes the PID tool
+        _shard_processor = self
+        pool = multiprocessing.Pool(min(self.processes, len(shards)),
+                                    maxtasksperchild=1)
+        try:
+            while True:
+                pending = [shard for shard in shards if shard not in results]
+                for result in pool.imap(_process_shard, pending):
+                    results[result.shard] = result
+
+                unsafe = self._find_unsafe_splits(shards, results)
+                if not unsafe:
+                    break
+                shards = self._merge_shards(shards, unsafe)
+        finally:
+            pool.close()
+            pool.join()
+            _shard_processor = None
+
+        print(" --- Processed in %d of %d shards" %
+              (len(shards), len(splits) + 1))
+        return self._stitch(shards, results)
+
+    def process_shard(self, start, finish):
+        """ Handles the events of a shard with its own process tree.
+
+        :param start: Index of the first event of the shard
+        :param finish: Index after the last event of the shard
+        :return: ShardResult of the shard
+        """
+        result = ShardResult((start, finish))
+        process_tree = ProcessTree(self.pidtracer, self.metrics)
+        self._replay_threads(process_tree, start)
+
+        Nodes.task_ID = self.first_id
+        known_pids = self._get_classified_pids()
+        try:
+            for event in self.events[start:finish]:
+                process_tree.handle_event(event, self.subgraph)
+        except Exception, e:
+            result.error = "%s, shard %d - %d" % (e, start, finish)
+            return result
+
+        forked = set(self.events[index].child_pid
+                     for index in self.thread_events[bisect.bisect_left(
+                         self.thread_events, start):bisect.bisect_left(
+                             self.thread_events, finish)]
+                     if self.events[index].__class__ is EventProcessFork)
+        result.resolved_pids = list(self._get_classified_pids() - known_pids -
+                                    forked)
+
+        branches = process_tree.process_branches.values()
+        result.open_start = any(
+            branch.tasks and branch.tasks[0].events[0].pid == branch.pid
+            for branch in branches)
+        result.open_end = bool(
+            any(branch.active for branch in branches)
+            or process_tree.pending_binder_calls
+            or process_tree.completed_binder_calls
+            or any(process_tree.received_binder_calls.values()))
+
+        result.data = TreeCheckpoint.dump(process_tree, metrics=False)
+        result.nodes = Nodes.task_ID - self.first_id
+        result.event_stats = process_tree.event_stats
+        return result
+
+    def _replay_threads(self, process_tree, start):
+        """ Brings the PID tool and process tree of a worker to their state at the start of a shard.
+        """
+        for event in self.replayed_events:
+            process_tree.handle_event(event, self.subgraph)
+        for index in self.thread_events[:bisect.bisect_left(
+                self.thread_events, start)]:
+            process_tree.handle_event(self.events[index], self.subgraph)
+
+        if start in self.thread_names:
+            self.pidtracer.thread_names = dict(self.thread_names[start])
+        if self.first_received is not None and self.first_received < start:
+            process_tree.exact_binder_matching = True
+
+    def _get_classified_pids(self):
+        return set(self.pidtracer.app_pids) | set(
+            self.pidtracer.system_pids) | set(self.pidtracer.binder_pids)
+
+    def _find_splits(self):
+        """ Finds the event indices at which the events are split into shards. Threads are considered as open
+        from the switch in that starts their task until they are switched out to sleep, as in ProcessBranch.
+
+        :return: Sorted list of event indices, each the first event of a shard
+        """
+        shard_count = min(self.processes,
+                          len(self.events) // self.min_shard_events)
+
+        roles = self.pidtracer.roles
+        forked = dict()  # Classification of the threads forked or exited during the trace
+        for event in self.replayed_events:
+            if event.__class__ is EventProcessFork:
+                forked[event.child_pid] = bool(
+                    forked.get(event.pid, roles.get(event.pid) &
+                               PIDRoles.TRACKED))
+            elif event.__class__ is EventProcessExit:
+                forked[event.pid] = False
+
+        sleep_state = str(ThreadState.INTERRUPTIBLE_SLEEP_S)
+        open_pids = set()
+        quiet_starts = []  # Ranges of indices at which no thread is open
+        quiet_finishes = []
+        for index, event in enumerate(self.events):
+            event_class = event.__class__
+            if event_class is EventSchedSwitch:
+                self.last_seen[event.pid] = index
+                self.last_seen[event.next_pid] = index
+                if forked.get(event.next_pid, roles.get(event.next_pid) &
+                              PIDRoles.TRACKED):
+                    if event.pid != 0:
+                        if event.prev_state == sleep_state:
+                            open_pids.discard(event.pid)
+                        elif forked.get(event.pid, roles.get(event.pid) &
+                                        PIDRoles.TRACKED):
+                            open_pids.add(event.pid)
+                    open_pids.add(event.next_pid)
+            elif event_class is EventBinderTransaction:
+                self.last_seen[event.pid] = index
+                self.last_seen[event.target_pid] = index
+            elif event_class is EventBinderReceived:
+                self.last_seen[event.pid] = index
+                if self.first_received is None:
+                    self.first_received = index
+            elif event_class is EventProcessFork:
+                forked[event.child_pid] = bool(
+                    forked.get(event.pid, roles.get(event.pid) &
+                               PIDRoles.TRACKED))
+                self.thread_events.append(index)
+                self.metric_events.append(index)
+            elif event_class is EventProcessExit:
+                forked[event.pid] = False
+                self.thread_events.append(index)
+                self.metric_events.append(index)
+            elif event_class is EventFreqChange or event_class is EventMaliUtil:
+                self.metric_events.append(index)
+
+            if not open_pids:
+                if quiet_finishes and quiet_finishes[-1] == index:
+                    quiet_finishes[-1] = index + 1
+                else:
+                    quiet_starts.append(index + 1)
+                    quiet_finishes.append(index + 1)
+
+        splits = []
+        for shard in range(1, shard_count):
+            target = len(self.events) * shard // shard_count
+            split = self._get_nearest_quiet(target, quiet_starts,
+                                            quiet_finishes)
+            if split is not None and 0 < split < len(self.events):
+                splits.append(split)
+        splits = sorted(set(splits))
+
+        self._record_thread_names(splits)
+        return splits
+
+    @staticmethod
+    def _get_nearest_quiet(target, quiet_starts, quiet_finishes):
+        """ Finds the index closest to the target at which no thread is open.
+        """
+        i = bisect.bisect_right(quiet_starts, target) - 1
+        candidates = []
+        if i >= 0:
+            candidates.append(min(target, quiet_finishes[i]))
+        if i + 1 < len(quiet_starts):
+            candidates.append(quiet_starts[i + 1])
+        if not candidates:
+            return None
+        return min(candidates, key=lambda index: abs(index - target))
+
+    def _record_thread_names(self, splits):
+        """ Records the thread names, as observed by the process tree, before each split.
+        """
+        if not splits:
+            return
+
+        names = dict(self.pidtracer.thread_names)
+        for event in self.replayed_events:
+            if event.__class__ is EventProcessFork:
+                names[event.child_pid] = event.child_name
+
+        index = 0
+        for split in splits:
+            for event in self.events[index:split]:
+                if event.__class__ is EventSchedSwitch:
+                    names[event.pid] = event.name
+                    names[event.next_pid] = event.next_name
+                elif event.__class__ is EventProcessFork:
+                    names[event.child_pid] = event.child_name
+            self.thread_names[split] = dict(names)
+            index = split
+
+    def _find_unsafe_splits(self, shards, results):
+        """ Finds the splits at which the shard trees cannot be stitched, see module docstring.
+
+        :return: Set of the first event index of each shard that must be merged with its previous shard
+        """
+        unsafe = set()
+        for i, shard in enumerate(shards):
+            result = results[shard]
+            if result.error:
+                if i == 0:
+                    raise Exception(result.error)
+                unsafe.add(shard[0])
+                continue
+
+            if i > 0 and result.open_start:
+                unsafe.add(shard[0])
+            if i < len(shards) - 1 and result.open_end:
+                unsafe.add(shard[1])
+
+            for pid in result.resolved_pids:
+                last_seen = self.last_seen.get(pid, -1)
+                for later_shard in shards[i + 1:]:
+                    if later_shard[0] <= last_seen:
+                        unsafe.add(later_shard[0])
+
+        return unsafe
+
+    @staticmethod
+    def _merge_shards(shards, unsafe):
+        merged = []
+        for start, finish in shards:
+            if merged and start in unsafe:
+                merged[-1] = (merged[-1][0], finish)
+            else:
+                merged.append((start, finish))
+        return merged
+
+    def _stitch(self, shards, results):
+        """ Merges the shard trees in time order into one process tree. The thread, frequency and Mali events
+        are handled by the stitched tree such that the PID tool and metrics are left as by serial handling.
+        """
+        process_tree = ProcessTree(self.pidtracer, self.metrics)
+        for event in self.replayed_events:
+            process_tree.handle_event(event, self.subgraph)
+        for index in self.metric_events:
+            process_tree.handle_event(self.events[index], self.subgraph)
+
+        id_offset = 0
+        for shard in shards:
+            result = results[shard]
+            TreeCheckpoint.merge(process_tree, result.data, id_offset)
+            id_offset += result.nodes
+            process_tree.event_stats.merge(result.event_stats)
+        Nodes.task_ID = self.first_id + id_offset
+
+        return process_tree
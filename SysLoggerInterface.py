@@ -19,16 +19,19 @@ class SysLogger:
     # The internal buffers on the Odroid XU3 only allow you to increment them slowly
     def _get_da_buffers_up(self, buffer_val):
         cur_val = int(
-            self.adb.command("cat /sys/kernel/debug/tracing/buffer_size_kb"))
+            self.adb.command("cat /sys/kernel/debug/tracing/buffer_size_kb",
+                             idempotent=True))
         attempts = 0
         while cur_val < buffer_val:
             self.adb.command('echo "' + str(cur_val + 500) +
-                             '" > /sys/kernel/debug/tracing/buffer_size_kb')
+                             '" > /sys/kernel/debug/tracing/buffer_size_kb',
+                             idempotent=True)
             time.sleep(0.1)
             prev_val = cur_val
             cur_val = int(
                 self.adb.command(
-                    "cat /sys/kernel/debug/tracing/buffer_size_kb"))
+                    "cat /sys/kernel/debug/tracing/buffer_size_kb",
+                    idempotent=True))
             if prev_val == cur_val:
                 attempts += 1
                 if attempts == 3:
@@ -59,22 +59,11 @@ class Event:
     """ All traced events for task graph extraction always provide the PID that is involved with the event,
     the timestamp of the event, the CPU on which the event occurred and the name of the event.
     """
-    def __init__(self,
-                 pid,
-                 ts,
-                 name,
-                 cpu=0,
-                 freq_l=0,
-                 freq_b=0,
-                 gpu_freq=0,
-                 gpu_util=0):
+    def __init__(self, pid, ts, name, cpu=0):
         self.pid = pid
         self.time = ts
         self.cpu = cpu
         self.name = name
-        self.cpu_freq = [freq_l, freq_b]
-        self.gpu_freq = gpu_freq
-        self.gpu_util = gpu_util
 
 
 class EventSchedSwitch(Event):
@@ -107,6 +96,23 @@ class EventWakeup(Event):
         Event.__init__(self, pid=pid, ts=ts, cpu=cpu, name=name)
 
 
+class EventProcessFork(Event):
+    """ A new thread or process is created, the PID of the event being that of the parent thread.
+    """
+    def __init__(self, pid, ts, cpu, name, child_pid, child_name):
+        Event.__init__(self, pid=pid, ts=ts, cpu=cpu, name=name)
+
+        self.child_pid = child_pid
+        self.child_name = child_name
+
+
+class EventProcessExit(Event):
+    """ A thread exits, after which its PID may be reused by a new thread.
+    """
+    def __init__(self, pid, ts, cpu, name):
+        Event.__init__(self, pid=pid, ts=ts, cpu=cpu, name=name)
+
+
 class EventIdle(Event):
     """ Idle events are used to track how long a certain CPU is no in use and therefore the utilization
     of a thread when executing.
@@ -201,19 +207,43 @@ class FreqPowerEvent:
         self.gpu_util = gpu_util
 
 
+class EventBinderReceived(Event):
+    """ A binder thread has taken a transaction from its queue to handle it. The transaction is identified by
+    the same debug ID as the binder_transaction event that sent it.
+    """
+    def __init__(self, pid, ts, cpu, tran_num):
+        Event.__init__(self, pid=pid, ts=ts, cpu=cpu, name="binder received")
+
+        self.transaction = tran_num
+
+
 class FirstHalfBinderTransaction:
     """ Binder transactions are often directed to the parent binder thread of a
     system service. The exact PID of the child binder thread that will perform the
     transaction is not known when the first half of the transaction is completed.
-    A list of child binder threads is found for the parent binder thread.
-    This list is used to match the second half of the binder transaction to any
-    pending first halves.
+
+    If binder_transaction_received events are traced the handling thread is known
+    exactly from the transaction's debug ID. Otherwise a list of child binder threads
+    is found for the parent binder thread, which is used to match the second half of
+    the binder transaction to any pending first halves.
     """
     def __init__(self, event, parent_pid, pidtracer):
         self.parent_pid = parent_pid
-        self.child_pids = pidtracer.find_child_binder_threads(parent_pid)
+        self.pidtracer = pidtracer
+        self.child_pids = None  # Only found if required, see is_handled_by
         self.send_event = event
 
+    def is_handled_by(self, pid):
+        """ Checks if the given thread could be handling the transaction, ie. if it is the target binder
+        thread or one of its child binder threads.
+        """
+        if pid == self.parent_pid:
+            return True
+        if self.child_pids is None:
+            self.child_pids = self.pidtracer.find_child_binder_threads(
+                self.parent_pid)
+        return pid in self.child_pids
+
 
 class CompletedBinderTransaction:
     """ A binder transaction is completed in two halves, firstly a transaction is performed to a target
@@ -1,10 +1,13 @@
 #!/usr/bin/env python
 
+import bisect
 import sys
 
 import numpy as np
 from enum import Enum
 
+from MemoryBudget import MemoryBudget
+from SystemEvents import EventFreqChange, EventMaliUtil
 from XU3EnergyProfile import XU3RegressionModel
 
 __author__ = "Alex Hoffman"
@@ -31,8 +34,27 @@ class SystemTemps:
     """
     def __init__(self):
         self.temps = []
+        self.times = []  # Times of the measurements, each applies from just after the previous one
         self.initial_time = 0
         self.end_time = 0
+        # Measurements of the previous segments of a session, see SystemMetrics.compact_history
+        self.past_times = []
+        self.past_entries = []
+
+    def get_past_entry(self, ts):
+        """ Returns the measurement that applies at a time before the current temperature timeline.
+        """
+        i = bisect.bisect_left(self.past_times, ts)
+        return self.past_entries[min(i, len(self.past_entries) - 1)]
+
+    def discard_before(self, ts):
+        """ Drops the past measurements that only apply before the given time.
+        """
+        i = min(bisect.bisect_left(self.past_times, ts),
+                len(self.past_times) - 1)
+        if i > 0:
+            del self.past_times[:i]
+            del self.past_entries[:i]
 
 
 class UtilizationSlice:
@@ -112,22 +134,90 @@ class UtilizationWindow:
 
 
 class CPUUtilizationTable(UtilizationTable):
+
+    # Duration (in microseconds) of the window over which utilizations are averaged
+    window_duration = 250000
+    # Keeps the idle events' times and states, such that the utilizations can be rebuilt over other windows once
+    # checkpointed, see rebuild
+    record_states = False
+
     def __init__(self, core_num):
         UtilizationTable.__init__(self)
 
-        self.uw = UtilizationWindow(250000)
+        self.uw = UtilizationWindow(self.window_duration)
         self.core = core_num
         self.utils = None
+        self.history = MetricTimeline(0.0)  # Utilizations before start_time, see compact
+        self.scratch = None  # Scratch file of the utilizations once the memory budget is exceeded
+        self.idle_times = []
+        self.idle_states = []
 
     def get_util(self, ts):
 
+        if ts <= self.start_time and self.history.times:
+            return self.history.get(ts)
+
         try:
             return self.utils[ts - self.start_time - 1]
         except Exception:
             return 0.0
 
+    def get_utils(self, timestamps):
+        """ Vectorized get_util, returns the utilizations at each of the given times as a numpy array.
+        """
+        utils = np.zeros(len(timestamps))
+        if self.utils is not None and len(self.utils):
+            # Negative indices wrap around as in get_util
+            indices = timestamps - self.start_time - 1
+            valid = (indices >= -len(self.utils)) & (indices < len(
+                self.utils))
+            utils[valid] = self.utils[indices[valid]]
+        if self.history.times:
+            before = timestamps <= self.start_time
+            utils[before] = self.history.get_many(timestamps[before])
+        return utils
+
+    def rebuild(self, window_duration):
+        """ Recomputes the per microsecond utilizations over another window from the recorded idle states, see
+        record_states, as if the idle events had been added with that window. The utilization of each interval
+        between idle events is the share of the window before its end during which the core was not idle,
+        which is looked up from the running sum of the time that the core was not idle.
+
+        :param window_duration: Duration (in microseconds) of the utilization window
+        """
+        self.uw = UtilizationWindow(window_duration)
+        if self.utils is None:
+            return
+        if len(self.idle_times) < 2:
+            raise ValueError("Idle states of core %d were not recorded, see "
+                             "CPUUtilizationTable.record_states" % self.core)
+
+        times = np.array(self.idle_times, dtype=np.int64)
+        # As UtilizationWindow, any state but 0 counts as the core being in use
+        busy = np.array(self.idle_states[:-1], dtype=bool)
+        durations = np.diff(times)
+        busy_sums = np.concatenate(([0], np.cumsum(durations * busy)))
+
+        finishes = times[1:]
+        starts = np.maximum(finishes - window_duration, times[0])
+        spans = (finishes - starts).astype(np.float64)
+        busy_time = busy_sums[1:] - np.interp(starts, times, busy_sums)
+        utils = np.where(spans > 0, busy_time / np.maximum(spans, 1) * 100.0,
+                         0.0)
+
+        # The recorded states go back to the first idle event, before any compaction
+        self.start_time = int(times[0])
+        self.last_event_time = int(times[-1] - times[0])
+        self.history = MetricTimeline(0.0)
+        self.utils = np.repeat(utils, durations)
+        self.scratch = None
+
     def add_idle_event(self, event):
 
+        if self.record_states:
+            self.idle_times.append(event.time)
+            self.idle_states.append(event.state)
+
         if self.start_time is 0:  # First event
             self.start_time = event.time
             self.last_event_time = 0
@@ -138,14 +228,37 @@ class CPUUtilizationTable(UtilizationTable):
         self.uw.add_state(self.core_state, duration)
         util = self.uw.calculate_util()
         util_array = np.full(duration, [util])
-        if self.utils is not None:
+        if self.scratch is not None:
+            self.utils = self.scratch.append(util_array)
+        elif self.utils is not None:
             self.utils = np.concatenate((self.utils, util_array))
+            budget = MemoryBudget.current
+            if budget is not None and budget.exceeded():
+                self.scratch = budget.scratch_array("util%d" % self.core,
+                                                    self.utils)
+                self.utils = self.scratch.view()
         else:
             self.utils = util_array
 
         self.last_event_time = event.time - self.start_time
         self.core_state = event.state
 
+    def compact(self):
+        """ Moves the per microsecond utilizations into the history of utilization changes, such that the table
+        continues from its last idle event without keeping the utilizations before it per microsecond.
+        """
+        if self.utils is None:
+            return
+
+        changes = np.concatenate(([0], np.flatnonzero(np.diff(self.utils)) + 1))
+        for index, util in zip(changes.tolist(), self.utils[changes].tolist()):
+            self.history.add(self.start_time + 1 + index, util)
+
+        self.start_time += self.last_event_time
+        self.last_event_time = 0
+        self.utils = None
+        self.scratch = None
+
 
 class GPUUtilizationTable(UtilizationTable):
     def __init__(self):
@@ -177,6 +290,16 @@ class GPUUtilizationTable(UtilizationTable):
         self.current_util = event.util
         self.last_event_time = event.time - self.start_time
 
+    def discard_before(self, ts):
+        """ Drops the utilization slices that end before the given time.
+        """
+        relative_time = ts - self.start_time
+        i = 0
+        while (i < len(self.events) and self.events[i].start_time +
+               self.events[i].duration < relative_time):
+            i += 1
+        del self.events[:i]
+
     def get_util(self, ts):
 
         for x, event in enumerate(self.events):
@@ -305,6 +428,157 @@ class GPUUtilizationTable(UtilizationTable):
         return self.get_energy(microsecond_start, microsecond_finish)
 
 
+class MetricTimeline:
+    """ A metric that changes in steps over time, eg. a cluster's frequency. Stored as the sorted times at which
+    the metric changed and the values it changed to, such that the value at any time is found by a binary search.
+    """
+    def __init__(self, initial):
+        """
+        :param initial: Value of the metric before its first change
+        """
+        self.initial = initial
+        self.times = []
+        self.values = []
+        self._arrays = None
+
+    def add(self, ts, value):
+        """ Records a change of the metric. Changes are expected in chronological order.
+        """
+        if self.times and ts < self.times[-1]:
+            i = bisect.bisect_right(self.times, ts)
+            self.times.insert(i, ts)
+            self.values.insert(i, value)
+        else:
+            self.times.append(ts)
+            self.values.append(value)
+        self._arrays = None
+
+    def get(self, ts):
+        """ Returns the value of the metric at the given time, a change at exactly the given time applies.
+        """
+        i = bisect.bisect_right(self.times, ts)
+        return self.values[i - 1] if i else self.initial
+
+    def discard_before(self, ts):
+        """ Drops the changes before the change in effect at the given time, which also becomes the initial
+        value.
+        """
+        i = bisect.bisect_right(self.times, ts) - 1
+        if i > 0:
+            del self.times[:i]
+            del self.values[:i]
+            self.initial = self.values[0]
+            self._arrays = None
+
+    def get_many(self, timestamps):
+        """ Vectorized get, returns the values of the metric at each of the given times as a numpy array.
+        """
+        if self._arrays is None:
+            self._arrays = (np.array(self.times, dtype=np.int64),
+                            np.array([self.initial] + self.values))
+        times, values = self._arrays
+        return values[np.searchsorted(times, timestamps, side="right")]
+
+
+class ClusterEnergyTimeline:
+    """ Cumulative energy and cycle counts of a CPU cluster over time. The cluster's power, computed from its
+    frequency, core utilizations and temperatures using the regression model, is constant between the times at
+    which any of these change. The running sums of energy and cycles at each of these breakpoints are
+    precomputed such that the energy or cycles over any interval are the difference of two lookups.
+    """
+    def __init__(self, cluster, times, power, freqs):
+        """
+        :param cluster: 0 for the LITTLE cluster, 1 for the big cluster
+        :param times: Sorted times at which the cluster's power changes
+        :param power: Power (in watts) of the cluster from each breakpoint until the next
+        :param freqs: Frequency (in Hz) of the cluster from each breakpoint until the next
+        """
+        self.cluster = cluster
+        self.times = times
+        self.power = power
+        self.freqs = freqs
+
+        durations = np.diff(times) * 0.000001
+        self.energy_sums = np.concatenate(([0.0], np.cumsum(power[:-1] * durations)))
+        self.cycle_sums = np.concatenate(([0.0], np.cumsum(freqs[:-1] * durations)))
+
+        budget = MemoryBudget.current
+        if budget is not None and budget.exceeded():
+            for name in ("times", "power", "freqs", "energy_sums",
+                         "cycle_sums"):
+                setattr(self, name,
+                        budget.to_memmap("cluster%d_%s" % (cluster, name),
+                                         getattr(self, name)))
+
+    @staticmethod
+    def build(metrics, cluster, since=None):
+        """ Builds the timeline of a cluster from the utilization, temperature and frequency timelines of
+        the given metrics, which must be complete.
+
+        :param metrics: SystemMetrics holding the timelines
+        :param cluster: 0 for the LITTLE cluster, 1 for the big cluster
+        :param since: Time from which the timeline is built, earlier breakpoints are dropped
+        """
+        first_core = cluster * 4
+        tables = metrics.sys_util_history.cpu[first_core:first_core + 4]
+        temp_history = metrics.sys_temp_history
+        freq_history = metrics.cluster_freq_history[cluster]
+
+        breakpoints = [
+            np.array(freq_history.times, dtype=np.int64),
+            np.array(temp_history.times, dtype=np.int64) + 1
+        ]
+        for table in tables:
+            if table.utils is not None and len(table.utils):
+                changes = np.flatnonzero(np.diff(table.utils)) + 1
+                breakpoints.append(table.start_time + 1 + np.concatenate(
+                    ([0], changes, [len(table.utils)])))
+        if since is not None:
+            breakpoints.append(np.array([since], dtype=np.int64))
+        times = np.unique(np.concatenate(breakpoints))
+        if since is not None:
+            times = times[times >= since]
+        if not len(times):
+            times = np.zeros(1, dtype=np.int64)
+
+        freqs = freq_history.get_many(times).astype(np.float64)
+        utils = [ClusterEnergyTimeline._sample_utils(table, times) for table in tables]
+        temps = [metrics.get_temps(times, first_core + i) for i in range(4)]
+
+        power = XU3RegressionModel.get_cpu_per_second_energy(first_core, freqs, utils, temps)[cluster]
+        power = np.where(freqs > 0, power, 0.0)  # Cluster is off
+
+        return ClusterEnergyTimeline(cluster, times, power, freqs)
+
+    @staticmethod
+    def _sample_utils(table, times):
+        """ Vectorized CPUUtilizationTable.get_util.
+        """
+        if table.utils is None or not len(table.utils):
+            return np.zeros(len(times))
+
+        indices = times - table.start_time - 1
+        valid = (indices >= 0) & (indices < len(table.utils))
+        return np.where(valid, table.utils[np.clip(indices, 0, len(table.utils) - 1)], 0.0)
+
+    def _integrate(self, sums, rates, ts):
+        i = np.maximum(np.searchsorted(self.times, ts, side="right") - 1, 0)
+        return sums[i] + rates[i] * (ts - self.times[i]) * 0.000001
+
+    def get_energy(self, start_time, finish_time):
+        """ Returns the energy (in joules) consumed by one core of the cluster running between the given times.
+        Also accepts arrays of start and finish times, returning an array of energies.
+        """
+        return (self._integrate(self.energy_sums, self.power, finish_time) -
+                self._integrate(self.energy_sums, self.power, start_time))
+
+    def get_cycles(self, start_time, finish_time):
+        """ Returns the number of cycles executed by one core of the cluster between the given times.
+        """
+        return (self._integrate(self.cycle_sums, self.freqs, finish_time) -
+                self._integrate(self.cycle_sums, self.freqs, start_time))
+
+
 class SystemUtilization:
     def __init__(self, core_count):
         self.cpu = []
@@ -324,7 +598,8 @@ class SystemMetrics:
     """ Stores all current and previous system metrics for all relevant hardware from the target system.
 
     Attributes:
-        adb                 The ADB connection used to interface with the target Android device.
+        adb                 The ADB connection used to interface with the target Android device, None when offline.
+        initial_metrics     The core and GPU frequencies and utilizations at the start of the trace.
         energy_profile      Regression constants used to calculate per-core energy consumption for target device.
         core_count          Number of cores on the target Android device.
 
@@ -339,21 +614,128 @@ class SystemMetrics:
 
     current_metrics = None
 
-    def __init__(self, adb):
+    def __init__(self, adb, initial_metrics=None):
+        """
+        :param adb: ADBInterface of the target system, None when working offline
+        :param initial_metrics: Tuple of the core frequencies, core utilizations, GPU frequency and GPU utilization
+        at the start of the trace, ie. stored in a checkpoint. Read from the target system if not given, when
+        working offline without them the frequencies are unknown (0) until the first frequency events.
+        """
         self.adb = adb
         self.energy_profile = XU3RegressionModel()
         self.core_count = self._get_core_count()
 
-        self.current_core_freqs = self._get_core_freqs()
-        self.current_core_utils = self._get_core_utils()
-        self.current_gpu_freq = self._get_gpu_freq()
-        self.current_gpu_util = self._get_gpu_util()
+        if initial_metrics is None:
+            if adb is None:
+                initial_metrics = ([0] * self.core_count,
+                                   [0] * self.core_count, 0, 0)
+            else:
+                initial_metrics = (self._get_core_freqs(),
+                                   self._get_core_utils(),
+                                   self._get_gpu_freq(), self._get_gpu_util())
+        core_freqs, core_utils, gpu_freq, gpu_util = initial_metrics
+        self.initial_metrics = (list(core_freqs), list(core_utils), gpu_freq,
+                                gpu_util)
+
+        self.current_core_freqs = list(core_freqs)
+        self.current_core_utils = list(core_utils)
+        self.current_gpu_freq = gpu_freq
+        self.current_gpu_util = gpu_util
 
         self.sys_util_history = SystemUtilization(self.core_count)
         self.sys_temp_history = SystemTemps()
 
+        # Frequencies of the LITTLE and big clusters and of the GPU over time, see record_frequency_events
+        self.cluster_freq_history = [
+            MetricTimeline(self.current_core_freqs[0]),
+            MetricTimeline(self.current_core_freqs[4])
+        ]
+        self.gpu_freq_history = MetricTimeline(self.current_gpu_freq)
+        self.gpu_util_history = MetricTimeline(self.current_gpu_util)
+
+        # Energy and cycle prefix sums of the LITTLE and big clusters, see build_energy_timelines
+        self.cluster_energy = [None, None]
+
         SystemMetrics.current_metrics = self
 
+    def record_frequency_events(self, events):
+        """ Records the CPU and GPU frequency changes of the given events in the frequency timelines.
+
+        :param events: Time ordered list of processed events
+        """
+        for event in events:
+            if isinstance(event, EventFreqChange):
+                self.cluster_freq_history[0 if event.target_cpu < 4 else 1].add(
+                    event.time, event.freq)
+            elif isinstance(event, EventMaliUtil):
+                self.gpu_freq_history.add(event.time, event.freq)
+                self.gpu_util_history.add(event.time, event.util)
+
+    def build_energy_timelines(self, since=None):
+        """ Builds the energy prefix sums of both CPU clusters. The frequency, utilization and temperature
+        timelines must be complete.
+
+        :param since: Time from which the prefix sums are built, the start of the segment when processing a
+        session of multiple segments
+        """
+        self.cluster_energy = [
+            ClusterEnergyTimeline.build(self, 0, since),
+            ClusterEnergyTimeline.build(self, 1, since)
+        ]
+
+    def compact_history(self):
+        """ Keeps only the changes of the per microsecond temperature and utilization timelines, such that the
+        timelines of the next segment of a session can be built while lookups into the previous segments
+        remain valid. The energy timelines are rebuilt for each segment.
+        """
+        temp_history = self.sys_temp_history
+        if len(temp_history.temps):
+            temp_times = np.array(temp_history.times, dtype=np.int64)
+            entries = temp_history.temps[np.clip(
+                temp_times - temp_history.initial_time, 0,
+                len(temp_history.temps) - 1)]
+            temp_history.past_times.extend(temp_history.times)
+            temp_history.past_entries.extend(entries.tolist())
+            temp_history.temps = []
+            temp_history.times = []
+
+        for table in self.sys_util_history.cpu:
+            table.compact()
+
+    def discard_history(self, before):
+        """ Drops the compacted history before a time, such that an unbounded stream of segments only holds
+        the history of a window, see LiveProcessor. Lookups before the time return the values at the time.
+        """
+        self.sys_temp_history.discard_before(before)
+        for table in self.sys_util_history.cpu:
+            table.history.discard_before(before)
+        self.sys_util_history.gpu.discard_before(before)
+        for timeline in self.cluster_freq_history + [
+                self.gpu_freq_history, self.gpu_util_history
+        ]:
+            timeline.discard_before(before)
+
+    def get_energy_timeline(self, core):
+        """ Returns the energy prefix sums of the core's cluster.
+        """
+        return self.cluster_energy[0 if core < 4 else 1]
+
+    def get_temps(self, timestamps, core):
+        """ Vectorized get_temp, returns the temperatures of a core at each of the given times as a numpy array.
+        """
+        temps = self.sys_temp_history.temps
+        indices = np.clip(timestamps - self.sys_temp_history.initial_time, 0,
+                          len(temps) - 1)
+        indices[timestamps <= temps[0].time] = 0
+        indices[timestamps >= temps[-1].time] = len(temps) - 1
+
+        if core == -1:
+            return np.array([entry.gpu for entry in temps[indices]])
+        elif core <= 3:
+            return np.array([entry.little for entry in temps[indices]])
+        else:
+            return np.array([entry.big[core % 4] for entry in temps[indices]])
+
     def get_temp(self, ts, core):
         """ Returns the temperature for a particular core (GPU represented by core -1) at a particular point in time.
         If the time falls before or after the recorded temperature measurements then the first or last temperature will
@@ -363,6 +745,17 @@ class SystemMetrics:
         :param core: The core for which the temperature should be returned
         :return: The temperature of the specified core at the specified time
         """
+        temp_history = self.sys_temp_history
+        if temp_history.past_times and (not len(temp_history.temps) or
+                                        ts < temp_history.temps[0].time):
+            entry = temp_history.get_past_entry(ts)
+            if core == -1:
+                return entry.gpu
+            elif core <= 3:
+                return entry.little
+            else:
+                return entry.big[core % 4]
+
         try:
             if ts <= self.sys_temp_history.temps[0].time:
                 if core == -1:
@@ -397,14 +790,15 @@ class SystemMetrics:
         # return int(self.adb.command("nproc")) #TODO
 
     def _get_core_freqs(self):
-        frequencies = []
+        batch = self.adb.batch()
         for core in range(self.core_count):
+            batch.read_file("/sys/devices/system/cpu/cpu" + str(core) +
+                            "/cpufreq/scaling_cur_freq")
+
+        frequencies = []
+        for output in batch.run():
             try:
-                frequencies.append(
-                    int(
-                        self.adb.command("cat /sys/devices/system/cpu/cpu" +
-                                         str(core) +
-                                         "/cpufreq/scaling_cur_freq")) * 1000)
+                frequencies.append(int(output) * 1000)
             except ValueError:  # Big is off
                 frequencies.append(0)
 
@@ -415,14 +809,30 @@ class SystemMetrics:
         return loads
 
     def _get_gpu_freq(self):
-        return int(self.adb.command("cat /sys/class/misc/mali0/device/clock"))
+        return int(
+            self.adb.command("cat /sys/class/misc/mali0/device/clock",
+                             idempotent=True))
 
     def _get_gpu_util(self):
         return int(
-            self.adb.command("cat /sys/class/misc/mali0/device/utilization"))
+            self.adb.command("cat /sys/class/misc/mali0/device/utilization",
+                             idempotent=True))
 
     def get_cpu_core_freq(self, core):
         return self.current_core_freqs[core]
 
+    def get_cluster_freqs(self, ts):
+        """ Returns the frequencies of the LITTLE and big clusters at the given time.
+        """
+        return [
+            self.cluster_freq_history[0].get(ts),
+            self.cluster_freq_history[1].get(ts)
+        ]
+
+    def get_cpu_freq_at(self, core, ts):
+        """ Returns the frequency of the core's cluster at the given time.
+        """
+        return self.cluster_freq_history[0 if core < 4 else 1].get(ts)
+
     def get_gpu_core_freq(self):
         return self.current_gpu_freq
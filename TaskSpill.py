@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+"""
+On-disk store of the retired tasks of a process branch, see ProcessBranch.retention_horizon_us.
+
+The attributes that finish_tree evaluates are appended as rows of a fixed record type to a binary file, a few
+thousand rows at a time. The file is read back through a memory map, one block of rows at a time, as SpilledTask
+objects that stand in for the original TaskNodes. As such only a block of the spilled tasks is held in memory
+however many tasks have been spilled.
+"""
+
+import os
+import tempfile
+
+import numpy as np
+
+from Dependencies import Dependency
+from Optimizations import OptimizationInfo
+
+__author__ = "Alex Hoffman"
+__copyright__ = "Copyright 2019, Alex Hoffman"
+__license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = "Alex Hoffman"
+__email__ = "alex.hoffman@tum.de"
+__status__ = "Beta"
+
+task_dtype = np.dtype([
+    ("id", np.int64),
+    ("start_time", np.int64),
+    ("finish_time", np.int64),
+    ("duration", np.int64),
+    ("cpu_cycles", np.int64),
+    ("energy", np.float64, (2, )),
+    ("first_cpu", np.int64),
+    ("first_time", np.int64),
+    ("next_start", np.int64),  # Start time of the dependent task, -1 if there is none
+])
+
+
+class SpilledJob:
+    """ The first job of a spilled task.
+    """
+    def __init__(self, ts, cpu):
+        self.time = ts
+        self.cpu = cpu
+
+
+class SpilledDependent:
+    """ The dependent task of a spilled task, of which only the start time is kept.
+    """
+    def __init__(self, start_time):
+        self.start_time = start_time
+
+
+class SpilledTask:
+    """ A task read back from a TaskSpill, providing the attributes of a finished TaskNode that finish_tree
+    evaluates. Its dependent task only provides its start time.
+    """
+    def __init__(self, row, pid, name, graph):
+        self.id = int(row["id"])
+        self.pid = pid
+        self.name = name
+        self.start_time = int(row["start_time"])
+        self.finish_time = int(row["finish_time"])
+        self.duration = int(row["duration"])
+        self.cpu_cycles = int(row["cpu_cycles"])
+        self.energy = row["energy"].tolist()
+        self.events = [
+            SpilledJob(int(row["first_time"]), int(row["first_cpu"]))
+        ]
+        self.dependency = Dependency()
+        if row["next_start"] >= 0:
+            self.dependency.next_task = SpilledDependent(
+                int(row["next_start"]))
+        self.optimization_info = OptimizationInfo(graph)
+
+
+class TaskSpill:
+    """ Appends tasks to a spill file and reads them back, see module docstring.
+    """
+
+    # Rows written and read at a time
+    block_rows = 4096
+
+    def __init__(self, directory, pid, name, graph):
+        """
+        :param directory: Directory in which the spill file is created
+        :param pid: PID of the branch whose tasks are spilled
+        :param name: Thread name of the branch
+        :param graph: Graph of the branch's tree
+        """
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        fd, self.filename = tempfile.mkstemp(suffix=".tasks",
+                                             prefix="branch%d_" % pid,
+                                             dir=directory)
+        os.close(fd)
+
+        self.pid = pid
+        self.name = name
+        self.graph = graph
+        self.pending = []
+        self.count = 0
+
+    def __del__(self):
+        try:
+            os.remove(self.filename)
+        except OSError:
+            pass
+
+    def __len__(self):
+        return self.count
+
+    def append(self, task):
+        """ Spills a finished task, whose dependent task has started.
+        """
+        next_task = task.dependency.next_task
+        self.pending.append((
+            task.id,
+            task.start_time,
+            task.finish_time,
+            task.duration,
+            task.cpu_cycles,
+            task.energy,
+            task.events[0].cpu,
+            task.events[0].time,
+            next_task.start_time if next_task else -1,
+        ))
+        self.count += 1
+        if len(self.pending) >= self.block_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        with open(self.filename, "ab") as f:
+            np.array(self.pending, dtype=task_dtype).tofile(f)
+        self.pending = []
+
+    def iter_tasks(self, reverse=False):
+        """ Reads the spilled tasks back, one block at a time.
+
+        :param reverse: Yields the tasks from the most recently spilled task backwards
+        :return: Generator of SpilledTask
+        """
+        self.flush()
+        if not self.count:
+            return
+
+        rows = np.memmap(self.filename, dtype=task_dtype, mode="r")
+        starts = range(0, len(rows), self.block_rows)
+        if reverse:
+            starts.reverse()
+
+        for start in starts:
+            block = np.array(rows[start:start + self.block_rows])
+            if reverse:
+                block = block[::-1]
+            for row in block:
+                yield SpilledTask(row, self.pid, self.name, self.graph)
@@ -7,7 +7,12 @@ objects, found in the SystemEvents module of the energy debugger.
 import sys
 
 from SystemEvents import *
-from tracecmd import Trace
+from Tracer import Tracer
+
+try:
+    from tracecmd import Trace
+except ImportError:  # The ctracecmd SWIG module could not be loaded, see TraceReportParser
+    Trace = None
 
 __author__ = "Alex Hoffman"
 __copyright__ = "Copyright 2019, Alex Hoffman"
@@ -18,6 +23,9 @@ __email__ = "alex.hoffman@tum.de"
 __status__ = "Beta"
 
 
+thread_event_names = frozenset(Tracer.thread_events)
+
+
 class EventCounts:
     """ Used simply to track the number of different events that occured throughout the duration of a trace.
     """
@@ -27,8 +35,23 @@ class EventCounts:
         self.update_cpu_metric = 0
         self.cpu_freq = 0
         self.binder_transaction = 0
+        self.binder_received = 0
         self.mali = 0
         self.temp = 0
+        self.process_fork = 0
+        self.process_exit = 0
+        # Lines of handled events that could not be parsed by event name, see TraceReportProcessor
+        self.skipped = dict()
+
+    def merge(self, other):
+        """ Adds the counts of another part of the trace.
+        """
+        for count, value in vars(other).iteritems():
+            if count == "skipped":
+                for name, skipped in value.iteritems():
+                    self.skipped[name] = self.skipped.get(name, 0) + skipped
+            else:
+                setattr(self, count, getattr(self, count) + value)
 
 
 class TracecmdProcessor:
@@ -40,6 +63,12 @@ class TracecmdProcessor:
         self.processed_events = []
         self.temp_events = []
         self.idle_events = []
+        self.trace_markers = dict()
+        # Threads created or exited during the discarded preamble, see TraceProcessor
+        self.preamble_thread_events = []
+        if Trace is None:
+            print "Tracecmd module could not be loaded, the trace report must be parsed instead"
+            sys.exit(1)
         try:
             self.trace = Trace(str(filename))
         except Exception, e:
@@ -61,8 +90,17 @@ class TracecmdProcessor:
             print "------ CPU freq: " + str(self.event_count.cpu_freq)
             print "------ Binder transactions: " + str(
                 self.event_count.binder_transaction)
+            print "------ Binder received: " + str(
+                self.event_count.binder_received)
             print "------ Mali: " + str(self.event_count.mali)
             print "------ Temp: " + str(self.event_count.temp)
+            print "------ Thread fork/exit: %d/%d" % (
+                self.event_count.process_fork, self.event_count.process_exit)
+            for name, skipped in sorted(self.event_count.skipped.items()):
+                print "------ Skipped unparsable %s lines: %d" % (name, skipped)
+            if "start" in self.trace_markers and "stop" in self.trace_markers:
+                print "--- Trace markers: %d - %d" % (
+                    self.trace_markers["start"], self.trace_markers["stop"])
         except Exception, e:
             print("Print event count failed, %s" % e)
 
@@ -78,10 +116,54 @@ class TracecmdProcessor:
         if start_time == 0 and event:
             start_time = int(round(event.ts / 1000.0)) + (preamble * 1000000)
         while event:
-            if int(round(event.ts / 1000.0)) > start_time:
+            if event.name == "print":  # Markers are kept even if they fall into the preamble
+                self._handle_marker(int(round(event.ts / 1000.0)),
+                                    event.str_field("buf"))
+            elif int(round(event.ts / 1000.0)) > start_time:
                 self._handle_event(event)
+            elif event.name in thread_event_names:
+                self.preamble_thread_events.append(
+                    self._create_thread_event(event))
             event = self.trace.read_next_event()
 
+    def _handle_marker(self, ts, buf):
+        """ Records the timestamps of the markers written by the Tracer when tracing was enabled and disabled.
+
+        :param ts: Timestamp of the trace_marker write
+        :param buf: Contents of the trace_marker write
+        """
+        if not buf:
+            return
+
+        if Tracer.start_marker in buf:
+            self.trace_markers["start"] = ts
+        elif Tracer.stop_marker in buf:
+            self.trace_markers["stop"] = ts
+
+    def _create_thread_event(self, event):
+        """ Creates the event object of a sched_process_fork or sched_process_exit event.
+
+        :param event: Tracecmd event object to be processed into Event object
+        """
+        if event.name == "sched_process_fork":
+            self.event_count.process_fork += 1
+            return EventProcessFork(
+                pid=event.num_field("parent_pid"),
+                ts=int(round(event.ts / 1000.0)),
+                cpu=event.cpu,
+                name=event.str_field("parent_comm"),
+                child_pid=event.num_field("child_pid"),
+                child_name=event.str_field("child_comm"),
+            )
+
+        self.event_count.process_exit += 1
+        return EventProcessExit(
+            pid=event.num_field("pid"),
+            ts=int(round(event.ts / 1000.0)),
+            cpu=event.cpu,
+            name=event.str_field("comm"),
+        )
+
     def _handle_event(self, event):
         """ Create an appropriate Event class child object that is then added to the list of unprocessed
         python objects.
@@ -186,6 +268,17 @@ class TracecmdProcessor:
                     tran_num=trans_num,
                 ))
 
+        elif event.name == "binder_transaction_received":
+            self.event_count.binder_received += 1
+
+            self.processed_events.append(
+                EventBinderReceived(
+                    pid=event.pid,
+                    ts=int(round(event.ts / 1000.0)),
+                    cpu=event.cpu,
+                    tran_num=event.num_field("debug_id"),
+                ))
+
         elif event.name == "mali":
             self.event_count.mali += 1
 
@@ -223,5 +316,8 @@ class TracecmdProcessor:
                     gpu=gpu,
                 ))
 
+        elif event.name in thread_event_names:
+            self.processed_events.append(self._create_thread_event(event))
+
         else:
             pass  # print "Unknown event %s" % event.name
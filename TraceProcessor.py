@@ -5,7 +5,15 @@ import time
 import numpy as np
 
 from Grapher import Grapher
+from MemoryBudget import MemoryBudget
 from ProcessTree import ProcessTree
+from Profiler import Profiler
+from QuickLook import QuickLook
+from ShardProcessor import ShardProcessor
+from SystemEvents import (EventBinderReceived, EventBinderTransaction,
+                          EventFreqChange, EventMaliUtil, EventProcessExit,
+                          EventProcessFork, EventSchedSwitch)
+from TreeCheckpoint import TreeCheckpoint
 
 __author__ = "Alex Hoffman"
 __copyright__ = "Copyright 2019, Alex Hoffman"
@@ -16,12 +24,56 @@ __email__ = "alex.hoffman@tum.de"
 __status__ = "Beta"
 
 
+def parse_window(window):
+    """ Parses a processing window given as "start:end", both values being seconds offset from the start of
+    the trace. Either side may be left empty, ie. ":2.5" processes the first two and a half seconds.
+
+    :param window: String representation of the window
+    :return: Tuple of (start, end) in seconds, end being None if the window is open ended
+    """
+    try:
+        start, end = window.split(":")
+        start = float(start) if start else 0.0
+        end = float(end) if end else None
+    except ValueError:
+        raise ValueError("Window must be given as start:end in seconds")
+
+    if start < 0 or (end is not None and end <= start):
+        raise ValueError("Window end must come after window start")
+
+    return start, end
+
+
+def find_event_index(events, ts):
+    """ Binary searches a time ordered list of events for the index of the first event at or after the
+    given timestamp.
+
+    :param events: List of events sorted by time
+    :param ts: Timestamp that is to be searched for
+    :return: Index of the first event with a time >= ts
+    """
+    lo = 0
+    hi = len(events)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if events[mid].time < ts:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
 class TraceProcessor:
     """ After a trace is run the trace data is retrieved from the target Android system. This binary trace
     data must be parsed and processed. The TraceProcessor class loads the data using the provided filename,
     then processing the stored trace events, compiling required metric histories and process branches as
     well as the final process tree.
     """
+
+    # Warm-up before a processing window, one utilization window such that core utilizations and running
+    # tasks have settled by the time the window starts
+    window_margin = 250000
+
     def __init__(self, pidt, filename):
         """
         :param pidt: PID tool object that has all the PIDs relevant to the target application stored
@@ -41,12 +93,19 @@ class TraceProcessor:
             test=None,
             subgraph=False,
             subdir=None,
+            window=None,
+            binder_log=None,
+            checkpoint=None,
+            quick=False,
+            shards=None,
     ):
         """ There are a number of steps required in processing a given trace. This is outlined below.
 
         - Idle and temperature events are preprocessed and removed from the pending events to be processed. This
         is so that the per core temperature and utilization lookup timelines can be generated before the events that
         depending on them to calculate energy consumptions are processed.
+        - The frequency changes are recorded and, together with the temperature and utilization timelines, used to
+        build the per cluster energy timelines from which task energy is looked up
         - Events are handled by their respective PID branches
         - The process tree is finished, this generates the results of the energy debugger from the data stored in the
         process branches
@@ -58,9 +117,17 @@ class TraceProcessor:
         :param duration: The duration for which the trace should be processed, required as the tracing duration
         is not exact, due to overhead in loading and unloading the trace framework
         :param draw: Boolean to signal if the visual .dot graph file should be drawn or not
-        :param test: Boolean to signal if the trial is a test of not, test runs only parse 300 events such that they
-        can complete the processing process quickly
+        :param test: Number of events to process, test runs only parse the first events such that they can complete
+        the processing process quickly. Ignored when a window is given.
         :param subgraph: Boolean to signal if the subgraphs of the graph's task nodes should be drawn
+        :param window: Tuple of (start, end) seconds, relative to the trace start, to which all processing is
+        restricted. A warm-up margin before the window is also processed such that metrics are valid at the
+        start of the window.
+        :param binder_log: Optional BinderTransactionLog that is joined against the binder events before processing
+        :param checkpoint: Optional filename to which the processed tree is checkpointed, see process_checkpoint
+        :param quick: Only computes the per-thread energy totals and energy timeline, see QuickLook
+        :param shards: Number of worker processes across which the events are handled in time shards, see
+        ShardProcessor. The events are handled serially if not given.
         """
 
         process_start_time = time.time()
@@ -68,6 +135,18 @@ class TraceProcessor:
         if not tracecmd.processed_events:
             sys.exit("Processing trace failed")
 
+        Profiler.begin("process_trace")
+
+        if binder_log is not None:
+            Profiler.begin("binder_join")
+            start_time = time.time()
+            thread_processes, joined = binder_log.join(
+                tracecmd.processed_events)
+            self.pidt.thread_processes.update(thread_processes)
+            print("Joined binder log, %d transactions joined, processes of %d threads found --- %s Sec"
+                  % (joined, len(thread_processes), time.time() - start_time))
+            Profiler.end("binder_join")
+
         process_tree = ProcessTree(self.pidt, metrics)
         trace_start_time = tracecmd.processed_events[0].time
         if len(tracecmd.idle_events) == 0:
@@ -79,82 +158,125 @@ class TraceProcessor:
             trace_start_time = tracecmd.temp_events[0].time
         trace_finish_time = int(trace_start_time + float(duration) * 1000000)
 
-        try:
-            start_time = time.time()
-            sys.stdout.write("Building temp trees")
-            if len(tracecmd.temp_events):
-                metrics.sys_temp_history.initial_time = tracecmd.temp_events[
-                    0].time
-                metrics.sys_temp_history.end_time = tracecmd.temp_events[
-                    -1].time
+        if window:
+            window_start = trace_start_time + int(window[0] * 1000000)
+            if window[1] is not None:
+                window_finish = trace_start_time + int(window[1] * 1000000)
             else:
-                raise Exception("No temp events")
+                window_finish = trace_finish_time
+            warmup_start = window_start - self.window_margin
+            print("Processing window %s - %s seconds" %
+                  (window[0], "end" if window[1] is None else window[1]))
+        else:
+            window_start = warmup_start = trace_start_time
+            window_finish = None
 
-            temp_history = []
-            no_temp_events = len(tracecmd.temp_events)
-            temp_history.append(
-                process_tree.handle_temp_event(tracecmd.temp_events[0], None))
-            for x in range(len(tracecmd.temp_events[1:])):
-                if progress_signal:
-                    progress_signal.emit(
-                        (round(float(x) / no_temp_events * 100, 2)))
-                temp_history.append(
-                    process_tree.handle_temp_event(tracecmd.temp_events[x + 1],
-                                                   tracecmd.temp_events[x]))
-            if progress_signal:
-                progress_signal.emit(100)
-            metrics.sys_temp_history.temps = np.block(temp_history)
-            print(" --- COMPLETED in %s seconds" % (time.time() - start_time))
+        # Time ordered slices of each event list that fall into the processing window
+        temp_events = tracecmd.temp_events
+        idle_events = tracecmd.idle_events
+        events = tracecmd.processed_events
+        if window:
+            # The last temperature before and first after the window bound the temperature timeline
+            temp_events = temp_events[
+                max(find_event_index(temp_events, warmup_start) - 1, 0):
+                find_event_index(temp_events, window_finish) + 1]
+            idle_events = idle_events[
+                find_event_index(idle_events, warmup_start):
+                find_event_index(idle_events, window_finish)]
+            first_event = find_event_index(events, warmup_start)
+            events = events[first_event:find_event_index(
+                events, window_finish)]
+        elif test:
+            events = events[:test]
+
+        try:
+            self.build_temp_history(process_tree, metrics, temp_events,
+                                    progress_signal)
         except Exception, e:
             print("Error processing temperatures: %s" % e)
             return
 
         try:
-            start_time = time.time()
-            no_idle_events = len(tracecmd.idle_events)
-            sys.stdout.write("Building utilization trees")
-            for x, event in enumerate(tracecmd.idle_events):
-                if progress_signal:
-                    progress_signal.emit(
-                        round(float(x) / no_idle_events * 100, 2))
-                process_tree.handle_idle_event(event)
-            if progress_signal:
-                progress_signal.emit(100)
-            print(" --- COMPLETED in {} seconds".format(time.time() -
-                                                        start_time))
+            self.build_util_history(process_tree, idle_events,
+                                    progress_signal)
         except Exception, e:
             print("Error building utilization trees: %s" % e)
             return
 
+        if window:
+            # Frequencies before the window are only needed as the starting state of the window
+            initial_freq_events = self._get_initial_freq_events(
+                tracecmd.processed_events, first_event)
+        else:
+            initial_freq_events = []
+
+        try:
+            Profiler.begin("energy_timelines")
+            start_time = time.time()
+            sys.stdout.write("Building energy timelines")
+            metrics.record_frequency_events(initial_freq_events)
+            metrics.record_frequency_events(events)
+            metrics.build_energy_timelines()
+            print(" --- COMPLETED in %s seconds" % (time.time() - start_time))
+            Profiler.end("energy_timelines")
+        except Exception, e:
+            print("Error building energy timelines: %s" % e)
+            return
+
         try:
             start_time = time.time()
-            num_events = len(tracecmd.processed_events)
+            num_events = len(events)
             sys.stdout.write("Processing %d events" % num_events)
+            Profiler.set_attribute("events", num_events)
+            Profiler.begin("events")
 
             # TODO does it matter if the first event is a mali event?
-            metrics.sys_util_history.gpu.init(trace_start_time,
-                                              trace_finish_time,
-                                              metrics.current_gpu_util)
+            metrics.sys_util_history.gpu.init(
+                warmup_start, window_finish or trace_finish_time,
+                metrics.current_gpu_util)
         except Exception, e:
             print("Error initializing GPU util: %s" % e)
             return
 
-        try:
-            error_event = 0
-            if test:
-                for x, event in enumerate(tracecmd.processed_events[:test]):
-                    if (progress_signal and trace_start_time <= event.time <=
-                            trace_finish_time):
-                        progress_signal.emit(round(float(x) / test * 100, 2))
-                    try:
-                        if process_tree.handle_event(event, subgraph):
-                            break
-                    except Exception, e:
-                        error_event = x
-                        e = str(e) + " event {}".format(error_event)
-                        raise Exception(e)
-            else:
-                for x, event in enumerate(tracecmd.processed_events):
+        # Threads created before the first processed event must be known when their first events are processed
+        replayed_events = list(tracecmd.preamble_thread_events)
+        if window:
+            replayed_events += self._get_thread_events(
+                tracecmd.processed_events, first_event)
+            replayed_events += initial_freq_events
+
+        if quick:
+            total_energy = QuickLook(self.pidt, metrics, self.filename).run(
+                replayed_events + events,
+                governor,
+                subdir,
+                bounds=(window_start, window_finish) if window else None)
+            print(" --- COMPLETED in %s seconds" % (time.time() - start_time))
+            print("Total energy %s J" % total_energy)
+            print("** Processing finished in %s seconds **" %
+                  (time.time() - process_start_time))
+            Profiler.end("process_trace")
+            return
+
+        if shards:
+            try:
+                process_tree = ShardProcessor(self.pidt, metrics,
+                                              shards).process(
+                                                  events, replayed_events,
+                                                  subgraph)
+            except Exception, e:
+                print("Error processing events: %s" % e)
+                return
+            if progress_signal:
+                progress_signal.emit(100)
+            print(" --- COMPLETED in %s seconds" % (time.time() - start_time))
+        else:
+            for event in replayed_events:
+                process_tree.handle_event(event, subgraph)
+
+            try:
+                error_event = 0
+                for x, event in enumerate(events):
                     if (progress_signal and trace_start_time <= event.time <=
                             trace_finish_time):
                         progress_signal.emit(
@@ -166,39 +288,208 @@ class TraceProcessor:
                         error_event = x
                         e = str(e) + " event {}".format(error_event)
                         raise Exception(e)
+                if progress_signal:
+                    progress_signal.emit(100)
+                print(" --- COMPLETED in %s seconds" %
+                      (time.time() - start_time))
+            except Exception, e:
+                print("Error processing event {}: {}".format(error_event, e))
+                return
+
+        Profiler.end("events")
+        Profiler.add_event_stats(process_tree.event_stats)
+
+        # Estimated from the sampled events, see EventStats
+        stats = process_tree.event_stats
+        print(" ------ Sched switch events in %s seconds" %
+              stats.get_estimated_time(EventSchedSwitch))
+        print(" ------ Binder events in %s seconds" %
+              (stats.get_estimated_time(EventBinderTransaction) +
+               stats.get_estimated_time(EventBinderReceived)))
+        print(" ------ Freq events in %s seconds" %
+              stats.get_estimated_time(EventFreqChange))
+
+        bounds = (window_start, window_finish) if window else None
+        if checkpoint:
+            Profiler.begin("checkpoint")
+            start_time = time.time()
+            sys.stdout.write("Writing checkpoint")
+            try:
+                TreeCheckpoint.save(process_tree, checkpoint, window=bounds)
+                print(" --- COMPLETED in %s seconds" %
+                      (time.time() - start_time))
+            except Exception, e:
+                print("Error writing checkpoint: %s" % e)
+            Profiler.end("checkpoint")
+
+        self._finish_tree(process_tree, governor, subdir, bounds, draw)
+
+        print("** Processing finished in %s seconds **" %
+              (time.time() - process_start_time))
+        Profiler.end("process_trace")
+
+    @staticmethod
+    def build_temp_history(process_tree, metrics, temp_events,
+                           progress_signal=None):
+        """ Builds the per microsecond temperature timeline from the temperature events.
+        """
+        Profiler.begin("temp_history")
+        start_time = time.time()
+        sys.stdout.write("Building temp trees")
+        if len(temp_events):
+            metrics.sys_temp_history.initial_time = temp_events[0].time
+            metrics.sys_temp_history.end_time = temp_events[-1].time
+        else:
+            raise Exception("No temp events")
+
+        budget = MemoryBudget.current
+        if budget is not None and budget.exceeded():
+            # Held as the indices of the measurements in a scratch file, see IndexedTimeline
+            metrics.sys_temp_history.temps = budget.indexed_timeline(
+                "temps", [process_tree.get_temp_entry(e) for e in temp_events],
+                [1] + [
+                    event.time - prev.time
+                    for prev, event in zip(temp_events, temp_events[1:])
+                ])
+            metrics.sys_temp_history.times = [e.time for e in temp_events]
             if progress_signal:
                 progress_signal.emit(100)
             print(" --- COMPLETED in %s seconds" % (time.time() - start_time))
-            print(" ------ Sched switch events in %s seconds" %
-                  process_tree.sched_switch_time)
-            print(" ------ Binder events in %s seconds" %
-                  process_tree.binder_time)
-            print(" ------ Freq events in %s seconds" % process_tree.freq_time)
-        except Exception, e:
-            print("Error processing event {}: {}".format(error_event, e))
+            Profiler.end("temp_history")
             return
 
+        temp_history = []
+        no_temp_events = len(temp_events)
+        temp_history.append(process_tree.handle_temp_event(
+            temp_events[0], None))
+        for x in range(len(temp_events[1:])):
+            if progress_signal:
+                progress_signal.emit(
+                    (round(float(x) / no_temp_events * 100, 2)))
+            temp_history.append(
+                process_tree.handle_temp_event(temp_events[x + 1],
+                                               temp_events[x]))
+        if progress_signal:
+            progress_signal.emit(100)
+        metrics.sys_temp_history.temps = np.block(temp_history)
+        metrics.sys_temp_history.times = [e.time for e in temp_events]
+        print(" --- COMPLETED in %s seconds" % (time.time() - start_time))
+        Profiler.end("temp_history")
+
+    @staticmethod
+    def build_util_history(process_tree, idle_events, progress_signal=None):
+        """ Builds the per microsecond utilization timelines of the cores from the idle events.
+        """
+        Profiler.begin("util_history")
+        start_time = time.time()
+        no_idle_events = len(idle_events)
+        sys.stdout.write("Building utilization trees")
+        for x, event in enumerate(idle_events):
+            if progress_signal:
+                progress_signal.emit(round(float(x) / no_idle_events * 100, 2))
+            process_tree.handle_idle_event(event)
+        if progress_signal:
+            progress_signal.emit(100)
+        print(" --- COMPLETED in {} seconds".format(time.time() - start_time))
+        Profiler.end("util_history")
+
+    def process_checkpoint(self, governor, metrics, checkpoint, draw=None,
+                           subdir=None):
+        """ Regenerates the results of a processed trace from its checkpoint, see TreeCheckpoint, without
+        parsing or processing the trace.
+
+        :param metrics: The SystemMetrics object into which the checkpoint's metric timelines are loaded
+        :param checkpoint: Filename of the checkpoint
+        :param draw: Boolean to signal if the visual .dot graph file should be drawn or not
+        :param subdir: Sub directory to store results in
+        """
+        process_start_time = time.time()
+
+        Profiler.begin("load_checkpoint")
+        start_time = time.time()
+        sys.stdout.write("Loading checkpoint")
+        process_tree, window = TreeCheckpoint.load(checkpoint, self.pidt,
+                                                   metrics)
+        print(" --- COMPLETED in %s seconds" % (time.time() - start_time))
+        Profiler.end("load_checkpoint")
+
+        self._finish_tree(process_tree, governor, subdir, window, draw)
+
+        print("** Processing finished in %s seconds **" %
+              (time.time() - process_start_time))
+
+    def _finish_tree(self, process_tree, governor, subdir, window, draw):
+        """ Writes the results of a process tree whose events have all been handled and draws its graph.
+        """
         try:
+            Profiler.begin("finish_tree")
             start_time = time.time()
             sys.stdout.write("Finishing process tree")
             optimizations_found = process_tree.finish_tree(
-                self.filename, governor, subdir)
+                self.filename,
+                governor,
+                subdir,
+                window=window)
             print(" --- COMPLETED in {} seconds".format(time.time() -
                                                         start_time))
             print(
                 "Found {} B2L realloc, {} DVFS, {} Intra-cluster realloc, {} DVFS after realloc"
                 .format(optimizations_found[0], optimizations_found[1],
                         optimizations_found[2], optimizations_found[3]))
+            Profiler.set_attribute("optimizations", optimizations_found)
         except Exception, e:
             print("Error finishing tree: %s" % e)
             return
+        finally:
+            Profiler.end("finish_tree")
 
         if draw:
+            Profiler.begin("draw_graph")
             sys.stdout.write("Drawing graph")
             start_time = time.time()
             draw_graph = Grapher(process_tree, subdir)
             draw_graph.draw_graph()
             print(" --- COMPLETED in %s seconds" % (time.time() - start_time))
+            Profiler.end("draw_graph")
 
-        print("** Processing finished in %s seconds **" %
-              (time.time() - process_start_time))
+    @staticmethod
+    def _get_thread_events(events, index):
+        """ Finds the thread fork and exit events before the given event index.
+
+        :param events: Time ordered list of processed events
+        :param index: Index of the first event of the window
+        :return: The found events in chronological order
+        """
+        return [
+            events[i] for i in xrange(index)
+            if isinstance(events[i], (EventProcessFork, EventProcessExit))
+        ]
+
+    @staticmethod
+    def _get_initial_freq_events(events, index):
+        """ Finds the most recent frequency event of each CPU cluster and of the GPU before the given event
+        index, such that a windowed run starts with the frequencies that were set at the start of the window.
+
+        :param events: Time ordered list of processed events
+        :param index: Index of the first event of the window
+        :return: The found events in chronological order
+        """
+        freq_events = dict()
+        mali_event = None
+
+        for i in xrange(index - 1, -1, -1):
+            event = events[i]
+            if isinstance(event, EventFreqChange):
+                if event.target_cpu not in freq_events:
+                    freq_events[event.target_cpu] = event
+            elif isinstance(event, EventMaliUtil):
+                if mali_event is None:
+                    mali_event = event
+            if len(freq_events) == 2 and mali_event is not None:
+                break
+
+        initial_events = list(freq_events.values())
+        if mali_event is not None:
+            initial_events.append(mali_event)
+
+        return sorted(initial_events, key=lambda e: e.time)
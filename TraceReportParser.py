@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+"""
+Parses the ASCII trace report, generated by 'trace-cmd report', into the same event objects that the
+TracecmdProcessor creates from the binary .dat file. This allows traces to be processed on hosts where the
+ctracecmd SWIG module cannot be loaded.
+
+The report is split into line aligned chunks which are parsed in parallel across a process pool. As the
+chunks are contiguous and results are collected in order the resulting event lists remain sorted by time.
+"""
+
+import multiprocessing
+import os
+import re
+import subprocess
+import sys
+
+from SystemEvents import *
+from TraceCMDParser import EventCounts, TracecmdProcessor, thread_event_names
+from Tracer import Tracer
+
+__author__ = "Alex Hoffman"
+__copyright__ = "Copyright 2019, Alex Hoffman"
+__license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = "Alex Hoffman"
+__email__ = "alex.hoffman@tum.de"
+__status__ = "Beta"
+
+# <comm>-<pid> [<cpu>] (<latency flags>) <sec>.<usec>: <event>: <fields>
+event_line_re = re.compile(
+    r"^\s*(.+)-(\d+)\s+\[(\d+)\]\s+(?:\S+\s+)?(\d+\.\d+):\s+(\w+):\s*(.*)$")
+field_re = re.compile(r"(\w+)=(\S+)")
+
+handled_events = frozenset([
+    "sched_switch", "cpu_idle", "cpu_freq", "binder_transaction",
+    "binder_transaction_received", "mali", "exynos_temp", "print"
+]) | thread_event_names
+
+
+def _num(value):
+    """ Report fields are printed either as decimal or hex values.
+    """
+    return int(value, 0)
+
+
+def _parse_line(line):
+    """ Splits a report line into its header values and the unparsed text of its fields.
+
+    :param line: A single line from the ASCII trace report
+    :return: Tuple of (pid, ts, cpu, name, fields text) or None if the line is not a handled event
+    """
+    match = event_line_re.match(line)
+    if not match:
+        return None
+
+    name = match.group(5)
+    if name not in handled_events:
+        return None
+
+    ts = int(round(float(match.group(4)) * 1000000))
+
+    return int(match.group(2)), ts, int(match.group(3)), name, match.group(6)
+
+
+def _thread_event(name, ts, cpu, fields, counts):
+    """ Creates the event object of a sched_process_fork or sched_process_exit line.
+    """
+    if name == "sched_process_fork":
+        event = EventProcessFork(pid=int(fields["pid"]),
+                                 ts=ts,
+                                 cpu=cpu,
+                                 name=fields["comm"],
+                                 child_pid=int(fields["child_pid"]),
+                                 child_name=fields["child_comm"])
+        counts.process_fork += 1
+        return event
+
+    event = EventProcessExit(pid=int(fields["pid"]),
+                             ts=ts,
+                             cpu=cpu,
+                             name=fields["comm"])
+    counts.process_exit += 1
+    return event
+
+
+def _parse_chunk(chunk):
+    """ Parses a line aligned byte range of the report into event objects. Run within the worker processes.
+
+    :param chunk: Tuple of (filename, start offset, finish offset, timestamp before which events are dropped)
+    :return: Tuple of the processed, temperature and idle events, the event counts, the trace markers and the
+    thread events within the preamble of the chunk
+    """
+    filename, start, finish, start_time = chunk
+
+    with open(filename, "r") as f:
+        f.seek(start)
+        lines = f.read(finish - start).splitlines()
+
+    return parse_lines(lines, start_time)
+
+
+def parse_lines(lines, start_time=0):
+    """ Parses report formatted lines into event objects. The lines of the kernel's trace_pipe share the format
+    of the report and are parsed the same way, see LiveProcessor.
+
+    :param lines: Iterable of report lines
+    :param start_time: Timestamp before which events are dropped
+    :return: Tuple of the processed, temperature and idle events, the event counts, the trace markers and the
+    thread events before the start time
+    """
+    processed_events = []
+    temp_events = []
+    idle_events = []
+    counts = EventCounts()
+    markers = dict()
+    preamble_thread_events = []
+
+    for line in lines:
+        parsed = _parse_line(line)
+        if parsed is None:
+            continue
+
+        pid, ts, cpu, name, text = parsed
+        if name == "print":  # Markers are kept even if they fall into the preamble
+            if Tracer.start_marker in text:
+                markers["start"] = ts
+            elif Tracer.stop_marker in text:
+                markers["stop"] = ts
+            continue
+
+        if ts <= start_time and name not in thread_event_names:
+            continue
+
+        fields = dict(field_re.findall(text))
+
+        try:
+            if name in thread_event_names:
+                event = _thread_event(name, ts, cpu, fields, counts)
+                if ts <= start_time:
+                    preamble_thread_events.append(event)
+                else:
+                    processed_events.append(event)
+
+            elif name == "sched_switch":
+                processed_events.append(
+                    EventSchedSwitch(
+                        pid=pid,
+                        ts=ts,
+                        cpu=cpu,
+                        name=fields["prev_comm"],
+                        prev_state=fields["prev_state"][0],
+                        next_pid=int(fields["next_pid"]),
+                        next_name=fields["next_comm"],
+                    ))
+                counts.sched_switch += 1
+
+            elif name == "cpu_idle":
+                state = 1 if int(fields["state"]) == 4294967295 else 0
+                idle_events.append(
+                    EventIdle(ts=ts, cpu=cpu, name=name, state=state))
+                counts.cpu_idle += 1
+
+            elif name == "cpu_freq":
+                processed_events.append(
+                    EventFreqChange(
+                        pid=pid,
+                        ts=ts,
+                        cpu=cpu,
+                        freq=int(fields["freq"]) * 1000,
+                        util=0,
+                        target_cpu=int(fields["cpu"]),
+                    ))
+                counts.cpu_freq += 1
+
+            elif name == "binder_transaction":
+                to_proc = int(fields["dest_proc"])
+                to_thread = int(fields["dest_thread"])
+                if to_thread == 0:
+                    to_thread = to_proc
+                processed_events.append(
+                    EventBinderTransaction(
+                        pid=pid,
+                        ts=ts,
+                        cpu=cpu,
+                        name=name,
+                        reply=int(fields["reply"]),
+                        dest_proc=to_proc,
+                        target_pid=to_thread,
+                        flags=_num(fields["flags"]),
+                        code=_num(fields["code"]),
+                        tran_num=int(fields["transaction"]),
+                    ))
+                counts.binder_transaction += 1
+
+            elif name == "binder_transaction_received":
+                processed_events.append(
+                    EventBinderReceived(
+                        pid=pid,
+                        ts=ts,
+                        cpu=cpu,
+                        tran_num=int(fields["transaction"]),
+                    ))
+                counts.binder_received += 1
+
+            elif name == "mali":
+                processed_events.append(
+                    EventMaliUtil(
+                        pid=pid,
+                        ts=ts,
+                        cpu=cpu,
+                        util=int(fields["load"]),
+                        freq=int(fields["freq"]) * 1000000,
+                    ))
+                counts.mali += 1
+
+            elif name == "exynos_temp":
+                big0 = int(fields["t0"]) / 1000
+                big1 = int(fields["t1"]) / 1000
+                big2 = int(fields["t2"]) / 1000
+                big3 = int(fields["t3"]) / 1000
+                temp_events.append(
+                    EventTempInfo(
+                        ts=ts,
+                        cpu=cpu,
+                        big0=big0,
+                        big1=big1,
+                        big2=big2,
+                        big3=big3,
+                        little=(big0 + big1 + big2 + big3) / 4.0,
+                        gpu=int(fields["t4"]) / 1000,
+                    ))
+                counts.temp += 1
+
+        except (KeyError, ValueError):
+            # Truncated or malformed line, eg. "LOST EVENTS" in the middle of an event. Counted such that a
+            # field that no longer parses does not silently drop all events of its type
+            counts.skipped[name] = counts.skipped.get(name, 0) + 1
+
+    return (processed_events, temp_events, idle_events, counts, markers,
+            preamble_thread_events)
+
+
+def generate_report(dat_filename, report_filename):
+    """ Generates the ASCII report of a .dat file using the host trace-cmd binary bundled with the tool.
+
+    :param dat_filename: The binary trace that is to be converted
+    :param report_filename: File into which the report is written
+    """
+    trace_cmd = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             "trace-cmd")
+    with open(report_filename, "w") as f:
+        subprocess.check_call([trace_cmd, "report", "-i", dat_filename],
+                              stdout=f)
+
+
+class TraceReportProcessor(TracecmdProcessor):
+    """ Alternative to the tracecmd backend that parses the ASCII trace report, see module docstring. The
+    resulting event lists and counts are identical in structure to those of the TracecmdProcessor such that
+    the rest of the processing pipeline is unchanged.
+    """
+    def __init__(self, filename, preamble, processes=None):
+        self.processed_events = []
+        self.temp_events = []
+        self.idle_events = []
+        self.trace_markers = dict()
+        self.preamble_thread_events = []
+        self.filename = str(filename)
+        self.processes = processes or multiprocessing.cpu_count()
+
+        if not os.path.isfile(self.filename):
+            print "Trace report could not be read: %s" % self.filename
+            sys.exit(1)
+
+        self.event_count = EventCounts()
+        self._process_report(preamble)
+
+    def _get_start_time(self, preamble):
+        """ Finds the timestamp of the first event in the report, from which the preamble is discarded.
+        """
+        with open(self.filename, "r") as f:
+            for line in f:
+                match = event_line_re.match(line)
+                if match:
+                    return int(round(float(match.group(4)) *
+                                     1000000)) + (preamble * 1000000)
+        return 0
+
+    def _get_chunks(self, start_time):
+        """ Splits the report into line aligned byte ranges, a few per worker so that the load is balanced.
+        """
+        size = os.path.getsize(self.filename)
+        chunk_count = self.processes * 4
+        chunk_size = max(size // chunk_count, 1)
+
+        chunks = []
+        start = 0
+        with open(self.filename, "r") as f:
+            while start < size:
+                f.seek(min(start + chunk_size, size))
+                f.readline()
+                finish = min(f.tell(), size)
+                chunks.append((self.filename, start, finish, start_time))
+                start = finish
+
+        return chunks
+
+    def _process_report(self, preamble):
+        start_time = self._get_start_time(preamble)
+        chunks = self._get_chunks(start_time)
+
+        pool = multiprocessing.Pool(self.processes)
+        try:
+            for (processed, temps, idles, counts, markers,
+                 preamble_threads) in pool.imap(_parse_chunk, chunks):
+                self.trace_markers.update(markers)
+                self.preamble_thread_events.extend(preamble_threads)
+                self.processed_events.extend(processed)
+                self.temp_events.extend(temps)
+                self.idle_events.extend(idles)
+                self.event_count.merge(counts)
+        finally:
+            pool.close()
+            pool.join()
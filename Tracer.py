@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 
+import csv
+import math
 import os
 import re
 import sys
@@ -14,6 +16,23 @@ class Tracer:
     """
 
     tracing_path = "/d/tracing/"
+    # Written to trace_marker as tracing is enabled and disabled, see TracecmdProcessor
+    start_marker = "energy_debugger_trace_start"
+    stop_marker = "energy_debugger_trace_stop"
+    # Time given to the device side trace command on top of the traced duration before timing out
+    trace_timeout_margin_ms = 10000
+    # Thread lifecycle events, traced alongside sched_switch such that threads created during the trace are known
+    thread_events = ["sched_process_fork", "sched_process_exit"]
+    # Identifies the thread handling each binder transaction, traced alongside binder_transaction
+    binder_events = ["binder_transaction_received"]
+    # Segmented traces are extracted from the ftrace buffer every segment, short enough for the buffer to hold
+    # a segment's events, see _trace_segments
+    segment_duration = 5
+    segment_marker = "energy_debugger_trace_segment"
+    segment_path = "/data/local/tmp/trace_segments/"
+    device_trace_cmd = "/data/local/tmp/trace-cmd"
+    # Seconds between checks for completed segments
+    segment_poll_interval = 1.0
 
     def __init__(
             self,
@@ -38,12 +57,21 @@ class Tracer:
                          name + "_tracer.trace")
         self.trace_type = trace_type
         self.functions = functions
-        self.events = events
+        self.events = list(events)
+        if "sched_switch" in self.events:
+            self.events += [e for e in self.thread_events if e not in self.events]
+        if "binder_transaction" in self.events:
+            self.events += [e for e in self.binder_events if e not in self.events]
         self.duration = duration
+        self.segment_manifest = "results/" + name + ".segments"
+        self._pull_progress = dict()
 
-    def run_tracer(self, preamble, skip):
+    def run_tracer(self, preamble, skip, segmented=False):
         """ Runs the tracer by getting all of the appropriate flags set in the /d/tracing directory on the
         target system, then starting the trace by writing to the tracing_on file in the tracing directory.
+
+        :param segmented: Records the trace as a sequence of segments that are pulled as they complete, see
+        _trace_segments
         """
 
         if not skip:
@@ -51,7 +79,44 @@ class Tracer:
             self.adb.clear_file(self.tracing_path + "set_event")
         self._set_available_events(self.events)
         self._set_available_tracer(self.trace_type)
-        self._trace_for_time(self.duration, preamble)
+        if segmented:
+            self._trace_segments(self.duration, preamble)
+        else:
+            self._trace_for_time(self.duration, preamble)
+
+    def stream_trace(self, skip, duration=None):
+        """ Runs the tracer, streaming the events from trace_pipe as they are recorded instead of collecting
+        them into a trace file. The events are formatted as in the ASCII trace report, see LiveProcessor.
+
+        :param skip: Keeps the current tracer and events, as for run_tracer
+        :param duration: Time for which the trace should run, the tracer's duration if not given
+        :return: Generator of the streamed text, in the chunks in which it is received
+        """
+        if not skip:
+            self._clear_tracer()
+            self.adb.clear_file(self.tracing_path + "set_event")
+        self._set_available_events(self.events)
+        self._set_available_tracer(self.trace_type)
+
+        trace_us = int((duration or self.duration) * 1000000)
+        # trace_pipe is read until it is killed, once the duration has elapsed
+        command = "; ".join([
+            "echo 1 > " + self.tracing_path + "tracing_on",
+            "echo " + self.start_marker + " > " + self.tracing_path +
+            "trace_marker",
+            "cat " + self.tracing_path + "trace_pipe & pipe=$!",
+            "busybox usleep {}".format(trace_us),
+            "echo " + self.stop_marker + " > " + self.tracing_path +
+            "trace_marker",
+            "echo 0 > " + self.tracing_path + "tracing_on",
+            "busybox usleep {}".format(int(self.segment_poll_interval *
+                                           1000000)),
+            "kill $pipe",
+        ])
+
+        return self.adb.stream_command(command,
+                                       timeout_ms=trace_us / 1000 +
+                                       self.trace_timeout_margin_ms)
 
     def _enable_tracing(self, on=True):
         """ Enables tracing on the system connected to the current ADB connection.
@@ -64,43 +129,160 @@ class Tracer:
             self.adb.write_file(self.tracing_path + "tracing_on", "0")
 
     def _trace_for_time(self, duration, preamble):
-        """ The system time is firstly recorded such that the start time is known in system time.
-        The trace is then let to run for the specified duration.
+        """ Traces for the specified duration using a single device side command that enables tracing, sleeps
+        and disables tracing again. The host does not poll the device during the trace, it only waits for the
+        command to complete. Markers are written into the trace when tracing is enabled and before it is
+        disabled such that the exact trace boundaries are recorded in the trace itself.
 
         :param duration: Time for which the trace should run
+        :param preamble: Time that is traced before the duration, discarded when processing
         """
-        start_time = self._get_device_time()
-        self._enable_tracing(True)
-        while (self._get_device_time() - start_time) < (duration * 1000000 +
-                                                        preamble * 1000000):
-            time.sleep(0.1)
+        trace_us = int((duration + preamble) * 1000000)
+        command = "; ".join([
+            "echo 1 > " + self.tracing_path + "tracing_on",
+            "echo " + self.start_marker + " > " + self.tracing_path +
+            "trace_marker",
+            "cat /proc/uptime",
+            "busybox usleep {}".format(trace_us),
+            "echo " + self.stop_marker + " > " + self.tracing_path +
+            "trace_marker",
+            "echo 0 > " + self.tracing_path + "tracing_on",
+            "cat /proc/uptime",
+        ])
+
+        uptimes = self.adb.command(command,
+                                   timeout_ms=trace_us / 1000 +
+                                   self.trace_timeout_margin_ms)
+        uptimes = re.findall(r"(\d+\.\d+) \d+\.\d+", uptimes)
+
+        if len(uptimes) == 2:
+            print("*** Traced for %s seconds ***" %
+                  (float(uptimes[1]) - float(uptimes[0])))
+        else:
+            print("*** Traced for %s seconds ***" % (duration + preamble))
 
-        print("*** Traced for %s seconds ***" %
-              ((self._get_device_time() - start_time) / 1000000.0))
-        self._enable_tracing(False)
+    def _trace_segments(self, duration, preamble):
+        """ Traces for the specified duration as a sequence of fixed length segments, such that traces longer
+        than the ftrace buffer can hold are not truncated. A device side script writes a segment marker into the
+        trace at the start of each segment and extracts the buffer into a segment file, using trace-cmd extract,
+        at its end. Completed segments are pulled, and removed from the device, while later segments are being
+        recorded. The segments and their device uptime boundaries are listed in the segment manifest, see
+        read_segment_manifest.
 
-    def _get_device_time(self):
-        sys_time = self.adb.command(
-            "cat /proc/uptime")  # Get timestamp when test started
-        return int(float(re.findall(r"(\d+.\d{2})", sys_time)[0]) * 1000000)
+        :param duration: Time for which the trace should run
+        :param preamble: Time that is traced before the duration, discarded when processing
+        """
+        segment_count = int(
+            math.ceil((duration + preamble) / float(self.segment_duration)))
+        segment_us = int(self.segment_duration * 1000000)
+        segment_log = self.segment_path + "segments"
+
+        # The stop marker is written into the last segment, before it is extracted
+        script = "; ".join([
+            "i=0",
+            "echo 1 > " + self.tracing_path + "tracing_on",
+            "echo " + self.start_marker + " > " + self.tracing_path +
+            "trace_marker",
+            "while [ $i -lt {} ]; do ".format(segment_count) +
+            "start=$(cat /proc/uptime); " +
+            "echo " + self.segment_marker + " $i > " + self.tracing_path +
+            "trace_marker; " +
+            "busybox usleep {}; ".format(segment_us) +
+            "if [ $i -eq {} ]; then ".format(segment_count - 1) +
+            "echo " + self.stop_marker + " > " + self.tracing_path +
+            "trace_marker; " +
+            "echo 0 > " + self.tracing_path + "tracing_on; fi; " +
+            "finish=$(cat /proc/uptime); " +
+            self.device_trace_cmd + " extract -o " + self.segment_path +
+            "trace_$i.dat > /dev/null 2>&1; " +
+            "echo $i ${start%% *} ${finish%% *} >> " + segment_log + "; " +
+            "i=$((i + 1)); done",
+        ])
+        batch = self.adb.batch()
+        batch.command("rm -rf " + self.segment_path, idempotent=True)
+        batch.command("mkdir -p " + self.segment_path, idempotent=True)
+        batch.run()
+        self.adb.command("nohup sh -c '" + script + "' > /dev/null 2>&1 &")
+
+        # Segments not completed within their duration and the timeout margin are considered lost
+        timeout = self.segment_duration + self.trace_timeout_margin_ms / 1000.0
+        segments = []
+        last_completed = time.time()
+        while len(segments) < segment_count:
+            time.sleep(self.segment_poll_interval)
+            completed = self.adb.command("cat " + segment_log + " 2> /dev/null",
+                                         idempotent=True).splitlines()
+
+            for line in completed[len(segments):]:
+                index, start, finish = line.split()
+                target_file = self.segment_path + "trace_" + index + ".dat"
+                dest_filename = "results/{}_segment{}.dat".format(
+                    self.name, index)
+                self.adb.pull_file(target_file, dest_filename)
+                self.adb.command("rm " + target_file)
+                segments.append(
+                    (int(index), dest_filename, float(start), float(finish)))
+                last_completed = time.time()
+                print("------ Segment %s, %s - %s" % (index, start, finish))
+
+            if time.time() - last_completed > timeout:
+                print("Segmented trace timed out after %d of %d segments" %
+                      (len(segments), segment_count))
+                break
+
+        self._write_segment_manifest(segments)
+        if segments:
+            print("*** Traced for %s seconds in %d segments ***" %
+                  (segments[-1][3] - segments[0][2], len(segments)))
+
+    def _write_segment_manifest(self, segments):
+        with open(self.segment_manifest, "w+") as f:
+            writer = csv.writer(f, delimiter=",")
+            for segment in segments:
+                writer.writerow(segment)
+
+    @staticmethod
+    def read_segment_manifest(filename):
+        """ Reads the segments of a segmented trace, see _trace_segments.
+
+        :param filename: Segment manifest written by a segmented trace
+        :return: List of (index, .dat filename, start uptime, finish uptime) tuples, in recording order
+        """
+        with open(filename, "r") as f:
+            return [(int(index), dat_filename, float(start), float(finish))
+                    for index, dat_filename, start, finish in csv.reader(f)]
 
-    def get_trace_results(self):
+    def get_trace_results(self, segmented=False):
         """ Retrieves, through the ADB connection, both the tracecmd binary data and the ASCII ftrace data
-        generated by tracecmd.
+        generated by tracecmd, as well as the binder transaction log.
+
+        :param segmented: Only the binder transaction log is retrieved, the segments of a segmented trace are
+        pulled as they are recorded
         """
-        sys.stdout.write("Pulling /data/local/tmp/trace.dat")
-        self.adb.pull_file("/data/local/tmp/trace.dat",
-                           "results/" + self.name + ".dat")
-        print(" --- Completed")
-        sys.stdout.write("Pulling /data/local/tmp/trace.report")
-        self.adb.pull_file("/data/local/tmp/trace.report",
-                           "results/" + self.name + ".report")
-        print(" --- Completed")
-        sys.stdout.write("Pulling /d/binder/transaction_log")
-        self.adb.pull_file("/d/binder/transaction_log",
-                           "results/" + self.name + ".tlog")
+        results = [
+            ("/data/local/tmp/trace.dat", "results/" + self.name + ".dat"),
+            ("/data/local/tmp/trace.report",
+             "results/" + self.name + ".report"),
+            ("/d/binder/transaction_log", "results/" + self.name + ".tlog"),
+        ]
+        if segmented:
+            results = results[2:]
+        print("Pulling " + ", ".join(target for target, _ in results))
+        self._pull_progress = dict()
+        self.adb.pull_files(results, progress_callback=self._print_pull_progress)
         print(" --- Completed")
 
+    def _print_pull_progress(self, filename, current, total):
+        """ Prints the progress of a pull in quarter steps.
+        """
+        if not total:
+            return
+
+        step = current * 4 // total
+        if step > self._pull_progress.get(filename, 0):
+            self._pull_progress[filename] = step
+            print("------ %s %d%%" % (filename, step * 25))
+
     def _get_available_events(self):
         """ Retrieves all the events that are able to be traced on the target system
 
@@ -118,15 +300,14 @@ class Tracer:
 
         avail_events = self._get_available_events()
 
-        if isinstance(events, list):
-            for f in range(0, len(events)):
-                if events[f] in avail_events:
-                    self.adb.append_to_file(self.tracing_path + "set_event",
-                                            events[f])
-        else:
-            if events in avail_events:
-                self.adb.append_to_file(self.tracing_path + "set_event",
-                                        events)
+        if not isinstance(events, list):
+            events = [events]
+
+        batch = self.adb.batch()
+        for event in events:
+            if event in avail_events:
+                batch.append_to_file(self.tracing_path + "set_event", event)
+        batch.run()
 
     def _set_event_filter(self, event, filter_contents):
         """ Sets the ftrace event filter for a particular event.
@@ -135,7 +316,8 @@ class Tracer:
         :param filter_contents: State of the event filter to be set
         """
         event_dir = self.adb.command("find " + self.tracing_path +
-                                     "/events -name " + event)
+                                     "/events -name " + event,
+                                     idempotent=True)
         if event_dir is None:
             return
 
@@ -148,7 +330,8 @@ class Tracer:
         :param event: Event whoes filter is to be cleared
         """
         event_dir = self.adb.command("find " + self.tracing_path +
-                                     "/events -name " + event)
+                                     "/events -name " + event,
+                                     idempotent=True)
         if event_dir is None:
             return
 
@@ -161,7 +344,8 @@ class Tracer:
         :return: String representation of the event's format. Empty string otherwise.
         """
         event_dir = self.adb.command("find " + self.tracing_path +
-                                     "/events -name " + event)
+                                     "/events -name " + event,
+                                     idempotent=True)
         if event_dir is None:
             return ""
 
@@ -186,5 +370,7 @@ class Tracer:
     def _clear_tracer(self):
         """ Resets the current tracer by setting the current tracer to 'nop'.
         """
-        self.adb.write_file(self.tracing_path + "current_tracer", "nop")
-        self.adb.clear_file(self.tracing_path + "trace")
+        batch = self.adb.batch()
+        batch.write_file(self.tracing_path + "current_tracer", "nop")
+        batch.clear_file(self.tracing_path + "trace")
+        batch.run()
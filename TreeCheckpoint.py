@@ -0,0 +1,630 @@
+#!/usr/bin/env python
+"""
+Checkpoints a processed ProcessTree such that its results can be regenerated, ie. with different optimizer or
+timeline settings, without re-parsing and re-processing the trace.
+
+The checkpoint is a single uncompressed .npz file of columnar arrays. The tasks of all branches are stored as
+rows of one task table, each branch referencing its slice of the table, and dependencies reference the row of
+the task that they point to. Binder nodes are stored the same way. The graph is stored as lists of nodes and
+edges with their attributes, and the metric timelines as their change points such that the per microsecond
+lookup arrays are rebuilt on loading.
+
+The process table and the initial metrics of the traced system are stored as well, see load_context, such that
+results can be regenerated offline, without a connection to the target system.
+
+The runs of each task, the intervals during which it was switched in, and the idle states of the cores, if they
+were recorded (see CPUUtilizationTable.record_states), are stored such that a checkpoint can be loaded with
+another utilization window. The utilizations are then rebuilt and the energy of all task runs is looked up from
+the rebuilt energy timelines at once, see load.
+"""
+
+import json
+import re
+
+import numpy as np
+
+from Dependencies import DependencyType
+from Nodes import BinderNode, TaskNode
+from ProcessBranch import ProcessBranch
+from ProcessTree import ProcessTree
+from SystemEvents import Event, EventSchedSwitch
+from SystemMetrics import MetricTimeline, TempLogEntry, UtilizationSlice
+
+__author__ = "Alex Hoffman"
+__copyright__ = "Copyright 2019, Alex Hoffman"
+__license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = "Alex Hoffman"
+__email__ = "alex.hoffman@tum.de"
+__status__ = "Beta"
+
+# Node IDs within the graph labels, eg. "ID: #12"
+node_id_re = re.compile(r"#(\d+)")
+
+
+class TreeCheckpoint:
+    """ Saves and loads processed process trees, see module docstring.
+    """
+
+    version = 3
+
+    # Node kinds of the stored graph
+    NODE_TASK = 0
+    NODE_BINDER = 1
+    NODE_OTHER = 2
+
+    @staticmethod
+    def save(process_tree, filename, window=None):
+        """ Writes the process tree, its graph and the metric timelines of its metrics to a checkpoint.
+
+        :param process_tree: ProcessTree whose events have all been handled
+        :param filename: File into which the checkpoint is written
+        :param window: Tuple of absolute (start, finish) timestamps to which the results are clamped, if any
+        """
+        data = TreeCheckpoint.dump(process_tree, window=window)
+        with open(filename, "wb") as f:
+            np.savez(f, **data)
+
+    @staticmethod
+    def dump(process_tree, window=None, metrics=True):
+        """ Converts the process tree into the columnar arrays of a checkpoint, see module docstring.
+
+        :param process_tree: ProcessTree whose events have all been handled
+        :param window: Tuple of absolute (start, finish) timestamps to which the results are clamped, if any
+        :param metrics: Boolean to signal if the metric timelines are included
+        :return: Dictionary of array name to array
+        """
+        if any(branch.retired_count or branch.retired_binder_count
+               for branch in process_tree.process_branches.itervalues()):
+            raise Exception("Tasks have been retired, see "
+                            "ProcessBranch.retention_horizon_us")
+
+        data = dict(version=np.array(TreeCheckpoint.version))
+        data["window"] = np.array(window if window else [], dtype=np.int64)
+
+        graph_refs = TreeCheckpoint._save_branches(process_tree, data)
+        TreeCheckpoint._save_graph(process_tree.graph, graph_refs, data)
+        if metrics:
+            TreeCheckpoint._save_metrics(process_tree.metrics, data)
+            TreeCheckpoint._save_context(process_tree, data)
+
+        return data
+
+    @staticmethod
+    def read(filename):
+        """ Reads the arrays of a checkpoint, such that it can be loaded repeatedly without reading the file
+        each time, see load.
+        """
+        checkpoint = np.load(filename)
+        try:
+            data = dict((key, checkpoint[key]) for key in checkpoint.files)
+        finally:
+            checkpoint.close()
+
+        if int(data["version"]) != TreeCheckpoint.version:
+            raise ValueError("Checkpoint version %d is not supported" %
+                             int(data["version"]))
+        return data
+
+    @staticmethod
+    def load_context(filename):
+        """ Reads the process table and initial metrics of the traced system from a checkpoint, from which the
+        PIDTool and SystemMetrics of the trace are recreated without the target system.
+
+        :param filename: Checkpoint written by TreeCheckpoint.save
+        :return: Tuple of the 'busybox ps -T' output, the main PID of the application, a dictionary of the thread
+        names seen in the trace and the initial metrics, see SystemMetrics
+        """
+        data = TreeCheckpoint.read(filename)
+        thread_names = dict(zip(data["thread_pids"].tolist(),
+                                [str(name) for name in data["thread_names"]]))
+        initial_metrics = (data["initial_core_freqs"].tolist(),
+                           data["initial_core_utils"].tolist(),
+                           int(data["initial_gpu"][0]),
+                           int(data["initial_gpu"][1]))
+        return (str(data["ps_output"].item()), int(data["main_pid"]),
+                thread_names, initial_metrics)
+
+    @staticmethod
+    def load(filename, pidtracer, metrics, utilization_window=None):
+        """ Rebuilds a process tree from a checkpoint. The metric timelines of the given metrics are replaced
+        by those of the checkpoint.
+
+        :param filename: Checkpoint written by TreeCheckpoint.save, or its arrays as read by read
+        :param pidtracer: PID tool of the traced application
+        :param metrics: SystemMetrics into which the metric timelines are loaded
+        :param utilization_window: Duration (in microseconds) of the utilization window over which the
+        utilizations and task energies are recomputed, see module docstring. The window that the trace was
+        processed with is used if not given.
+        :return: Tuple of the process tree and the window that the checkpoint was processed with, or None
+        """
+        data = (TreeCheckpoint.read(filename)
+                if isinstance(filename, basestring) else filename)
+
+        TreeCheckpoint._load_metrics(data, metrics)
+        if (utilization_window is not None
+                and utilization_window != int(data["util_window"])):
+            data = TreeCheckpoint._rewindow(data, metrics, utilization_window)
+
+        process_tree = ProcessTree(pidtracer, metrics)
+        process_tree.process_branches = dict()
+        process_tree.binder_branches = dict()
+        TreeCheckpoint.merge(process_tree, data)
+
+        window = tuple(data["window"].tolist()) or None
+        return process_tree, window
+
+    @staticmethod
+    def merge(process_tree, data, id_offset=0):
+        """ Adds the branches, tasks and graph of dumped arrays to a process tree. Tasks of branches that
+        already exist in the tree are appended to them, the first appended task depending on the branch's last
+        task as if the branch had handled the events of both trees. Metric timelines are not loaded.
+
+        :param process_tree: ProcessTree into which the arrays are merged
+        :param data: Arrays of TreeCheckpoint.dump
+        :param id_offset: Offset added to the IDs of the merged task and binder nodes
+        """
+        tasks, binder_tasks, links = TreeCheckpoint._load_branches(
+            process_tree, data, id_offset)
+        TreeCheckpoint._load_graph(process_tree.graph, (tasks, binder_tasks),
+                                   data, id_offset)
+
+        for prev_task, task in links:
+            TreeCheckpoint._link_tasks(process_tree.graph, prev_task, task)
+
+    @staticmethod
+    def _save_branches(process_tree, data):
+        branches = ([(0, key, branch) for key, branch in
+                     process_tree.process_branches.iteritems()] +
+                    [(1, key, branch) for key, branch in
+                     process_tree.binder_branches.iteritems()])
+
+        tasks = []
+        binder_tasks = []
+        task_offsets = [0]
+        binder_offsets = [0]
+        for kind, key, branch in branches:
+            tasks.extend(branch.tasks)
+            binder_tasks.extend(branch.binder_tasks)
+            task_offsets.append(len(tasks))
+            binder_offsets.append(len(binder_tasks))
+
+        task_rows = dict((id(task), row) for row, task in enumerate(tasks))
+
+        data["branch_kind"] = np.array([b[0] for b in branches], dtype=np.int8)
+        data["branch_key"] = np.array([b[1] for b in branches], dtype=np.int64)
+        data["branch_pid"] = np.array([b[2].pid for b in branches],
+                                      dtype=np.int64)
+        data["branch_pname"] = np.array([str(b[2].pname) for b in branches],
+                                        dtype=str)
+        data["branch_tname"] = np.array([str(b[2].tname) for b in branches],
+                                        dtype=str)
+        data["branch_cpu"] = np.array(
+            [-1 if b[2].cpu is None else b[2].cpu for b in branches],
+            dtype=np.int64)
+        data["branch_active"] = np.array([b[2].active for b in branches],
+                                         dtype=bool)
+        data["branch_tasks"] = np.array(task_offsets, dtype=np.int64)
+        data["branch_binder_tasks"] = np.array(binder_offsets, dtype=np.int64)
+
+        TreeCheckpoint._save_task_columns("task", tasks, data)
+        data["task_cycles"] = np.array([t.cpu_cycles for t in tasks],
+                                       dtype=np.int64)
+        data["task_calc_time"] = np.array([t.calc_time for t in tasks],
+                                          dtype=np.int64)
+        data["task_duration"] = np.array([t.duration for t in tasks],
+                                         dtype=np.int64)
+        data["task_energy"] = np.array([t.energy for t in tasks],
+                                       dtype=np.float64).reshape(-1, 2)
+        data["task_util"] = np.array([t.util or [0.0] * 4 for t in tasks],
+                                     dtype=np.float64).reshape(-1, 4)
+        data["task_temp"] = np.array([t.temp or [0.0] * 4 for t in tasks],
+                                     dtype=np.float64).reshape(-1, 4)
+        data["task_dep_type"] = np.array(
+            [t.dependency.type.value for t in tasks], dtype=np.int8)
+        data["task_dep_prev"] = np.array([
+            task_rows.get(id(t.dependency.prev_task), -1) for t in tasks
+        ], dtype=np.int64)
+        data["task_dep_next"] = np.array([
+            task_rows.get(id(t.dependency.next_task), -1) for t in tasks
+        ], dtype=np.int64)
+
+        runs = [TreeCheckpoint._get_runs(t) for t in tasks]
+        data["task_runs"] = np.concatenate(
+            ([0], np.cumsum([len(r) for r in runs]))).astype(np.int64)
+        data["run_times"] = np.array(
+            [run for task_runs in runs for run in task_runs],
+            dtype=np.int64).reshape(-1, 3)
+
+        TreeCheckpoint._save_task_columns("binder", binder_tasks, data)
+
+        graph_refs = dict((id(task), (TreeCheckpoint.NODE_TASK, row))
+                          for row, task in enumerate(tasks))
+        graph_refs.update((id(task), (TreeCheckpoint.NODE_BINDER, row))
+                          for row, task in enumerate(binder_tasks))
+        return graph_refs
+
+    @staticmethod
+    def _get_runs(task):
+        """ Returns the (start, finish, CPU) intervals during which a task was switched in, over which its energy
+        was summed, see TaskNode.add_event. Tasks loaded from dumped arrays keep the runs that they were loaded
+        with, as only their first and last events are kept.
+        """
+        if hasattr(task, "runs"):
+            return task.runs
+
+        runs = []
+        calc_time = 0
+        for event in task.events:
+            if not isinstance(event, EventSchedSwitch):
+                continue
+            if event.pid == task.pid:  # Switching out
+                if calc_time == 0:
+                    calc_time = event.time
+                if event.time != calc_time:
+                    runs.append((calc_time, event.time, event.cpu))
+                    calc_time = event.time
+            if event.next_pid == task.pid:  # Switching in
+                calc_time = event.time
+        return runs
+
+    @staticmethod
+    def _save_task_columns(prefix, tasks, data):
+        """ Columns shared by task and binder nodes.
+        """
+        data[prefix + "_id"] = np.array([t.id for t in tasks], dtype=np.int64)
+        data[prefix + "_pid"] = np.array([t.pid for t in tasks],
+                                         dtype=np.int64)
+        data[prefix + "_name"] = np.array([str(t.name) for t in tasks],
+                                          dtype=str)
+        data[prefix + "_start"] = np.array([t.start_time for t in tasks],
+                                           dtype=np.int64)
+        data[prefix + "_finish"] = np.array([t.finish_time for t in tasks],
+                                            dtype=np.int64)
+        # Only the first and last events (jobs) of a task are kept
+        data[prefix + "_events"] = np.array(
+            [[len(t.events), t.events[0].time, t.events[0].cpu,
+              t.events[-1].time, t.events[-1].cpu] for t in tasks],
+            dtype=np.int64).reshape(-1, 5)
+
+    @staticmethod
+    def _save_graph(graph, graph_refs, data):
+        nodes = list(graph.nodes(data=True))
+        node_index = dict((id(node), i) for i, (node, _) in enumerate(nodes))
+
+        refs = [
+            graph_refs.get(id(node), (TreeCheckpoint.NODE_OTHER, i))
+            for i, (node, _) in enumerate(nodes)
+        ]
+        data["node_ref"] = np.array(refs, dtype=np.int64).reshape(-1, 2)
+        data["node_attrs"] = np.array(
+            [json.dumps(attrs, default=str) for _, attrs in nodes], dtype=str)
+
+        edges = list(graph.edges(data=True))
+        data["edge_nodes"] = np.array(
+            [[node_index[id(u)], node_index[id(v)]] for u, v, _ in edges],
+            dtype=np.int64).reshape(-1, 2)
+        data["edge_attrs"] = np.array(
+            [json.dumps(attrs, default=str) for _, _, attrs in edges],
+            dtype=str)
+
+    @staticmethod
+    def _save_timeline(name, timeline, data):
+        data[name + "_initial"] = np.array(timeline.initial)
+        data[name + "_times"] = np.array(timeline.times, dtype=np.int64)
+        data[name + "_values"] = np.array(timeline.values)
+
+    @staticmethod
+    def _save_metrics(metrics, data):
+        TreeCheckpoint._save_timeline("little_freq",
+                                      metrics.cluster_freq_history[0], data)
+        TreeCheckpoint._save_timeline("big_freq",
+                                      metrics.cluster_freq_history[1], data)
+        TreeCheckpoint._save_timeline("gpu_freq", metrics.gpu_freq_history,
+                                      data)
+        TreeCheckpoint._save_timeline("gpu_util", metrics.gpu_util_history,
+                                      data)
+
+        # Temperatures, one row per measurement
+        temp_history = metrics.sys_temp_history
+        temp_times = np.array(temp_history.times, dtype=np.int64)
+        entries = temp_history.temps[np.clip(temp_times -
+                                             temp_history.initial_time, 0,
+                                             len(temp_history.temps) - 1)]
+        data["temp_times"] = temp_times
+        data["temp_values"] = np.array(
+            [e.big + [e.little, e.gpu] for e in entries],
+            dtype=np.float64).reshape(-1, 6)
+
+        # CPU utilizations, as the indices at which each core's lookup array changes value
+        starts = []
+        lengths = []
+        changes = []
+        offsets = [0]
+        for table in metrics.sys_util_history.cpu:
+            utils = table.utils if table.utils is not None else np.zeros(0)
+            starts.append(table.start_time)
+            lengths.append(len(utils))
+            if len(utils):
+                changes.append(
+                    np.concatenate(([0], np.flatnonzero(np.diff(utils)) + 1)))
+            else:
+                changes.append(np.zeros(0, dtype=np.int64))
+            offsets.append(offsets[-1] + len(changes[-1]))
+            data["util_values_%d" % table.core] = utils[changes[-1]]
+        data["util_start"] = np.array(starts, dtype=np.int64)
+        data["util_length"] = np.array(lengths, dtype=np.int64)
+        data["util_changes"] = np.concatenate(changes).astype(np.int64)
+        data["util_offsets"] = np.array(offsets, dtype=np.int64)
+
+        # Idle states, from which the utilizations are rebuilt over other windows
+        data["util_window"] = np.array(
+            metrics.sys_util_history.cpu[0].uw.window_duration, dtype=np.int64)
+        for table in metrics.sys_util_history.cpu:
+            data["idle_times_%d" % table.core] = np.array(table.idle_times,
+                                                          dtype=np.int64)
+            data["idle_states_%d" % table.core] = np.array(
+                table.idle_states, dtype=np.int8)
+
+        gpu = metrics.sys_util_history.gpu
+        data["gpu_table"] = np.array(
+            [gpu.start_time, gpu.finish_time, gpu.current_util],
+            dtype=np.int64)
+        data["gpu_slices"] = np.array(
+            [[s.start_time, s.duration, s.freq, s.util] for s in gpu.events],
+            dtype=np.int64).reshape(-1, 4)
+
+    @staticmethod
+    def _save_context(process_tree, data):
+        pidtracer = process_tree.pidtracer
+        data["ps_output"] = np.array(pidtracer.ps_table.output)
+        data["main_pid"] = np.array(pidtracer.main_pid, dtype=np.int64)
+        data["thread_pids"] = np.array(list(pidtracer.thread_names.keys()),
+                                       dtype=np.int64)
+        data["thread_names"] = np.array(
+            [str(name) for name in pidtracer.thread_names.values()],
+            dtype=str)
+
+        core_freqs, core_utils, gpu_freq, gpu_util = (
+            process_tree.metrics.initial_metrics)
+        data["initial_core_freqs"] = np.array(core_freqs, dtype=np.int64)
+        data["initial_core_utils"] = np.array(core_utils, dtype=np.float64)
+        data["initial_gpu"] = np.array([gpu_freq, gpu_util], dtype=np.int64)
+
+    @staticmethod
+    def _load_timeline(name, data):
+        timeline = MetricTimeline(data[name + "_initial"].item())
+        timeline.times = data[name + "_times"].tolist()
+        timeline.values = data[name + "_values"].tolist()
+        return timeline
+
+    @staticmethod
+    def _load_metrics(data, metrics):
+        metrics.cluster_freq_history = [
+            TreeCheckpoint._load_timeline("little_freq", data),
+            TreeCheckpoint._load_timeline("big_freq", data)
+        ]
+        metrics.gpu_freq_history = TreeCheckpoint._load_timeline(
+            "gpu_freq", data)
+        metrics.gpu_util_history = TreeCheckpoint._load_timeline(
+            "gpu_util", data)
+
+        # Each measurement applies from just after the previous one, the first to its own time only
+        temp_times = data["temp_times"]
+        entries = np.empty(len(temp_times), dtype=object)
+        for i, (ts, values) in enumerate(zip(temp_times.tolist(),
+                                             data["temp_values"].tolist())):
+            entries[i] = TempLogEntry(ts, *values)
+        temp_history = metrics.sys_temp_history
+        temp_history.times = temp_times.tolist()
+        if len(temp_times):
+            temp_history.initial_time = temp_history.times[0]
+            temp_history.end_time = temp_history.times[-1]
+            temp_history.temps = np.repeat(
+                entries, np.concatenate(([1], np.diff(temp_times))))
+
+        offsets = data["util_offsets"]
+        for table in metrics.sys_util_history.cpu:
+            core = table.core
+            table.uw.window_duration = int(data["util_window"])
+            table.idle_times = data["idle_times_%d" % core].tolist()
+            table.idle_states = data["idle_states_%d" % core].tolist()
+            table.start_time = int(data["util_start"][core])
+            length = int(data["util_length"][core])
+            if not length:
+                table.utils = None
+                continue
+            changes = data["util_changes"][offsets[core]:offsets[core + 1]]
+            table.utils = np.repeat(data["util_values_%d" % core],
+                                    np.diff(np.append(changes, length)))
+
+        gpu = metrics.sys_util_history.gpu
+        start_time, finish_time, current_util = data["gpu_table"].tolist()
+        gpu.init(start_time, finish_time, current_util)
+        gpu.events = [
+            UtilizationSlice(start, start + duration + 1, freq=freq, util=util)
+            for start, duration, freq, util in data["gpu_slices"].tolist()
+        ]
+
+        metrics.build_energy_timelines()
+
+    @staticmethod
+    def _rewindow(data, metrics, window_duration):
+        """ Rebuilds the loaded utilizations over another window, and the energy timelines from them. The energy
+        of the tasks is then summed over their runs, and their utilizations at their finish looked up again, as
+        TaskNode.advance and TaskNode.finish do while the events are handled.
+
+        :return: Copy of the arrays in which the tasks' energies and utilizations are replaced
+        """
+        for table in metrics.sys_util_history.cpu:
+            table.rebuild(window_duration)
+        metrics.build_energy_timelines()
+
+        data = dict(data)
+        task_count = len(data["task_id"])
+        run_times = data["run_times"]
+        run_tasks = np.repeat(np.arange(task_count), np.diff(data["task_runs"]))
+
+        energy = np.zeros((task_count, 2))
+        for cluster in range(2):
+            runs = run_times[:, 2] // 4 == cluster
+            run_energy = metrics.cluster_energy[cluster].get_energy(
+                run_times[runs, 0], run_times[runs, 1])
+            energy[:, cluster] = np.bincount(run_tasks[runs],
+                                             weights=run_energy,
+                                             minlength=task_count)
+        data["task_energy"] = energy
+
+        # Utilizations of the cluster that each finished task last ran on
+        utils = np.array(data["task_util"], dtype=np.float64)
+        finish = data["task_finish"]
+        last_cluster = data["task_events"][:, 4] // 4
+        for table in metrics.sys_util_history.cpu:
+            rows = (last_cluster == table.core // 4) & (finish != 0)
+            utils[rows, table.core % 4] = table.get_utils(finish[rows])
+        data["task_util"] = utils
+
+        return data
+
+    @staticmethod
+    def _load_task_columns(node, prefix, row, data, id_offset):
+        node.id = int(data[prefix + "_id"][row]) + id_offset
+        node.start_time = int(data[prefix + "_start"][row])
+        node.finish_time = int(data[prefix + "_finish"][row])
+
+        count, first_time, first_cpu, last_time, last_cpu = data[
+            prefix + "_events"][row].tolist()
+        node.events = [Event(node.pid, first_time, node.name, first_cpu)]
+        if count > 1:
+            node.events.append(Event(node.pid, last_time, node.name,
+                                     last_cpu))
+
+    @staticmethod
+    def _load_branches(process_tree, data, id_offset):
+        tasks = []
+        binder_tasks = []
+        links = []
+
+        for i in range(len(data["branch_kind"])):
+            key = int(data["branch_key"][i])
+            if data["branch_kind"][i] == 0:
+                branches = process_tree.process_branches
+            else:
+                branches = process_tree.binder_branches
+
+            branch = branches.get(key)
+            if branch is None:
+                branch = ProcessBranch(
+                    int(data["branch_pid"][i]),
+                    str(data["branch_pname"][i]),
+                    str(data["branch_tname"][i]),
+                    None,
+                    process_tree.graph,
+                    process_tree.pidtracer,
+                    process_tree.cpus,
+                    process_tree.gpu,
+                )
+                branches[key] = branch
+
+            first_row = data["branch_tasks"][i]
+            if first_row < data["branch_tasks"][i + 1]:
+                branch.active = bool(data["branch_active"][i])
+                if branch.tasks:
+                    links.append((branch.tasks[-1], first_row))
+            cpu = int(data["branch_cpu"][i])
+            if cpu != -1:
+                branch.cpu = cpu
+
+            for row in range(first_row, data["branch_tasks"][i + 1]):
+                task = TaskNode(process_tree.graph,
+                                int(data["task_pid"][row]),
+                                str(data["task_name"][row]))
+                TreeCheckpoint._load_task_columns(task, "task", row, data,
+                                                  id_offset)
+                task.cpu_cycles = int(data["task_cycles"][row])
+                task.calc_time = int(data["task_calc_time"][row])
+                task.duration = int(data["task_duration"][row])
+                task.energy = data["task_energy"][row].tolist()
+                task.util = data["task_util"][row].tolist()
+                task.temp = data["task_temp"][row].tolist()
+                task.dependency.type = DependencyType(
+                    int(data["task_dep_type"][row]))
+                task.runs = [
+                    tuple(run) for run in data["run_times"][
+                        data["task_runs"][row]:data["task_runs"][row +
+                                                                  1]].tolist()
+                ]
+                branch.tasks.append(task)
+                tasks.append(task)
+
+                if task.finish_time:
+                    branch.accumulate_task(task)
+
+            for row in range(data["branch_binder_tasks"][i],
+                             data["branch_binder_tasks"][i + 1]):
+                binder_task = BinderNode(process_tree.graph,
+                                         int(data["binder_pid"][row]),
+                                         str(data["binder_name"][row]))
+                TreeCheckpoint._load_task_columns(binder_task, "binder", row,
+                                                  data, id_offset)
+                branch.binder_tasks.append(binder_task)
+                binder_tasks.append(binder_task)
+
+        for row, task in enumerate(tasks):
+            prev_row = data["task_dep_prev"][row]
+            next_row = data["task_dep_next"][row]
+            task.dependency.prev_task = tasks[prev_row] if prev_row >= 0 else None
+            task.dependency.next_task = tasks[next_row] if next_row >= 0 else None
+
+        return tasks, binder_tasks, [(prev_task, tasks[row])
+                                     for prev_task, row in links]
+
+    @staticmethod
+    def _link_tasks(graph, prev_task, task):
+        """ Connects consecutive tasks of a branch, as ProcessBranch does when a new task is started. The label
+        of the task, written when it finished, is updated to show the dependency.
+        """
+        graph.add_edge(prev_task, task, color="lightseagreen", style="dashed")
+        label = graph.node[task].get("label")
+
+        if task.dependency.type != DependencyType.BINDER:
+            task.dependency.type = DependencyType.TASK
+            if label:
+                label = label.replace("Dependency: NONE ",
+                                      "Dependency: TASK ")
+        if not task.dependency.prev_task:
+            task.dependency.prev_task = prev_task
+            if label:
+                label = label.replace("Dependent: #None",
+                                      "Dependent: #%d" % prev_task.id)
+        if not prev_task.dependency.next_task:
+            prev_task.dependency.next_task = task
+
+        if label:
+            graph.node[task]["label"] = label
+
+    @staticmethod
+    def _load_graph(graph, nodes, data, id_offset):
+        tasks, binder_tasks = nodes
+
+        graph_nodes = []
+        for (kind, row), attrs in zip(data["node_ref"].tolist(),
+                                      data["node_attrs"]):
+            if kind == TreeCheckpoint.NODE_TASK:
+                node = tasks[row]
+            elif kind == TreeCheckpoint.NODE_BINDER:
+                node = binder_tasks[row]
+            else:  # Job nodes of task subgraphs
+                node = "node%d" % graph.number_of_nodes()
+            attrs = json.loads(str(attrs))
+            if id_offset and "label" in attrs:
+                attrs["label"] = node_id_re.sub(
+                    lambda match: "#%d" % (int(match.group(1)) + id_offset),
+                    attrs["label"])
+            graph.add_node(node, **attrs)
+            graph_nodes.append(node)
+
+        for (u, v), attrs in zip(data["edge_nodes"].tolist(),
+                                 data["edge_attrs"]):
+            graph.add_edge(graph_nodes[u], graph_nodes[v],
+                           **json.loads(str(attrs)))